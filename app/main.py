@@ -1,15 +1,41 @@
+import os
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from .routers.camera import router as camera_router
 from .routers.visits import router as visits_router
 from .routers.ws import router as ws_router
-from .routers.results import router as results_router
+from .routers.results import notify_visit, router as results_router
 from .routers.status import router as status_router
+from .routers.jobs import router as jobs_router
+from .routers.metrics import router as metrics_router
+from .routers.patients import router as patients_router
+from .services.camera_pool import pool
+from .services.capabilities import capabilities
+from .services.finalize import warm_worker
+from .services.jobs import jobs
+from .services.profiling import ProfilingMiddleware, profiling_enabled
+from .services.smpl import model_registry
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Probe di OpenCV/MediaPipe/SMPL in background dopo l'avvio, poi warm-up
+    # dei modelli SMPL: il primo finalize non paga il caricamento
+    warmup = model_registry.warmup if os.getenv("SMPL_WARMUP", "1") != "0" else None
+    capabilities.start_background(then=warmup)
+    # process pool dei job: modelli SMPL caricati in ogni processo; eventi di fine job sul WS della visita
+    jobs.set_process_initializer(warm_worker)
+    jobs.add_listener(notify_visit)
+    yield
+    # ferma catture e processi dei dispositivi
+    pool.stop_all()
 
 
 def create_app() -> FastAPI:
-    app = FastAPI(title="PhysioPlus Backend", version="0.1.0")
+    app = FastAPI(title="PhysioPlus Backend", version="0.1.0", lifespan=lifespan)
 
     app.add_middleware(
         CORSMiddleware,
@@ -18,12 +44,18 @@ def create_app() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # profilo a campionamento per singola richiesta (?profile=1): solo se abilitato
+    if profiling_enabled():
+        app.add_middleware(ProfilingMiddleware)
 
     app.include_router(camera_router, prefix="/api/camera", tags=["camera"])
     app.include_router(visits_router, prefix="/api/visits", tags=["visits"])
     app.include_router(ws_router, tags=["ws"])
     app.include_router(results_router, tags=["results"])
     app.include_router(status_router, tags=["status"]) 
+    app.include_router(jobs_router, prefix="/api/jobs", tags=["jobs"])
+    app.include_router(metrics_router, tags=["metrics"])
+    app.include_router(patients_router, prefix="/api/patients", tags=["patients"])
 
     return app
 
@@ -1,24 +1,73 @@
+from typing import Optional
+
 from fastapi import APIRouter
-from ..schemas import ApiResponse
-from ..services.camera import camera
+from ..schemas import ApiResponse, CameraBinding, CameraDevice
+from ..services.camera_pool import pool
 
 
 router = APIRouter()
 
 
+def _not_found(camera_id: Optional[str]) -> ApiResponse:
+    return ApiResponse(success=False, message=f"Camera not found: {camera_id}")
+
+
 @router.post("/start")
-def start_camera() -> ApiResponse:
-    ok, msg = camera.start()
+def start_camera(camera_id: Optional[str] = None) -> ApiResponse:
+    cam = pool.get(camera_id)
+    if cam is None:
+        return _not_found(camera_id)
+    ok, msg = cam.start()
     return ApiResponse(success=ok, message=msg)
 
 
 @router.post("/stop")
-def stop_camera() -> ApiResponse:
-    ok, msg = camera.stop()
+def stop_camera(camera_id: Optional[str] = None) -> ApiResponse:
+    cam = pool.get(camera_id)
+    if cam is None:
+        return _not_found(camera_id)
+    ok, msg = cam.stop()
     return ApiResponse(success=ok, message=msg)
 
 
 @router.get("/status")
-def camera_status() -> ApiResponse:
-    return ApiResponse(success=True, data=camera.status())
+def camera_status(camera_id: Optional[str] = None) -> ApiResponse:
+    cam = pool.get(camera_id)
+    if cam is None:
+        return _not_found(camera_id)
+    cam.attach_shared()
+    return ApiResponse(success=True, data=cam.status())
+
+
+@router.get("/pool")
+def pool_status() -> ApiResponse:
+    return ApiResponse(success=True, data=pool.status())
+
+
+@router.post("/devices")
+def add_device(payload: CameraDevice) -> ApiResponse:
+    try:
+        cam = pool.add(payload.camera_id, payload.source, isolated=payload.isolated)
+    except ValueError as exc:
+        return ApiResponse(success=False, message=str(exc))
+    return ApiResponse(success=True, data=cam.status())
+
+
+@router.delete("/devices/{camera_id}")
+def remove_device(camera_id: str) -> ApiResponse:
+    try:
+        removed = pool.remove(camera_id)
+    except ValueError as exc:
+        return ApiResponse(success=False, message=str(exc))
+    if not removed:
+        return _not_found(camera_id)
+    return ApiResponse(success=True, message="Camera removed")
+
 
+@router.post("/bind")
+def bind_visit(payload: CameraBinding) -> ApiResponse:
+    try:
+        pool.bind(payload.visit_id, payload.camera_id)
+    except KeyError:
+        return _not_found(payload.camera_id)
+    return ApiResponse(success=True, data={"visit_id": payload.visit_id, "camera_id": payload.camera_id})
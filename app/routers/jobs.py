@@ -0,0 +1,23 @@
+from fastapi import APIRouter
+
+from ..schemas import ApiResponse
+from ..services.jobs import jobs
+
+
+router = APIRouter()
+
+
+@router.get("/{job_id}")
+def get_job(job_id: str) -> ApiResponse:
+    job = jobs.get(job_id)
+    if job is None:
+        return ApiResponse(success=False, message="Job not found")
+    return ApiResponse(success=True, data=job.to_dict())
+
+
+@router.delete("/{job_id}")
+def cancel_job(job_id: str) -> ApiResponse:
+    job = jobs.cancel(job_id)
+    if job is None:
+        return ApiResponse(success=False, message="Job not found")
+    return ApiResponse(success=True, data=job.to_dict())
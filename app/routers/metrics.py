@@ -0,0 +1,101 @@
+import asyncio
+import os
+import time
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ..schemas import ApiResponse
+from ..services.camera_pool import pool
+from ..services.jobs import jobs
+from ..services.metrics import metrics, render_histograms, render_metric
+from ..services.profiling import SamplingProfiler, profiles, profiling_enabled
+
+
+router = APIRouter()
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+MAX_PROFILE_S = 60.0
+
+
+def _camera_samples(devices: dict):
+    fps, streaming, clients, dropped, skipped, client_fps = [], [], [], [], [], []
+    for cid, st in devices.items():
+        cam = {"camera_id": cid}
+        conns = st.get("clients") or []
+        fps.append((cam, st.get("measured_fps")))
+        streaming.append((cam, 1 if st.get("streaming") else 0))
+        clients.append((cam, len(conns)))
+        inference = st.get("inference") or {}
+        dropped.append(({**cam, "reason": "inference"}, inference.get("dropped", 0)))
+        # cumulativi per camera: includono i client disconnessi, il contatore non cala
+        ws_dropped = st.get("ws_dropped") or {}
+        dropped.append(({**cam, "reason": "ws_stale"}, ws_dropped.get("ws_stale", 0)))
+        dropped.append(({**cam, "reason": "ws_backlog"}, ws_dropped.get("ws_backlog", 0)))
+        skipped.append((cam, inference.get("skipped", 0)))
+        for c in conns:
+            if "effective_fps" in c:
+                client_fps.append(({**cam, "visit_id": c["visit_id"]}, c["effective_fps"]))
+    return fps, streaming, clients, dropped, skipped, client_fps
+
+
+@router.get("/api/metrics")
+def get_metrics(format: str = "prometheus"):
+    """Metriche del processo in formato Prometheus (`?format=json` per un riepilogo con percentili)."""
+    if format == "json":
+        return ApiResponse(success=True, data={"pid": os.getpid(), "stages": metrics.summary()})
+
+    devices = pool.status()["devices"]
+    fps, streaming, clients, dropped, skipped, client_fps = _camera_samples(devices)
+    job_counts = jobs.stats()["jobs"]
+    lines = render_histograms(
+        "physioplus_stage_latency_seconds", "Latenza per stadio (cattura -> client, finalize).", metrics.merged()
+    )
+    lines += render_metric("physioplus_capture_fps", "gauge", "Frequenza di cattura misurata.", fps)
+    lines += render_metric("physioplus_camera_streaming", "gauge", "1 se la camera sta acquisendo.", streaming)
+    lines += render_metric("physioplus_ws_clients", "gauge", "Client WebSocket connessi.", clients)
+    lines += render_metric("physioplus_ws_client_fps", "gauge", "Fps effettivi inviati a ogni client.", client_fps)
+    lines += render_metric(
+        "physioplus_frames_dropped_total", "counter", "Frame scartati (inferenza in ritardo, client lenti).", dropped
+    )
+    lines += render_metric(
+        "physioplus_inference_skipped_total", "counter", "Frame non inferiti dal motion gate.", skipped
+    )
+    lines += render_metric(
+        "physioplus_jobs", "gauge", "Job per stato.", [({"status": s}, n) for s, n in sorted(job_counts.items())]
+    )
+    lines += render_metric(
+        "process_cpu_seconds_total", "counter", "Tempo CPU del processo.", [({}, round(time.process_time(), 4))]
+    )
+    lines += render_metric("physioplus_process_info", "gauge", "Processo che ha risposto.", [({"pid": os.getpid()}, 1)])
+    return PlainTextResponse("\n".join(lines) + "\n", media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@router.post("/api/metrics/profile")
+async def profile_process(seconds: float = 5.0, interval_ms: float = 5.0) -> ApiResponse:
+    """Campiona tutti i thread del processo per `seconds` (camera, inferenza, WS, job)."""
+    if not profiling_enabled():
+        return ApiResponse(success=False, message="Profiling disabled (PROFILING_ENABLED=1)")
+    profiler = SamplingProfiler(max(interval_ms, 1.0) / 1000.0)
+    if not profiler.start():
+        return ApiResponse(success=False, message="Another profile is running")
+    try:
+        await asyncio.sleep(min(max(seconds, 0.1), MAX_PROFILE_S))
+    finally:
+        profiler.stop()
+    entry = profiles.get(profiles.add(profiler, f"process {seconds:g}s"))
+    return ApiResponse(success=True, data={k: v for k, v in entry.items() if k != "collapsed"})
+
+
+@router.get("/api/metrics/profiles")
+def list_profiles() -> ApiResponse:
+    return ApiResponse(success=True, data=profiles.list())
+
+
+@router.get("/api/metrics/profiles/{profile_id}")
+def get_profile(profile_id: str):
+    entry = profiles.get(profile_id)
+    if entry is None:
+        return ApiResponse(success=False, message="Profile not found")
+    # collapsed stack: flamegraph.pl, speedscope, inferno
+    return PlainTextResponse(entry["collapsed"])
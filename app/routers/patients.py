@@ -0,0 +1,31 @@
+from typing import Optional
+
+from fastapi import APIRouter, Query
+
+from ..schemas import ApiResponse
+from ..services.store import store
+from ..services.trends import BUCKETS, parse_bound, patient_trends
+
+
+router = APIRouter()
+
+
+@router.get("/{patient_id}/trends")
+def get_patient_trends(
+    patient_id: str,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    bucket: str = Query("visit", pattern="^(" + "|".join(BUCKETS) + ")$"),
+    fields: Optional[str] = None,
+) -> ApiResponse:
+    """ROM, simmetria, qualità ed esiti degli esercizi nel tempo, dai riepiloghi salvati al finalize.
+
+    `since`/`until`: date o date-ora ISO (`until` con la sola data include il giorno);
+    `fields`: prefissi di colonna separati da virgola, es. `angles.left_knee,symmetry.knee`.
+    """
+    try:
+        start, end = parse_bound(since), parse_bound(until, end=True)
+    except ValueError:
+        return ApiResponse(success=False, message="Invalid date, expected ISO format (YYYY-MM-DD)")
+    data = patient_trends(store, patient_id, start, end, bucket, fields.split(",") if fields else None)
+    return ApiResponse(success=True, data=data)
@@ -1,74 +1,107 @@
-import json
+import gzip
 import os
-from datetime import datetime, timezone
-from typing import Any
 
-from fastapi import APIRouter
-from fastapi.responses import PlainTextResponse, FileResponse
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse, FileResponse, Response
 
 from ..schemas import ApiResponse
-from ..services.camera import camera
-from ..services.smpl import SmplFitter
+from ..services.camera_pool import pool
+from ..services.finalize import RESULTS_DIR, finalize_job, result_paths
+from ..services.jobs import Job, QueueFull, jobs
+from ..services.mesh import MESH_FORMATS, file_etag
+from ..services.store import store
 
 
-RESULTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "..", "data", "results")
 os.makedirs(RESULTS_DIR, exist_ok=True)
 
 router = APIRouter()
 
 
-def _result_paths(visit_id: str) -> dict:
-    base = os.path.abspath(os.path.join(RESULTS_DIR, visit_id))
-    return {
-        "params": base + ".json",
-        "mesh": base + ".obj",
-    }
+def notify_visit(job: Job) -> None:
+    # Evento di completamento sul WS della visita
+    if job.kind in ("finalize", "video") and job.visit_id:
+        pool.for_visit(job.visit_id).hub.publish_event(job.visit_id, {"type": "job", "event": job.status, "job": job.to_dict()})
 
 
 @router.post("/api/visits/{visit_id}/finalize")
 def finalize_visit(visit_id: str) -> ApiResponse:
-    # Usa l'ultimo frame disponibile e i keypoint correnti (o stub)
-    analysis = camera.analyze()
-    fitter = SmplFitter()
-    params, mesh_obj = fitter.fit(analysis.get("keypoints", {}))
-
-    paths = _result_paths(visit_id)
-    with open(paths["params"], "w", encoding="utf-8") as f:
-        json.dump(
-            {
-                "visit_id": visit_id,
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-                "smpl_available": fitter.available,
-                "smpl": params,
-                "metrics": {
-                    "angles": analysis.get("angles", {}),
-                    "symmetry": analysis.get("symmetry", {}),
-                },
-                "assets": {"mesh_url": f"/api/results/{visit_id}/mesh.obj"},
-            },
-            f,
-            ensure_ascii=False,
-            indent=2,
+    # Il fitting gira in background: si restituisce subito l'id del job.
+    # L'analisi live è lo snapshot di riserva se la visita non ha registrazione.
+    camera = pool.for_visit(visit_id)
+    camera.attach_shared()
+    try:
+        job, created = jobs.submit(
+            "finalize",
+            f"finalize:{visit_id}",
+            finalize_job,
+            visit_id,
+            camera.analyze(),
+            camera.recordings,
+            camera.session_metrics,
+            visit_id=visit_id,
         )
-    with open(paths["mesh"], "w", encoding="utf-8") as f:
-        f.write(mesh_obj)
-
-    return ApiResponse(success=True, data={"visit_id": visit_id})
+    except QueueFull as exc:
+        return ApiResponse(success=False, message=str(exc))
+    return ApiResponse(
+        success=True,
+        data={"visit_id": visit_id, "job_id": job.id, "status": job.status, "deduplicated": not created},
+    )
 
 
 @router.get("/api/results/{visit_id}")
 def get_results(visit_id: str) -> ApiResponse:
-    paths = _result_paths(visit_id)
-    if not os.path.exists(paths["params"]):
+    data = store.get_results(visit_id)
+    if data is None:
         return ApiResponse(success=False, message="Results not found")
-    with open(paths["params"], "r", encoding="utf-8") as f:
-        data: Any = json.load(f)
     return ApiResponse(success=True, data=data)
 
 
-@router.get("/api/results/{visit_id}/mesh.obj")
-def get_mesh_obj(visit_id: str):
-    paths = _result_paths(visit_id)
-    if not os.path.exists(paths["mesh"]):
+def _serve_mesh(request: Request, visit_id: str, ext: str) -> Response:
+    paths = result_paths(visit_id)
+    gz_path = paths[f"mesh_{ext}"]
+    media_type = MESH_FORMATS[ext][0]
+    tag = file_etag(gz_path)
+    if tag is None:
+        if ext == "obj" and os.path.exists(paths["mesh"]):
+            return FileResponse(paths["mesh"], media_type=media_type)
         return PlainTextResponse("mesh not found", status_code=404)
-    return FileResponse(paths["mesh"], media_type="text/plain")
+
+    # ETag forte distinto per variante compressa e non compressa
+    gzip_ok = "gzip" in request.headers.get("accept-encoding", "")
+    etag = f'"{tag}"' if gzip_ok else f'"{tag}-identity"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    inm = request.headers.get("if-none-match", "")
+    if etag in [t.strip() for t in inm.split(",")] or inm.strip() == "*":
+        return Response(status_code=304, headers=headers)
+
+    with open(gz_path, "rb") as f:
+        body = f.read()
+    if gzip_ok:
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body = gzip.decompress(body)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+@router.get("/api/results/{visit_id}/mesh.obj")
+def get_mesh_obj(visit_id: str, request: Request):
+    return _serve_mesh(request, visit_id, "obj")
+
+
+@router.get("/api/results/{visit_id}/mesh.glb")
+def get_mesh_glb(visit_id: str, request: Request):
+    return _serve_mesh(request, visit_id, "glb")
+
+
+@router.get("/api/results/{visit_id}/mesh.ply")
+def get_mesh_ply(visit_id: str, request: Request):
+    return _serve_mesh(request, visit_id, "ply")
+
+
+@router.get("/api/results/{visit_id}/smpl_fit.npz")
+def get_smpl_fit(visit_id: str):
+    # Pose, camere ed errore di riproiezione per frame del fitting della sessione
+    path = result_paths(visit_id)["smpl_fit"]
+    if not os.path.exists(path):
+        return PlainTextResponse("fit not found", status_code=404)
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{visit_id}.smpl_fit.npz")
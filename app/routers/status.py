@@ -1,8 +1,13 @@
 import os
+import time
+
 from fastapi import APIRouter
 
 from ..schemas import ApiResponse
-from ..services.camera import camera
+from ..services.camera_pool import pool
+from ..services.capabilities import capabilities
+from ..services.lbs import lbs_registry
+from ..services.smpl import model_registry
 
 
 router = APIRouter()
@@ -10,36 +15,23 @@ router = APIRouter()
 
 @router.get("/api/status")
 def backend_status() -> ApiResponse:
-    # Verifica disponibilità MediaPipe
-    try:
-        from ..services.pose import PoseEstimator  # type: ignore
-
-        pose_available = True
-        # Istanziazione facoltativa per ulteriore verifica
-        try:
-            _ = PoseEstimator()  # noqa: F841
-        except Exception:
-            pose_available = False
-    except Exception:
-        pose_available = False
-
-    # Verifica disponibilità SMPL
-    try:
-        from ..services.smpl import SmplFitter
-
-        smpl = SmplFitter()
-        smpl_available = bool(smpl.available)
-        smpl_model_dir = smpl.model_dir
-    except Exception:
-        smpl_available = False
-        smpl_model_dir = os.getenv("SMPL_MODEL_DIR")
+    # Tutto dalla cache dei probe: nessun import o istanziazione per richiesta
+    caps = capabilities.snapshot()
+    smpl = model_registry.status()
+    smpl["lbs"] = lbs_registry.status()
 
     data = {
         "version": "0.1.0",
-        "pose_available": pose_available,
-        "smpl_available": smpl_available,
-        "smpl_model_dir": smpl_model_dir,
-        "camera": camera.status(),
+        "pose_available": bool(caps["mediapipe"]["available"]),
+        "smpl_available": bool(caps["smpl"]["available"]),
+        "smpl_model_dir": caps["smpl"].get("model_dir") or smpl["model_dir"],
+        "smpl_backend": caps["smpl"].get("backend"),
+        "smpl_models": smpl,
+        "capabilities": caps,
+        "camera": pool.get().status(),
+        "cameras": pool.ids(),
+        # tempo CPU cumulato del worker: il load test ne ricava la CPU% per pid
+        "process": {"pid": os.getpid(), "cpu_s": round(time.process_time(), 4), "time": time.time()},
         "ws_endpoints": {
             "pose_stream": "/ws/pose-stream/{visit_id}",
         },
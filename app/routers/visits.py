@@ -1,25 +1,20 @@
-import json
 import os
 import uuid
 from datetime import datetime, timezone
-from typing import Any, List
+from typing import Any, List, Optional
 
-from fastapi import APIRouter, Body
+from fastapi import APIRouter, Body, Query, Request
 
 from ..schemas import ApiResponse, Visit
-
-
-DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "..", "data", "visits")
-os.makedirs(DATA_DIR, exist_ok=True)
+from ..services.camera_pool import pool
+from ..services.ingest import MULTIPART_OVERHEAD, UploadError, UploadTooLarge, ingest_video_job, save_upload
+from ..services.jobs import QueueFull, jobs
+from ..services.store import store
 
 
 router = APIRouter()
 
 
-def _visit_path(visit_id: str) -> str:
-    return os.path.abspath(os.path.join(DATA_DIR, f"{visit_id}.json"))
-
-
 @router.post("")
 def create_visit(payload: dict = Body(...)) -> ApiResponse:
     visit_id = str(uuid.uuid4())
@@ -34,41 +29,88 @@ def create_visit(payload: dict = Body(...)) -> ApiResponse:
         created_at=now,
         exercises=[],
     )
-    with open(_visit_path(visit_id), "w", encoding="utf-8") as f:
-        json.dump(visit.model_dump(), f, ensure_ascii=False, indent=2)
+    store.create_visit(visit.model_dump())
     return ApiResponse(success=True, data={"visit_id": visit_id})
 
 
+@router.get("")
+def list_visits(
+    patient_id: Optional[str] = None,
+    operator_id: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+) -> ApiResponse:
+    items, total = store.list_visits(patient_id, operator_id, status, limit, offset)
+    return ApiResponse(success=True, data={"items": items, "total": total, "limit": limit, "offset": offset})
+
+
 @router.get("/{visit_id}")
 def get_visit(visit_id: str) -> ApiResponse:
-    path = _visit_path(visit_id)
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    data = store.get_visit(visit_id)
+    if data is not None:
         return ApiResponse(success=True, data=data)
     return ApiResponse(success=False, message="Visit not found")
 
 
 @router.put("/{visit_id}/exercises")
 def update_exercises(visit_id: str, exercises: List[Any] = Body(...)) -> ApiResponse:
-    path = _visit_path(visit_id)
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    else:
-        data = {
-            "id": visit_id,
-            "patient_id": "",
-            "operator_id": "",
-            "tipo_analisi": "completa",
-            "status": "in_progress",
-            "note": "",
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "exercises": [],
-        }
-
-    data["exercises"] = exercises
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # Lettura-modifica-scrittura in un'unica transazione
+    store.update_exercises(visit_id, exercises)
+    # gli esercizi già iniziati nella sessione live mantengono i loro accumulatori
+    pool.for_visit(visit_id).session_metrics.set_exercises(visit_id, exercises)
     return ApiResponse(success=True)
 
+
+@router.get("/{visit_id}/metrics")
+def get_exercise_metrics(visit_id: str) -> ApiResponse:
+    """ROM, ripetizioni, tempo e simmetria per esercizio, aggiornati frame per frame."""
+    data = pool.for_visit(visit_id).session_metrics.summary(visit_id)
+    if data is not None:
+        return ApiResponse(success=True, data=data)
+    return ApiResponse(success=False, message="No live metrics for this visit")
+
+
+@router.post("/{visit_id}/video")
+async def upload_video(
+    visit_id: str,
+    request: Request,
+    filename: str = "video.mp4",
+    stride: int = Query(1, ge=1, le=30),
+) -> ApiResponse:
+    """Video registrato altrove (es. telefono) -> analisi offline della visita.
+
+    Accetta il file come corpo grezzo (`Content-Type: video/*`) o come campo
+    `file` di un form multipart; in entrambi i casi viene scritto su disco mentre
+    arriva, entro `VIDEO_MAX_MB`. L'estrazione della posa gira come job
+    (`GET /api/jobs/{job_id}`).
+    """
+    if store.get_visit(visit_id) is None:
+        return ApiResponse(success=False, message="Visit not found")
+    if pool.for_visit(visit_id).recordings.is_active(visit_id):
+        return ApiResponse(success=False, message="Visit is being recorded live")
+    max_bytes = int(os.getenv("VIDEO_MAX_MB", "2048")) * 1024 * 1024
+    too_large = ApiResponse(success=False, message=f"Video larger than {max_bytes // (1024 * 1024)} MB")
+    content_type = request.headers.get("content-type", "")
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > max_bytes + MULTIPART_OVERHEAD:
+        # rifiuto prima di leggere il corpo
+        return too_large
+    try:
+        path, size = await save_upload(request.stream(), content_type, visit_id, filename, max_bytes)
+    except UploadTooLarge:
+        return too_large
+    except UploadError as exc:
+        return ApiResponse(success=False, message=str(exc))
+    try:
+        job, created = jobs.submit("video", f"video:{visit_id}", ingest_video_job, visit_id, path, stride, visit_id=visit_id)
+    except QueueFull as exc:
+        os.remove(path)
+        return ApiResponse(success=False, message=str(exc))
+    if not created:
+        # un'altra elaborazione della stessa visita è in corso
+        os.remove(path)
+    return ApiResponse(
+        success=True,
+        data={"visit_id": visit_id, "job_id": job.id, "status": job.status, "bytes": size, "deduplicated": not created},
+    )
@@ -1,37 +1,383 @@
 import asyncio
-import base64
 import json
-from datetime import datetime, timezone
+import os
+import time
+from typing import Optional
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 
-from ..services.camera import camera
+from ..services.camera_pool import pool
+from ..services.flow import QUALITY_TIERS, FlowControl
+from ..services.metrics import metrics
+from ..services.pose import LANDMARK_NAMES
+from ..services.replay import ReplayClock, ReplayCursor, clamp_speed
+from ..services.store import store
 
 
 router = APIRouter()
 
+BINARY_SUBPROTOCOL = "physioplus.binary"
+
+
+class StreamOptions:
+    """Opzioni di una connessione: formato e frequenze video/keypoint.
+
+    In modalità binaria ogni tick con keypoint "dovuti" invia un messaggio di
+    testo compatto; se è dovuto anche il video, segue subito un frame binario
+    con i byte JPEG dello stesso `seq`. Il video non supera quindi mai la
+    frequenza dei keypoint.
+    """
+
+    def __init__(self, binary: bool, video_fps: Optional[float], kp_fps: Optional[float]) -> None:
+        self.binary = binary
+        self.video_fps = video_fps
+        self.kp_fps = kp_fps
+        self._next_kp = 0.0
+        self._next_video = 0.0
+
+    def update(self, msg: dict) -> None:
+        if "video_fps" in msg:
+            self.video_fps = _parse_fps(msg["video_fps"])
+        if "kp_fps" in msg:
+            self.kp_fps = _parse_fps(msg["kp_fps"])
+
+    def due(self, now: float) -> tuple:
+        send_kp = _is_due(now, self._next_kp, self.kp_fps)
+        if send_kp and self.kp_fps:
+            self._next_kp = _advance(self._next_kp, now, self.kp_fps)
+        send_video = send_kp and _is_due(now, self._next_video, self.video_fps)
+        if send_video and self.video_fps:
+            self._next_video = _advance(self._next_video, now, self.video_fps)
+        return send_kp, send_video
+
+
+def _is_due(now: float, next_at: float, fps: Optional[float]) -> bool:
+    # fps None = ogni tick; 0 = disabilitato
+    if fps is None:
+        return True
+    return fps > 0 and now >= next_at
+
+
+def _advance(next_at: float, now: float, fps: float) -> float:
+    # Mantiene la cadenza senza recuperare a raffica i tick persi
+    next_at += 1.0 / fps
+    return next_at if next_at > now else now + 1.0 / fps
+
+
+def _parse_fps(value) -> Optional[float]:
+    if value is None or value == "":
+        return None
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_tier(value) -> Optional[int]:
+    # ?quality=auto (default) oppure indice fisso in QUALITY_TIERS
+    try:
+        return min(max(int(value), 0), len(QUALITY_TIERS) - 1)
+    except (TypeError, ValueError):
+        return None
+
+
+async def _receive_loop(ws: WebSocket, opts: StreamOptions, flow: FlowControl, camera, visit_id: str) -> None:
+    # Consuma i messaggi del client finché non si disconnette: {"ack": seq}
+    # conferma un frame, {"exercise": indice | nome} cambia l'esercizio in corso;
+    # in modalità binaria accetta {"video_fps": .., "kp_fps": ..}
+    while True:
+        msg = await ws.receive()
+        if msg["type"] == "websocket.disconnect":
+            return
+        text = msg.get("text")
+        if not text:
+            continue
+        try:
+            data = json.loads(text)
+        except ValueError:
+            continue
+        if not isinstance(data, dict):
+            continue
+        if isinstance(data.get("ack"), int):
+            flow.on_ack(data["ack"])
+        if isinstance(data.get("exercise"), (int, str)):
+            camera.session_metrics.select(visit_id, data["exercise"])
+        if opts.binary:
+            opts.update(data)
+
+
+async def _timed_send(ws: WebSocket, flow: FlowControl, packet, data, video: bool) -> None:
+    # la durata del send include l'attesa sul buffer del socket: è il segnale di congestione
+    t0 = time.monotonic()
+    if isinstance(data, bytes):
+        await ws.send_bytes(data)
+    else:
+        await ws.send_text(data)
+    seconds = time.monotonic() - t0
+    flow.on_sent(packet.seq, len(data), seconds, video)
+    metrics.observe("send", seconds)
+    if packet.capture_ts is not None and not isinstance(data, bytes):
+        # cattura -> consegna dei keypoint al socket: il ritardo dello scheletro a schermo
+        metrics.observe("end_to_end", time.time() - packet.capture_ts)
+
+
+async def _send_packets(ws: WebSocket, sub, visit_id: str, opts: StreamOptions, flow: FlowControl) -> None:
+    while True:
+        packet = await sub.get()
+        if isinstance(packet, str):
+            # evento già serializzato (es. completamento finalize)
+            await ws.send_text(packet)
+            continue
+        now = time.monotonic()
+        age = time.time() - packet.capture_ts if packet.capture_ts is not None else None
+        if not opts.binary:
+            # frame e keypoint nello stesso messaggio: si adattano qualità e fps del video;
+            # se il video non è ammesso si inviano comunque i keypoint (`frame` null)
+            send_kp, _ = opts.due(now)
+            if flow.admit(now, age):
+                await _timed_send(ws, flow, packet, packet.message(visit_id, flow.tier), video=True)
+            elif send_kp:
+                await _timed_send(ws, flow, packet, packet.message(visit_id, None), video=False)
+            continue
+        # keypoint sempre inviati; il video solo se ammesso dal controllo di flusso
+        send_kp, send_video = opts.due(now)
+        if send_kp:
+            await _timed_send(ws, flow, packet, packet.analysis_message(visit_id), video=False)
+        if send_video and packet.frame is not None and flow.admit(now, age):
+            await _timed_send(ws, flow, packet, packet.jpeg_for(flow.tier), video=True)
+
 
 @router.websocket("/ws/pose-stream/{visit_id}")
 async def pose_stream(ws: WebSocket, visit_id: str):
-    await ws.accept()
+    # Modalità binaria opt-in: ?mode=binary oppure subprotocol "physioplus.binary"
+    params = ws.query_params
+    requested = ws.scope.get("subprotocols") or []
+    via_subprotocol = BINARY_SUBPROTOCOL in requested
+    opts = StreamOptions(
+        binary=via_subprotocol or params.get("mode") == "binary",
+        video_fps=_parse_fps(params.get("video_fps")),
+        kp_fps=_parse_fps(params.get("kp_fps")),
+    )
+    flow = FlowControl(
+        max_fps=_parse_fps(params.get("max_fps")) or None,
+        min_fps=_parse_fps(params.get("min_fps")) or None,
+        tier=_parse_tier(params.get("quality")),
+    )
+    # ?camera_id= lega la visita a una camera del pool, altrimenti vale il binding esistente
+    camera_id = params.get("camera_id")
+    if camera_id:
+        try:
+            pool.bind(visit_id, camera_id)
+        except KeyError:
+            await ws.close(code=1008)
+            return
+    camera = pool.for_visit(visit_id)
+    camera.attach_shared()
+    await ws.accept(subprotocol=BINARY_SUBPROTOCOL if via_subprotocol else None)
+    if opts.binary:
+        await ws.send_text(
+            json.dumps(
+                {
+                    "type": "hello",
+                    "mode": "binary",
+                    "visit_id": visit_id,
+                    "camera_id": camera.camera_id,
+                    "landmarks": LANDMARK_NAMES,
+                    "video_fps": opts.video_fps,
+                    "kp_fps": opts.kp_fps,
+                    "max_fps": flow.max_fps,
+                    "quality_tiers": [{"scale": sc, "jpeg_quality": q} for sc, q in QUALITY_TIERS],
+                }
+            )
+        )
+
+    # Ogni analisi della visita viene registrata finché c'è almeno un client
+    camera.recordings.start(visit_id)
+    sub = camera.hub.subscribe(visit_id)
+    # ... e alimenta le metriche degli esercizi, spinte come eventi {"type": "metrics"}
+    visit = store.get_visit(visit_id)
+    camera.session_metrics.start(visit_id, visit["exercises"] if visit is not None else None)
+    sub.flow = flow
+    sub.mode = "binary" if opts.binary else "json"
+    tasks = [
+        asyncio.ensure_future(_send_packets(ws, sub, visit_id, opts, flow)),
+        asyncio.ensure_future(_receive_loop(ws, opts, flow, camera, visit_id)),
+    ]
     try:
-        while True:
-            frame = camera.get_frame()
-            if frame is None:
-                # Send a tiny 1x1 transparent pixel if no frame
-                img_b64 = base64.b64encode(b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\x0cIDATx\x9cc``\x00\x00\x00\x02\x00\x01\xe2!\xbc3\x00\x00\x00\x00IEND\xaeB`\x82").decode("ascii")
-            else:
-                img_b64 = camera.frame_to_base64(frame)
-
-            analysis = camera.analyze()
-            payload = {
-                "frame": f"data:image/jpeg;base64,{img_b64}",
-                "analysis": analysis,
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-                "visit_id": visit_id,
-            }
-            await ws.send_text(json.dumps(payload))
-            await asyncio.sleep(0.1)
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
     except WebSocketDisconnect:
         # Client disconnected gracefully
         return
+    finally:
+        for t in tasks:
+            t.cancel()
+        camera.hub.unsubscribe(sub)
+        camera.session_metrics.stop(visit_id)
+        if camera.hub.visit_clients(visit_id) == 0:
+            camera.recordings.stop(visit_id)
+
+
+# ------------------------------------------------------------------ replay
+def _number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _replay_state(cursor: ReplayCursor, clock: ReplayClock, now: float, event: str = "state") -> str:
+    position = clock.position(now)
+    return json.dumps(
+        {
+            "type": "replay",
+            "event": event,
+            "visit_id": cursor.visit_id,
+            "position_s": round(position, 3),
+            "frame": cursor.index_at(position),
+            "frames": cursor.frames,
+            "duration_s": round(cursor.duration, 3),
+            "paused": clock.paused,
+            "speed": clock.speed,
+            "ended": clock.ended(now),
+        }
+    )
+
+
+def _apply_replay_control(data: dict, cursor: ReplayCursor, clock: ReplayClock, now: float) -> bool:
+    # {"speed": x}, {"seek": s}, {"seek_frame": i}, {"scrub": s} (seek in pausa), {"pause": bool}, {"play": true}
+    changed = False
+    if _number(data.get("speed")) and data["speed"] > 0:
+        clock.set_speed(data["speed"], now)
+        changed = True
+    if _number(data.get("scrub")):
+        clock.pause(now)
+        clock.seek(data["scrub"], now)
+        changed = True
+    if _number(data.get("seek")):
+        clock.seek(data["seek"], now)
+        changed = True
+    if isinstance(data.get("seek_frame"), int) and not isinstance(data["seek_frame"], bool):
+        clock.seek(cursor.position_of(data["seek_frame"]), now)
+        changed = True
+    if "pause" in data:
+        if data["pause"]:
+            clock.pause(now)
+        else:
+            clock.play(now)
+        changed = True
+    if data.get("play") is True:
+        clock.play(now)
+        changed = True
+    return changed
+
+
+async def _replay_receive(ws: WebSocket, cursor: ReplayCursor, clock: ReplayClock, wake: asyncio.Event) -> None:
+    while True:
+        msg = await ws.receive()
+        if msg["type"] == "websocket.disconnect":
+            return
+        try:
+            data = json.loads(msg.get("text") or "null")
+        except ValueError:
+            continue
+        if isinstance(data, dict) and _apply_replay_control(data, cursor, clock, time.monotonic()):
+            wake.set()
+
+
+async def _wait_or_wake(wake: asyncio.Event, delay: float) -> None:
+    try:
+        await asyncio.wait_for(wake.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _replay_send(
+    ws: WebSocket, cursor: ReplayCursor, clock: ReplayClock, wake: asyncio.Event, binary: bool, max_fps: float
+) -> None:
+    # Il frame inviato è quello della posizione corrente dell'orologio: un
+    # client lento o una velocità alta saltano frame invece di accumulare ritardo
+    visit_id = cursor.visit_id
+    last_index = None
+    last_keyframe = None
+    state_at = 0.0
+    min_gap = 1.0 / max_fps if max_fps > 0 else 0.0
+    while True:
+        now = time.monotonic()
+        if wake.is_set():
+            wake.clear()
+            await ws.send_text(_replay_state(cursor, clock, now))
+        index = cursor.index_at(clock.position(now))
+        if index != last_index:
+            packet, keyframe = cursor.packet(index)
+            if binary:
+                await ws.send_text(packet.analysis_message(visit_id))
+                if keyframe is not None and keyframe != last_keyframe:
+                    await ws.send_bytes(packet.jpeg)
+                    last_keyframe = keyframe
+            else:
+                await ws.send_text(packet.message(visit_id))
+            last_index = index
+        now = time.monotonic()
+        if not clock.paused and clock.ended(now):
+            clock.pause(now)
+            await ws.send_text(_replay_state(cursor, clock, now, "ended"))
+        if clock.paused:
+            await wake.wait()
+            continue
+        if now >= state_at:
+            # posizione per la timeline del client, una volta al secondo
+            await ws.send_text(_replay_state(cursor, clock, now))
+            state_at = now + 1.0
+        position = clock.position(now)
+        next_at = cursor.position_of(index + 1) if index + 1 < cursor.frames else cursor.duration
+        await _wait_or_wake(wake, max((next_at - position) / clock.speed, min_gap))
+
+
+@router.websocket("/ws/replay/{visit_id}")
+async def replay_stream(ws: WebSocket, visit_id: str):
+    """Replay della registrazione di una visita con gli stessi messaggi dello stream live.
+
+    Query: `speed` (0.1-16), `start` (secondi), `paused=1`, `max_fps`,
+    `mode=binary`. Il client controlla la riproduzione con `{"seek": s}`,
+    `{"seek_frame": i}`, `{"scrub": s}`, `{"pause": bool}`, `{"play": true}` e
+    `{"speed": x}`; lo stato torna come `{"type": "replay", ...}`.
+    """
+    params = ws.query_params
+    loaded = pool.for_visit(visit_id).recordings.load(visit_id)
+    if loaded is None or not len(loaded[1]):
+        await ws.close(code=1008)
+        return
+    meta, rec = loaded
+    cursor = ReplayCursor(visit_id, meta, rec)
+    via_subprotocol = BINARY_SUBPROTOCOL in (ws.scope.get("subprotocols") or [])
+    binary = via_subprotocol or params.get("mode") == "binary"
+    try:
+        speed = clamp_speed(params.get("speed") or 1.0)
+    except ValueError:
+        speed = 1.0
+    clock = ReplayClock(cursor.duration, speed, _parse_fps(params.get("start")) or 0.0, paused=params.get("paused") == "1")
+    max_fps = _parse_fps(params.get("max_fps")) or float(os.getenv("WS_MAX_FPS", "30"))
+
+    await ws.accept(subprotocol=BINARY_SUBPROTOCOL if via_subprotocol else None)
+    clock.start(time.monotonic())
+    await ws.send_text(
+        json.dumps(
+            dict(
+                {"type": "replay", "event": "hello", "visit_id": visit_id, "mode": "binary" if binary else "json"},
+                **cursor.info(),
+                speed=clock.speed,
+                paused=clock.paused,
+                max_fps=max_fps,
+                landmarks=LANDMARK_NAMES,
+            )
+        )
+    )
+    wake = asyncio.Event()
+    tasks = [
+        asyncio.ensure_future(_replay_send(ws, cursor, clock, wake, binary, max_fps)),
+        asyncio.ensure_future(_replay_receive(ws, cursor, clock, wake)),
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    except WebSocketDisconnect:
+        return
+    finally:
+        for t in tasks:
+            t.cancel()
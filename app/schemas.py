@@ -24,7 +24,7 @@ class PostureAnalysis(BaseModel):
 
 
 class StreamData(BaseModel):
-    frame: str  # base64 PNG/JPEG
+    frame: Optional[str]  # base64 PNG/JPEG; null se il video è stato ridotto dal controllo di flusso
     analysis: PostureAnalysis
     timestamp: str
     visit_id: str
@@ -40,3 +40,13 @@ class Visit(BaseModel):
     created_at: str
     exercises: List[dict] = []
 
+
+class CameraDevice(BaseModel):
+    camera_id: str
+    source: str = "0"  # indice del device o URL (rtsp/http/file)
+    isolated: bool = True
+
+
+class CameraBinding(BaseModel):
+    visit_id: str
+    camera_id: str
@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Union
+
+import numpy as np
+
+from .flow import QUALITY_TIERS
+from .metrics import metrics
+from .pose import analysis_for_api, as_keypoint_array
+
+
+# PNG 1x1 trasparente inviato quando la camera non ha ancora prodotto frame
+PLACEHOLDER_B64 = base64.b64encode(
+    b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89"
+    b"\x00\x00\x00\x0cIDATx\x9cc``\x00\x00\x00\x02\x00\x01\xe2!\xbc3\x00\x00\x00\x00IEND\xaeB`\x82"
+).decode("ascii")
+
+
+HEARTBEAT_S = 1.0
+
+
+class FramePacket:
+    """Frame + analisi di un tick, codificati e serializzati una sola volta.
+
+    JPEG (uno per livello di qualità), corpo JSON comune e messaggio compatto
+    vengono costruiti al primo accesso e riutilizzati da tutti i client; per
+    ogni visita si aggiunge solo il campo `visit_id`, così N client della
+    stessa visita e dello stesso livello ricevono la stessa stringa.
+    """
+
+    __slots__ = (
+        "frame",
+        "seq",
+        "analysis",
+        "capture_ts",
+        "timestamp",
+        "_encode_fn",
+        "_jpegs",
+        "_bodies",
+        "_messages",
+        "_compact",
+    )
+
+    def __init__(
+        self,
+        frame: Optional[np.ndarray],
+        seq: int,
+        analysis: dict,
+        encode_fn: Optional[Callable[..., bytes]],
+        capture_ts: Optional[float] = None,
+        jpeg: Optional[bytes] = None,
+    ) -> None:
+        self.frame = frame
+        self.seq = seq
+        self.analysis = analysis
+        # None per i pacchetti di heartbeat (mai considerati vecchi)
+        self.capture_ts = capture_ts
+        self.timestamp = datetime.now(timezone.utc).isoformat()
+        self._encode_fn = encode_fn
+        # JPEG già codificato (replay dai keyframe): vale per il livello 0
+        self._jpegs: Dict[int, bytes] = {0: jpeg} if jpeg else {}
+        self._bodies: Dict[Optional[int], str] = {}
+        self._messages: Dict[tuple, str] = {}
+        self._compact: Dict[str, str] = {}
+
+    @property
+    def jpeg(self) -> Optional[bytes]:
+        return self.jpeg_for(0)
+
+    def jpeg_for(self, tier: int) -> Optional[bytes]:
+        jpeg = self._jpegs.get(tier)
+        if jpeg is None:
+            if self.frame is None:
+                return self._jpegs.get(0)
+            scale, quality = QUALITY_TIERS[tier]
+            jpeg = self._jpegs[tier] = self._encode_fn(self.frame, quality=quality, scale=scale)
+        return jpeg
+
+    def _common_body(self, tier: Optional[int]) -> str:
+        body = self._bodies.get(tier)
+        if body is None:
+            jpeg = self.jpeg_for(tier) if tier is not None else None
+            t0 = time.perf_counter()
+            frame = None
+            if tier is not None:
+                img_b64 = base64.b64encode(jpeg).decode("ascii") if jpeg else PLACEHOLDER_B64
+                frame = f"data:image/jpeg;base64,{img_b64}"
+            body = json.dumps(
+                {
+                    "frame": frame,
+                    "analysis": analysis_for_api(self.analysis),
+                    "timestamp": self.timestamp,
+                }
+            )
+            # rimuove la graffa finale per poter accodare visit_id
+            body = self._bodies[tier] = body[:-1]
+            metrics.observe("serialize", time.perf_counter() - t0)
+        return body
+
+    def message(self, visit_id: str, tier: Optional[int] = 0) -> str:
+        """`StreamData` della visita; con `tier=None` solo l'analisi (`frame` null, video non ammesso)."""
+        msg = self._messages.get((visit_id, tier))
+        if msg is None:
+            msg = f"{self._common_body(tier)}, \"visit_id\": {json.dumps(visit_id)}}}"
+            self._messages[(visit_id, tier)] = msg
+        return msg
+
+    def analysis_message(self, visit_id: str) -> str:
+        """Messaggio compatto per la modalità binaria (keypoint come righe x,y,z,v)."""
+        msg = self._compact.get(visit_id)
+        if msg is None:
+            t0 = time.perf_counter()
+            a = self.analysis
+            msg = json.dumps(
+                {
+                    "type": "analysis",
+                    "seq": self.seq,
+                    "visit_id": visit_id,
+                    "timestamp": a.get("timestamp", self.timestamp),
+                    "keypoints": compact_keypoints(a.get("keypoints", {})),
+                    "angles": a.get("angles", {}),
+                    "symmetry": a.get("symmetry", {}),
+                    "frame_quality": a.get("frame_quality", 0.0),
+                },
+                separators=(",", ":"),
+            )
+            self._compact[visit_id] = msg
+            metrics.observe("serialize", time.perf_counter() - t0)
+        return msg
+
+
+def compact_keypoints(kps) -> List[Optional[List[float]]]:
+    # Ordine di LANDMARK_NAMES; null per i landmark non rilevati
+    arr = np.round(as_keypoint_array(kps).astype(np.float64), 4)
+    return [row if row[0] == row[0] else None for row in arr.tolist()]
+
+
+class Subscription:
+    """Canale di un client: ultimo pacchetto (sovrascritto) + eventi (mai persi).
+
+    Un client lento riceve sempre l'ultimo frame, mai una coda; gli eventi
+    (es. completamento job) vengono consegnati tutti e prima dei frame.
+    """
+
+    def __init__(self, visit_id: str) -> None:
+        self.visit_id = visit_id
+        self.flow: Optional[Any] = None  # FlowControl della connessione
+        self.mode = "json"
+        self._packet: Optional[FramePacket] = None
+        self._events: Deque[str] = deque()
+        self._ready = asyncio.Event()
+
+    def offer(self, packet: FramePacket) -> None:
+        self._packet = packet
+        self._ready.set()
+
+    def offer_event(self, message: str) -> None:
+        self._events.append(message)
+        self._ready.set()
+
+    async def get(self) -> Union[FramePacket, str]:
+        while True:
+            if self._events:
+                return self._events.popleft()
+            if self._packet is not None:
+                packet, self._packet = self._packet, None
+                return packet
+            self._ready.clear()
+            await self._ready.wait()
+
+
+class FrameHub:
+    """Produce un pacchetto per tick e lo distribuisce a tutti i subscriber.
+
+    Il task produttore gira solo finché c'è almeno un client connesso.
+    """
+
+    def __init__(self, camera: Any) -> None:
+        self._camera = camera
+        self._subs: Set[Subscription] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # frame scartati dai client già disconnessi: i contatori esportati non calano mai
+        self._drops_lock = threading.Lock()
+        self._retired_drops = {"ws_stale": 0, "ws_backlog": 0}
+
+    @property
+    def client_count(self) -> int:
+        return len(self._subs)
+
+    def client_stats(self) -> List[dict]:
+        return [
+            {"visit_id": s.visit_id, "mode": s.mode, **(s.flow.stats() if s.flow is not None else {})}
+            for s in list(self._subs)
+        ]
+
+    def dropped_totals(self) -> Dict[str, int]:
+        """Frame scartati dal controllo di flusso, cumulativi per camera (client connessi e passati)."""
+        with self._drops_lock:
+            totals = dict(self._retired_drops)
+            for s in list(self._subs):
+                if s.flow is not None:
+                    totals["ws_stale"] += s.flow.dropped_stale
+                    totals["ws_backlog"] += s.flow.dropped_backlog
+        return totals
+
+    def visit_clients(self, visit_id: str) -> int:
+        return sum(1 for s in self._subs if s.visit_id == visit_id)
+
+    def subscribe(self, visit_id: str) -> Subscription:
+        sub = Subscription(visit_id)
+        self._subs.add(sub)
+        self._loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._task = self._loop.create_task(self._produce())
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._drops_lock:
+            if sub in self._subs and sub.flow is not None:
+                self._retired_drops["ws_stale"] += sub.flow.dropped_stale
+                self._retired_drops["ws_backlog"] += sub.flow.dropped_backlog
+            self._subs.discard(sub)
+        if not self._subs and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def publish_event(self, visit_id: str, event: dict) -> None:
+        """Invia un evento JSON ai client della visita; chiamabile da qualsiasi thread."""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        message = json.dumps(event)
+        loop.call_soon_threadsafe(self._dispatch_event, visit_id, message)
+
+    def _dispatch_event(self, visit_id: str, message: str) -> None:
+        for sub in list(self._subs):
+            if sub.visit_id == visit_id:
+                sub.offer_event(message)
+
+    async def _produce(self) -> None:
+        cam = self._camera
+        ring = cam.ring
+        last_seq = ring.seq
+        while self._subs:
+            # Un pacchetto per ogni nuovo frame catturato; a camera ferma un
+            # heartbeat al secondo (ultimo frame o placeholder)
+            try:
+                seq, capture_ts, frame = await asyncio.wait_for(ring.wait_next_async(last_seq), HEARTBEAT_S)
+                last_seq = seq
+            except asyncio.TimeoutError:
+                # worker senza cattura: aggancio al produttore condiviso appena parte
+                cam.attach_shared()
+                seq, frame = ring.seq, cam.get_frame()
+                capture_ts = None
+                # nuovo produttore: la sequenza può ripartire più in basso
+                last_seq = min(last_seq, seq)
+            packet = FramePacket(frame, seq, cam.analyze(), cam.encode_jpeg, capture_ts)
+            if capture_ts is not None:
+                # keyframe per il replay: riusa il JPEG condiviso con i client
+                cam.recordings.feed_keyframe(seq, capture_ts, lambda: packet.jpeg)
+            for sub in list(self._subs):
+                sub.offer(packet)
@@ -1,55 +1,125 @@
 import base64
+import multiprocessing
+import os
 import threading
+import time
 from datetime import datetime, timezone
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 
 import numpy as np
 
-try:
-    import cv2  # type: ignore
-except Exception:  # pragma: no cover
-    cv2 = None  # OpenCV opzionale
+from .broadcast import FrameHub
+from .capabilities import capabilities, optional_import
+from .framebuffer import FrameRing, Pacer
+from .inference import PoseWorker
+from .metrics import metrics
+from .pose import PoseEstimator, keypoints_from_dict
+from .recording import RecordingManager
+from .session_metrics import SessionMetricsManager
+from .shm_ring import SharedFrameRing
+from .sources import open_source
 
-try:
-    from .pose import PoseEstimator  # type: ignore
-except Exception:
-    PoseEstimator = None  # opzionale se mediapipe non disponibile
+
+def _cv2():
+    # OpenCV opzionale, importato al primo uso
+    return optional_import("cv2")
+
+
+def parse_source(value: Union[int, str, None]) -> Union[int, str]:
+    """Sorgente OpenCV: indice del device ("0", "1", ...) oppure URL/percorso."""
+    if value is None or value == "":
+        return 0
+    if isinstance(value, int):
+        return value
+    value = value.strip()
+    return int(value) if value.isdigit() else value
 
 
 class CameraManager:
-    def __init__(self) -> None:
+    """Cattura + inferenza di un singolo dispositivo.
+
+    In modalità `isolated` cattura e MediaPipe girano in un processo dedicato
+    (`device_process.run_device`) e qui arrivano, via pipe, frame già nel ring
+    e analisi già calcolate: più camere scalano sui core senza condividere il GIL.
+    """
+
+    def __init__(
+        self,
+        camera_id: str = "default",
+        source: Union[int, str, None] = 0,
+        isolated: bool = False,
+        width: int = 640,
+        height: int = 480,
+        fps: Optional[int] = None,
+        shm_name: Optional[str] = None,
+    ) -> None:
+        self.camera_id = camera_id
+        self.source = parse_source(source)
+        self.isolated = isolated
         self._streaming = False
         self._cap = None
         self._lock = threading.Lock()
         self._thread: Optional[threading.Thread] = None
-        self.width = 640
-        self.height = 480
-        self.fps = 10
-        self._last_frame: Optional[np.ndarray] = None
-        self._pose = PoseEstimator() if PoseEstimator is not None else None
+        self.width = width
+        self.height = height
+        self.fps = fps or int(os.getenv("CAMERA_FPS", "10"))
+        # Stato del processo dedicato (solo modalità isolated)
+        self._proc = None
+        self._stop_event = None
+        self._remote_latest: Optional[dict] = None
+        self._device_stats: dict = {}
+        self._transport_ms = 0.0
+        # Ring di frame preallocati: la cattura scrive negli slot, i consumatori
+        # attendono il seq successivo senza polling né copie
+        slots = int(os.getenv("CAMERA_RING_SLOTS", "8"))
+        if shm_name:
+            # Ring in memoria condivisa: un solo produttore tra i worker uvicorn
+            slot_bytes = int(os.getenv("CAMERA_SHM_SLOT_BYTES", "0")) or max(width * height * 3, 1280 * 720 * 3)
+            self.ring: FrameRing = SharedFrameRing(shm_name, slots, (self.height, self.width, 3), slot_bytes)
+        else:
+            self.ring = FrameRing(slots, (self.height, self.width, 3))
+        # Registrazione per visita di ogni analisi prodotta dal worker
+        self.recordings = RecordingManager(self.width, self.height)
+        # Inferenza in un thread dedicato: analyze() legge solo l'ultimo risultato
+        # (MediaPipe viene caricato dal worker solo all'avvio della camera)
+        self._worker = PoseWorker(PoseEstimator, self.ring, on_result=self._on_analysis)
+        # Fan-out condiviso: un encode e un'analisi per tick, per tutti i client
+        self.hub = FrameHub(self)
+        # Metriche per esercizio (ROM, ripetizioni, simmetria) aggiornate frame per frame
+        self.session_metrics = SessionMetricsManager(on_update=self.hub.publish_event)
 
     def start(self) -> Tuple[bool, str]:
         with self._lock:
             if self._streaming:
                 return True, "Camera already running"
-            if cv2 is None:
-                # Modalità stub: nessuna webcam disponibile
-                self._streaming = True
-                self._thread = threading.Thread(target=self._loop_stub, daemon=True)
-                self._thread.start()
-                return True, "Camera started in stub mode"
-
-            cap = cv2.VideoCapture(0)
-            if not cap.isOpened():
+            if self.shared:
+                try:
+                    role = self.ring.bind()
+                except RuntimeError as exc:
+                    return False, str(exc)
+                if role == "consumer":
+                    # un altro worker cattura già: si leggono frame e analisi dal segmento
+                    self._remote_latest = None
+                    self._streaming = True
+                    self._thread = threading.Thread(target=self._loop_attached, daemon=True)
+                    self._thread.start()
+                    return True, "Camera attached to shared producer"
+                self.ring.clear_stop()
+            if self.isolated:
+                return self._start_process()
+            self._worker.start()
+            # webcam, stream, file video, sequenza di immagini o frame sintetici
+            source = open_source(self.source, self.width, self.height, self.fps)
+            if source is None:
+                # Modalità stub: sorgente non disponibile (o OpenCV assente)
                 self._streaming = True
                 self._thread = threading.Thread(target=self._loop_stub, daemon=True)
                 self._thread.start()
+                if _cv2() is None:
+                    return True, "Camera started in stub mode"
                 return True, "Camera fallback to stub (no device)"
 
-            cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
-            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
-            cap.set(cv2.CAP_PROP_FPS, self.fps)
-            self._cap = cap
+            self._cap = source
             self._streaming = True
             self._thread = threading.Thread(target=self._loop_capture, daemon=True)
             self._thread.start()
@@ -60,7 +130,17 @@ class CameraManager:
             if not self._streaming:
                 return True, "Camera already stopped"
             self._streaming = False
-            if self._cap is not None and cv2 is not None:
+            if self.shared and self.ring.role == "consumer":
+                # il produttore (altro worker) si ferma al prossimo frame
+                self.ring.request_stop()
+                return True, "Camera stop requested"
+            self._worker.stop()
+            if self._proc is not None:
+                self._stop_process()
+            if self.shared:
+                self.ring.request_stop()
+                self.ring.release()
+            if self._cap is not None:
                 try:
                     self._cap.release()
                 except Exception:
@@ -68,52 +148,163 @@ class CameraManager:
                 self._cap = None
             return True, "Camera stopped"
 
+    def attach_shared(self) -> bool:
+        """Worker che non ha avviato la camera: si aggancia al produttore condiviso, se attivo."""
+        with self._lock:
+            if not self.shared or self._streaming:
+                return self._streaming
+            if not self.ring.reattach():
+                return False
+            self._remote_latest = None
+            self._streaming = True
+            self._thread = threading.Thread(target=self._loop_attached, daemon=True)
+            self._thread.start()
+            return True
+
+    def _start_process(self) -> Tuple[bool, str]:
+        # spawn: il figlio non eredita thread, socket né lo stato di uvicorn
+        from .device_process import run_device
+
+        if self._proc is not None:
+            self._stop_process()  # processo precedente terminato da solo
+        ctx = multiprocessing.get_context("spawn")
+        recv_conn, send_conn = ctx.Pipe(duplex=False)
+        self._stop_event = ctx.Event()
+        self._proc = ctx.Process(
+            target=run_device,
+            args=(send_conn, self._stop_event, self.camera_id, self.source, self.width, self.height, self.fps),
+            name=f"camera-{self.camera_id}",
+            daemon=True,
+        )
+        self._proc.start()
+        send_conn.close()
+        self._remote_latest = None
+        self._device_stats = {}
+        self._streaming = True
+        self._thread = threading.Thread(target=self._loop_remote, args=(recv_conn,), daemon=True)
+        self._thread.start()
+        return True, "Camera process started"
+
+    def _stop_process(self) -> None:
+        proc, self._proc = self._proc, None
+        self._stop_event.set()
+        proc.join(timeout=3.0)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join(timeout=1.0)
+
+    @property
+    def shared(self) -> bool:
+        return isinstance(self.ring, SharedFrameRing)
+
+    def _on_analysis(self, result: dict) -> None:
+        self.recordings.feed(result)
+        self.session_metrics.feed(result)
+        if self.shared:
+            self.ring.publish_analysis(result)
+
+    def _shared_stop_requested(self) -> bool:
+        # stop chiesto da un worker consumatore
+        if self.shared and self.ring.stop_requested:
+            self.stop()
+            return True
+        return False
+
     def status(self) -> dict:
+        proc = self._proc
+        consumer = self.shared and self.ring.role == "consumer"
+        if consumer:
+            inference = {}
+            latency = self._transport_ms
+            cpu = None
+        elif self.isolated:
+            inference = self._device_stats.get("inference", {})
+            latency = inference.get("latency_ms", 0.0) + self._transport_ms
+            cpu = self._device_stats.get("cpu_percent")
+        else:
+            inference = self._worker.stats()
+            latency = inference["latency_ms"]
+            cpu = None  # condivide il processo dell'API
         return {
-            "streaming": self._streaming,
+            "camera_id": self.camera_id,
+            "source": str(self.source),
+            "mode": "shared" if consumer else ("process" if self.isolated else "thread"),
+            "shm": {"name": self.ring.name, "role": self.ring.role} if self.shared else None,
+            "pid": proc.pid if proc is not None else None,
+            "streaming": self._streaming and (not consumer or self.ring.producer_alive()),
             "width": self.width,
             "height": self.height,
             "fps": self.fps,
-            "backend": "opencv" if cv2 is not None else "stub",
+            "measured_fps": round(self.ring.measured_fps, 2),
+            "latency_ms": round(latency, 2),
+            "cpu_percent": cpu,
+            "backend": self._backend(),
+            "inference": inference,
+            "recordings": self.recordings.status(),
+            "clients": self.hub.client_stats(),
+            "ws_dropped": self.hub.dropped_totals(),
         }
 
+    def _backend(self) -> str:
+        cap = self._cap
+        if cap is not None:
+            return cap.kind
+        # dal probe in cache: lo status non importa OpenCV
+        return "opencv" if capabilities.available("opencv") else "stub"
+
+    @property
+    def seq(self) -> int:
+        return self.ring.seq
+
     def get_frame(self) -> Optional[np.ndarray]:
-        return self._last_frame
+        ref = self.ring.latest()
+        return ref[2] if ref is not None else None
 
-    def frame_to_base64(self, frame: np.ndarray) -> str:
+    def encode_jpeg(self, frame: np.ndarray, quality: Optional[int] = None, scale: float = 1.0) -> bytes:
+        t0 = time.perf_counter()
+        jpeg = self._encode_jpeg(frame, quality, scale)
+        metrics.observe("encode", time.perf_counter() - t0)
+        return jpeg
+
+    def _encode_jpeg(self, frame: np.ndarray, quality: Optional[int], scale: float) -> bytes:
+        cv2 = _cv2()
         if cv2 is not None:
-            ok, buf = cv2.imencode(".jpg", frame)
+            if scale < 1.0:
+                size = (max(1, int(frame.shape[1] * scale)), max(1, int(frame.shape[0] * scale)))
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)] if quality else []
+            ok, buf = cv2.imencode(".jpg", frame, params)
             if ok:
-                return base64.b64encode(buf.tobytes()).decode("ascii")
+                return buf.tobytes()
         # fallback png via numpy if cv2 missing (very simple solid image)
         try:
             import PIL.Image as Image  # type: ignore
             from io import BytesIO
 
+            if scale < 1.0:
+                step = max(1, int(round(1.0 / scale)))
+                frame = frame[::step, ::step]
             im = Image.fromarray(frame[..., ::-1])  # BGR->RGB
             bio = BytesIO()
-            im.save(bio, format="JPEG", quality=80)
-            return base64.b64encode(bio.getvalue()).decode("ascii")
+            im.save(bio, format="JPEG", quality=quality or 80)
+            return bio.getvalue()
         except Exception:
-            return ""
+            return b""
+
+    def frame_to_base64(self, frame: np.ndarray) -> str:
+        return base64.b64encode(self.encode_jpeg(frame)).decode("ascii")
+
+    def latest_analysis(self) -> Optional[dict]:
+        if self.isolated or (self.shared and self.ring.role == "consumer"):
+            return self._remote_latest
+        return self._worker.latest()
 
     def analyze(self) -> dict:
-        # Se disponibile MediaPipe, usa l'estimatore reale
-        if self._pose is not None and self._last_frame is not None:
-            try:
-                kps, quality = self._pose.process(self._last_frame)
-                ts = datetime.now(timezone.utc).isoformat()
-                angles = self._pose.derive_angles(kps)
-                symmetry = self._pose.derive_symmetry(kps)
-                return {
-                    "keypoints": kps,
-                    "angles": angles,
-                    "symmetry": symmetry,
-                    "timestamp": ts,
-                    "frame_quality": quality,
-                }
-            except Exception:
-                pass
+        # Ultimo risultato del worker MediaPipe (non bloccante)
+        if self._streaming:
+            latest = self.latest_analysis()
+            if latest is not None:
+                return latest
         # Fallback fittizio se non disponibile
         ts = datetime.now(timezone.utc).isoformat()
         kp = {
@@ -122,7 +313,7 @@ class CameraManager:
             "right_shoulder": {"x": 0.6, "y": 0.35, "z": 0.0, "visibility": 0.9},
         }
         return {
-            "keypoints": kp,
+            "keypoints": keypoints_from_dict(kp),
             "angles": {"shoulder_tilt": (kp["right_shoulder"]["y"] - kp["left_shoulder"]["y"]) * 10},
             "symmetry": {"shoulders": 1.0},
             "timestamp": ts,
@@ -131,36 +322,114 @@ class CameraManager:
 
     # Internal loops
     def _loop_capture(self) -> None:
-        assert cv2 is not None
-        assert self._cap is not None
+        source = self._cap
+        assert source is not None
+        ring = self.ring
+        pacer = Pacer(self.fps)
         while self._streaming:
-            ok, frame = self._cap.read()
-            if ok:
-                self._last_frame = frame
+            # lettura diretta nello slot del ring quando la risoluzione coincide
+            slot = ring.next_slot()
+            t0 = time.perf_counter()
+            ok, frame = source.read(slot)
+            ts = time.time()
+            # costo di lettura e decodifica, senza l'attesa del frame successivo della webcam
+            metrics.observe("capture", time.perf_counter() - t0 - source.wait_s)
+            if not ok:
+                ring.write(self._solid_frame((255, 255, 255)), ts)
+            elif frame is slot or np.shares_memory(frame, slot):
+                ring.commit(ts)
             else:
-                self._last_frame = self._solid_frame((255, 255, 255))
-            if cv2 is not None:
-                cv2.waitKey(int(1000 / max(self.fps, 1)))
+                ring.write(frame, ts)
+            if self._shared_stop_requested():
+                break
+            pacer.wait()
+
+    def _loop_remote(self, conn) -> None:
+        # Riceve dal processo del dispositivo: i byte del frame finiscono
+        # direttamente nello slot del ring, senza copie intermedie
+        ring = self.ring
+        try:
+            while self._streaming:
+                if not conn.poll(0.5):
+                    continue
+                msg = conn.recv()
+                kind = msg[0]
+                if kind == "frame":
+                    _, _seq, ts, shape = msg
+                    if tuple(shape) != ring.shape:
+                        ring.resize(tuple(shape))
+                    conn.recv_bytes_into(ring.next_slot().reshape(-1))
+                    ring.commit(ts)
+                    if self._shared_stop_requested():
+                        break
+                    transport = (time.time() - ts) * 1000.0
+                    self._transport_ms = 0.9 * self._transport_ms + 0.1 * transport if self._transport_ms else transport
+                elif kind == "analysis":
+                    self._remote_latest = msg[1]
+                    self._on_analysis(msg[1])
+                elif kind == "stats":
+                    self._device_stats = msg[1]
+                    # istogrammi del processo del dispositivo, sommati ai locali in /api/metrics
+                    if "metrics" in msg[1]:
+                        metrics.set_remote(f"device:{self.camera_id}", msg[1]["metrics"])
+        except (EOFError, OSError):
+            # processo terminato (stop o crash)
+            self._streaming = False
+        finally:
+            conn.close()
 
     def _loop_stub(self) -> None:
         # Genera un frame statico di placeholder
+        cv2 = _cv2()
         color = (40, 40, 40)
         text_color = (255, 255, 255)
-        while self._streaming:
-            frame = self._solid_frame(color)
-            try:
-                # draw STUB text if cv2 available
-                if cv2 is not None:
-                    cv2.putText(frame, "STUB STREAM", (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1.0, text_color, 2)
-            except Exception:
-                pass
-            self._last_frame = frame
-            # sleep approx fps
+        frame = self._solid_frame(color)
+        try:
+            # draw STUB text if cv2 available
             if cv2 is not None:
-                cv2.waitKey(int(1000 / max(self.fps, 1)))
+                cv2.putText(frame, "STUB STREAM", (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1.0, text_color, 2)
+        except Exception:
+            pass
+        pacer = Pacer(self.fps)
+        while self._streaming:
+            self.ring.write(frame)
+            if self._shared_stop_requested():
+                break
+            pacer.wait()
+
+    def _loop_attached(self) -> None:
+        # Consumatore del segmento condiviso: rilegge l'ultima analisi e la registra
+        ring = self.ring
+        last = 0
+        retry_at = 0.0
+        while self._streaming:
+            if not ring.producer_alive():
+                # produttore fermo o terminato: si aggancia a quello nuovo, se c'è
+                now = time.monotonic()
+                if now >= retry_at:
+                    retry_at = now + 1.0
+                    if ring.reattach():
+                        last = 0
+                time.sleep(0.1)
+                continue
+            found = ring.read_analysis(last)
+            if found is None:
+                time.sleep(0.005)
+                continue
+            last, result = found
+            self._remote_latest = result
+            latency = (time.time() - result["capture_ts"]) * 1000.0
+            self._transport_ms = 0.9 * self._transport_ms + 0.1 * latency if self._transport_ms else latency
+            self.recordings.feed(result)
+            self.session_metrics.feed(result)
 
     def _solid_frame(self, bgr: tuple) -> np.ndarray:
         return np.full((self.height, self.width, 3), bgr, dtype=np.uint8)
 
 
-camera = CameraManager()
+camera = CameraManager(
+    "default",
+    os.getenv("CAMERA_SOURCE", "0"),
+    isolated=os.getenv("CAMERA_ISOLATED", "0") == "1",
+    shm_name=os.getenv("CAMERA_SHM") or None,
+)
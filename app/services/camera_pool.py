@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import os
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+from .camera import CameraManager, camera
+
+
+def parse_devices(spec: str) -> List[Tuple[str, str]]:
+    """Parsa CAMERA_DEVICES: "sala1=0,sala2=rtsp://host/stream" -> [(id, sorgente)]."""
+    devices = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        camera_id, sep, source = item.partition("=")
+        if not sep or not camera_id.strip():
+            raise ValueError(f"dispositivo non valido: {item!r} (atteso id=sorgente)")
+        devices.append((camera_id.strip(), source.strip()))
+    return devices
+
+
+class CameraPool:
+    """Insieme delle camere per sala, indicizzate per id, con il binding visita -> camera.
+
+    La camera "default" è quella globale (retrocompatibile); le altre di norma
+    girano in un processo dedicato. Le visite senza binding usano la default.
+    """
+
+    def __init__(self, default: CameraManager) -> None:
+        self.default_id = default.camera_id
+        self._cameras: Dict[str, CameraManager] = {default.camera_id: default}
+        self._bindings: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, spec: str, isolated: bool = True) -> None:
+        for camera_id, source in parse_devices(spec):
+            self.add(camera_id, source, isolated=isolated)
+
+    def add(self, camera_id: str, source: Union[int, str], isolated: bool = True) -> CameraManager:
+        with self._lock:
+            if camera_id in self._cameras:
+                raise ValueError(f"camera già presente: {camera_id}")
+            prefix = os.getenv("CAMERA_SHM")
+            cam = CameraManager(
+                camera_id,
+                source,
+                isolated=isolated,
+                shm_name=f"{prefix}-{camera_id}" if prefix else None,
+            )
+            self._cameras[camera_id] = cam
+            return cam
+
+    def remove(self, camera_id: str) -> bool:
+        if camera_id == self.default_id:
+            raise ValueError("la camera di default non può essere rimossa")
+        with self._lock:
+            cam = self._cameras.pop(camera_id, None)
+            if cam is None:
+                return False
+            self._bindings = {v: c for v, c in self._bindings.items() if c != camera_id}
+        cam.stop()
+        return True
+
+    def get(self, camera_id: Optional[str] = None) -> Optional[CameraManager]:
+        return self._cameras.get(camera_id or self.default_id)
+
+    def ids(self) -> List[str]:
+        return list(self._cameras)
+
+    def bind(self, visit_id: str, camera_id: str) -> CameraManager:
+        with self._lock:
+            cam = self._cameras.get(camera_id)
+            if cam is None:
+                raise KeyError(camera_id)
+            self._bindings[visit_id] = camera_id
+            return cam
+
+    def unbind(self, visit_id: str) -> None:
+        with self._lock:
+            self._bindings.pop(visit_id, None)
+
+    def binding(self, visit_id: str) -> Optional[str]:
+        return self._bindings.get(visit_id)
+
+    def for_visit(self, visit_id: str) -> CameraManager:
+        cam = self._cameras.get(self._bindings.get(visit_id, ""))
+        return cam if cam is not None else self._cameras[self.default_id]
+
+    def stop_all(self) -> None:
+        for cam in list(self._cameras.values()):
+            cam.stop()
+
+    def status(self) -> dict:
+        return {
+            "default": self.default_id,
+            "devices": {cid: cam.status() for cid, cam in list(self._cameras.items())},
+            "bindings": dict(self._bindings),
+        }
+
+
+pool = CameraPool(camera)
+pool.configure(os.getenv("CAMERA_DEVICES", ""))
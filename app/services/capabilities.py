@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import importlib
+import threading
+import time
+from types import ModuleType
+from typing import Callable, Dict, Optional
+
+
+_modules: Dict[str, Optional[ModuleType]] = {}
+_modules_lock = threading.Lock()
+
+
+def optional_import(name: str) -> Optional[ModuleType]:
+    """Import lazy e memorizzato di un modulo opzionale (None se non installato)."""
+    try:
+        return _modules[name]
+    except KeyError:
+        pass
+    with _modules_lock:
+        if name not in _modules:
+            try:
+                _modules[name] = importlib.import_module(name)
+            except Exception:
+                _modules[name] = None
+        return _modules[name]
+
+
+def _probe_opencv() -> dict:
+    cv2 = optional_import("cv2")
+    if cv2 is None:
+        raise RuntimeError("opencv non disponibile")
+    return {"version": getattr(cv2, "__version__", None)}
+
+
+def _probe_mediapipe() -> dict:
+    mp = optional_import("mediapipe")
+    if mp is None:
+        raise RuntimeError("mediapipe non disponibile")
+    # costruisce (e chiude) un grafo Pose per verificare che il runtime funzioni
+    pose = mp.solutions.pose.Pose(static_image_mode=True, model_complexity=0)
+    close = getattr(pose, "close", None)
+    if close is not None:
+        close()
+    return {"version": getattr(mp, "__version__", None)}
+
+
+def _probe_smpl() -> dict:
+    from .smpl import SmplFitter
+
+    fitter = SmplFitter()
+    if not fitter.available:
+        raise RuntimeError("modelli SMPL (o smplx/torch) non disponibili")
+    return {"model_dir": fitter.model_dir, "backend": fitter.backend}
+
+
+PROBES: Dict[str, Callable[[], dict]] = {
+    "opencv": _probe_opencv,
+    "mediapipe": _probe_mediapipe,
+    "smpl": _probe_smpl,
+}
+
+
+class CapabilityRegistry:
+    """Probe delle dipendenze opzionali, eseguiti una volta in background.
+
+    I risultati (disponibilità, dettagli, durata del probe) restano in cache:
+    `/api/status` li legge senza importare nulla.
+    """
+
+    def __init__(self, probes: Dict[str, Callable[[], dict]] = PROBES) -> None:
+        self._probes = probes
+        self._results: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start_background(self, then: Optional[Callable[[], None]] = None) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run_all, args=(then,), name="capabilities", daemon=True)
+            self._thread.start()
+
+    def _run_all(self, then: Optional[Callable[[], None]]) -> None:
+        for name in self._probes:
+            self.probe(name)
+        if then is not None:
+            then()
+
+    def probe(self, name: str) -> dict:
+        result = self._results.get(name)
+        if result is not None:
+            return result
+        t0 = time.perf_counter()
+        try:
+            details = self._probes[name]()
+            result = {"available": True, **details}
+        except Exception as exc:
+            result = {"available": False, "error": str(exc)}
+        result["probe_ms"] = round((time.perf_counter() - t0) * 1000.0, 2)
+        self._results[name] = result
+        return result
+
+    def available(self, name: str) -> Optional[bool]:
+        # None = probe non ancora eseguito
+        result = self._results.get(name)
+        return None if result is None else bool(result["available"])
+
+    def snapshot(self) -> dict:
+        return {name: self._results.get(name, {"available": None, "pending": True}) for name in self._probes}
+
+
+capabilities = CapabilityRegistry()
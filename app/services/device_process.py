@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import time
+from typing import Union
+
+
+STATS_INTERVAL = 1.0
+
+
+def run_device(conn, stop_event, camera_id: str, source: Union[int, str], width: int, height: int, fps: int) -> None:
+    """Main del processo dedicato a un dispositivo: cattura + inferenza.
+
+    Riusa un `CameraManager` in-process e inoltra al processo padre, sulla
+    pipe, ogni nuovo frame (header + byte grezzi), ogni nuova analisi e
+    periodicamente le statistiche (inferenza, CPU del processo).
+    """
+    from .camera import CameraManager
+    from .metrics import metrics
+
+    cam = CameraManager(camera_id, source, width=width, height=height, fps=fps)
+    ok, msg = cam.start()
+    conn.send(("started", ok, msg))
+    last_frame = cam.ring.seq
+    last_analysis = None
+    stats_at = time.monotonic()
+    cpu_at = time.process_time()
+    try:
+        while not stop_event.is_set():
+            ref = cam.ring.wait_next(last_frame, timeout=0.5)
+            if ref is not None:
+                seq, ts, frame = ref
+                last_frame = seq
+                conn.send(("frame", seq, ts, frame.shape))
+                # vista 1-D: Connection misura i buffer con len(), non nbytes
+                conn.send_bytes(frame.reshape(-1))
+            latest = cam.latest_analysis()
+            if latest is not None and latest["seq"] != last_analysis:
+                last_analysis = latest["seq"]
+                conn.send(("analysis", latest))
+            now = time.monotonic()
+            if now - stats_at >= STATS_INTERVAL:
+                cpu = time.process_time()
+                conn.send(
+                    (
+                        "stats",
+                        {
+                            "cpu_percent": round(100.0 * (cpu - cpu_at) / (now - stats_at), 1),
+                            "inference": cam.status()["inference"],
+                            "metrics": metrics.export(),
+                        },
+                    )
+                )
+                stats_at, cpu_at = now, cpu
+    except (BrokenPipeError, EOFError, OSError):
+        pass
+    finally:
+        cam.stop()
+        try:
+            conn.close()
+        except Exception:
+            pass
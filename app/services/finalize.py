@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .fitting import best_frame, fit_summary, save_fit
+from .mesh import MESH_FORMATS, write_gzip
+from .metrics import metrics
+from .pose import symmetry_array
+from .recording import open_recording, recording_path, recording_source
+from .session_metrics import metrics_from_recording
+from .trends import visit_summary
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "..", "data", "results")
+
+
+def result_paths(visit_id: str) -> dict:
+    base = os.path.abspath(os.path.join(RESULTS_DIR, visit_id))
+    paths = {
+        "mesh": base + ".obj",  # formato legacy non compresso
+    }
+    for ext in MESH_FORMATS:
+        paths[f"mesh_{ext}"] = f"{base}.mesh.{ext}.gz"
+    paths["smpl_fit"] = base + ".smpl_fit.npz"
+    return paths
+
+
+def session_analysis(recordings, visit_id: str) -> Tuple[Optional[dict], Optional[dict]]:
+    """Frame migliore e statistiche della sessione registrata (se presente)."""
+    loaded = recordings.load(visit_id)
+    if loaded is None or not len(loaded[1]):
+        return None, None
+    meta, rec = loaded
+    best = int(np.argmax(rec["quality"]))
+    frame = rec[best]
+    names = meta["angles"]
+    analysis = {
+        "keypoints": np.array(frame["keypoints"]),
+        "angles": {n: (v if v == v else 0.0) for n, v in zip(names, frame["angles"].tolist())},
+        "symmetry": {"shoulders": float(symmetry_array(frame["keypoints"]))},
+        "frame_quality": float(frame["quality"]),
+    }
+    # medie di sessione sui soli frame in cui l'angolo è calcolabile
+    angles = rec["angles"]
+    valid = ~np.isnan(angles)
+    counts = valid.sum(axis=0)
+    means = np.where(counts > 0, np.where(valid, angles, 0.0).sum(axis=0) / np.maximum(counts, 1), np.nan)
+    session = {
+        "frames": int(len(rec)),
+        "duration_s": round(float(rec["ts"][-1] - rec["ts"][0]), 3),
+        "best_seq": int(frame["seq"]),
+        "mean_quality": round(float(rec["quality"].mean()), 4),
+        "angles_mean": {n: (round(v, 2) if v == v else 0.0) for n, v in zip(names, means.tolist())},
+    }
+    return analysis, session
+
+
+def staged_paths(visit_id: str, token: str) -> dict:
+    """Percorsi temporanei degli asset di un job: resi definitivi solo dal padre, a job non annullato."""
+    return {
+        key: os.path.join(os.path.dirname(path), f".{token}.{os.path.basename(path)}")
+        for key, path in result_paths(visit_id).items()
+        if key != "mesh"
+    }
+
+
+def commit_assets(visit_id: str, staged: dict) -> None:
+    final = result_paths(visit_id)
+    for key, path in staged.items():
+        os.replace(path, final[key])
+
+
+def discard_assets(staged: dict) -> None:
+    for path in staged.values():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def fit_recording(fitter, path: str, fit_path: str) -> Optional[Tuple[dict, np.ndarray, np.ndarray]]:
+    """Fitting dell'intera registrazione; salva pose/camere/errori per frame in `fit_path`."""
+    meta, rec = open_recording(path)
+    if not len(rec):
+        return None
+    result = fitter.fit_sequence(rec["keypoints"], int(meta.get("width") or 640), int(meta.get("height") or 480))
+    duration = float(rec["ts"][-1] - rec["ts"][0])
+    fps = meta.get("fps") or ((len(rec) - 1) / duration if duration > 0 else None)
+    save_fit(fit_path, result, rec["seq"])
+    best = best_frame(result, rec["quality"])
+    summary = fit_summary(result, fps)
+    summary["best_seq"] = int(rec["seq"][result["frames"][best]])
+    return summary, result["poses"][best], result["betas"]
+
+
+def fit_and_write_meshes(
+    visit_id: str, keypoints, recording: Optional[str] = None, token: str = "job"
+) -> Tuple[dict, bool, Optional[float], dict]:
+    """Parte CPU-bound del finalize, eseguita in un processo del pool.
+
+    Con una registrazione si adatta SMPL a tutti i frame e la mesh è quella del
+    frame migliore; altrimenti si adatta il solo snapshot `keypoints`.
+    Restituisce anche la durata del forward SMPL (None senza modello), che il
+    processo padre registra nelle metriche, e gli asset scritti nei percorsi
+    temporanei (`staged_paths`): un job annullato non tocca quelli pubblicati.
+    """
+    from .smpl import SmplFitter
+
+    fitter = SmplFitter()
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    paths = staged_paths(visit_id, token)
+    staged = {}
+    fitted = None
+    if fitter.available and recording and os.path.exists(recording):
+        try:
+            fitted = fit_recording(fitter, recording, paths["smpl_fit"])
+            if fitted is not None:
+                staged["smpl_fit"] = paths["smpl_fit"]
+        except Exception:
+            fitted = None
+    t0 = time.perf_counter()
+    if fitted is not None:
+        summary, pose, betas = fitted
+        params = {"betas": betas.tolist(), "pose": pose.tolist(), "transl": [0.0, 0.0, 0.0], "fit": summary}
+        mesh = fitter.mesh(pose, betas)
+    else:
+        params, mesh = fitter.fit(keypoints)
+    forward_s = time.perf_counter() - t0 if fitter.available else None
+    # Mesh salvate già compresse in tutti i formati
+    for ext, (_, writer) in MESH_FORMATS.items():
+        write_gzip(paths[f"mesh_{ext}"], writer(mesh))
+        staged[f"mesh_{ext}"] = paths[f"mesh_{ext}"]
+    return params, fitter.available, forward_s, staged
+
+
+def warm_worker() -> None:
+    # Initializer dei processi del pool: carica i modelli SMPL una volta per processo
+    if os.getenv("SMPL_WARMUP", "1") != "0":
+        from .lbs import lbs_registry
+        from .smpl import model_registry, smpl_backend
+
+        if smpl_backend() == "numpy":
+            lbs_registry.warmup()
+        else:
+            model_registry.warmup()
+
+
+def exercise_metrics(session_metrics, recordings, store, visit_id: str) -> Optional[dict]:
+    """Accumulatori live degli esercizi; ricostruiti dalla registrazione se mancano.
+
+    Succede se la sessione è stata servita da un altro worker/processo. Un video
+    caricato sostituisce la registrazione: gli accumulatori di un'eventuale
+    sessione live precedente non la descrivono più e vengono ignorati.
+    """
+    if recording_source(visit_id) != "video":
+        summary = session_metrics.summary(visit_id) if session_metrics is not None else None
+        if summary is not None:
+            return summary
+    loaded = recordings.load(visit_id)
+    if loaded is None or not len(loaded[1]):
+        return None
+    visit = store.get_visit(visit_id)
+    return metrics_from_recording(visit_id, loaded[1], visit["exercises"] if visit is not None else None)
+
+
+def finalize_job(ctx, visit_id: str, live_analysis: dict, recordings, session_metrics=None) -> dict:
+    from .store import store
+
+    with metrics.time("finalize"):
+        return _finalize(ctx, store, visit_id, live_analysis, recordings, session_metrics)
+
+
+def _finalize(ctx, store, visit_id: str, live_analysis: dict, recordings, session_metrics=None) -> dict:
+    ctx.report(0.05, "loading_session")
+    analysis, session = session_analysis(recordings, visit_id)
+    if analysis is None:
+        analysis = live_analysis
+    exercises = exercise_metrics(session_metrics, recordings, store, visit_id)
+
+    ctx.report(0.2, "fitting")
+    recording = recording_path(visit_id) if session is not None else None
+    token = ctx.job.id
+    try:
+        params, smpl_available, forward_s, staged = ctx.run_in_process(
+            fit_and_write_meshes, visit_id, analysis.get("keypoints", {}), recording, token
+        )
+        if forward_s is not None:
+            metrics.observe("smpl_forward", forward_s)
+        fit = params.get("fit")
+        if fit is not None:
+            metrics.observe("smpl_fit", fit["elapsed_s"])
+        ctx.report(0.9, "saving")
+    except Exception:
+        # annullato (o fallito) con il processo del pool che ha già scritto: asset scartati
+        discard_assets(staged_paths(visit_id, token))
+        raise
+    # ultimo punto di cancellazione superato: asset e risultati pubblicati insieme
+    commit_assets(visit_id, staged)
+    results = {
+        "visit_id": visit_id,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "smpl_available": smpl_available,
+        "smpl": params,
+        "metrics": {
+            "angles": analysis.get("angles", {}),
+            "symmetry": analysis.get("symmetry", {}),
+            "session": session,
+            "exercises": exercises,
+        },
+        "assets": {
+            "mesh_url": f"/api/results/{visit_id}/mesh.obj",
+            "mesh_glb_url": f"/api/results/{visit_id}/mesh.glb",
+            "mesh_ply_url": f"/api/results/{visit_id}/mesh.ply",
+            "smpl_fit_url": f"/api/results/{visit_id}/smpl_fit.npz" if fit is not None and fit["frames"] > 1 else None,
+        },
+    }
+    # riepilogo per i trend del paziente, salvato insieme ai risultati
+    store.save_results(visit_id, results, visit_summary(results))
+    return {"visit_id": visit_id, "results_url": f"/api/results/{visit_id}"}
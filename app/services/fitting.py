@@ -0,0 +1,387 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from .lbs import NUM_JOINTS, POSE_DIM, SmplLbs, rodrigues
+from .pose import LANDMARK_INDEX
+
+
+# Giunto SMPL <- landmark MediaPipe (media se più di uno), con peso del vincolo.
+# Anche e testa non coincidono esattamente (SMPL ha centri articolari, MediaPipe
+# punti di superficie): pesano meno.
+JOINT_MAP: Tuple[Tuple[int, Tuple[str, ...], float], ...] = (
+    (1, ("left_hip",), 0.6),
+    (2, ("right_hip",), 0.6),
+    (4, ("left_knee",), 1.0),
+    (5, ("right_knee",), 1.0),
+    (7, ("left_ankle",), 1.0),
+    (8, ("right_ankle",), 1.0),
+    (10, ("left_foot_index",), 0.5),
+    (11, ("right_foot_index",), 0.5),
+    (12, ("left_shoulder", "right_shoulder"), 0.5),
+    (15, ("nose",), 0.3),
+    (16, ("left_shoulder",), 1.0),
+    (17, ("right_shoulder",), 1.0),
+    (18, ("left_elbow",), 1.0),
+    (19, ("right_elbow",), 1.0),
+    (20, ("left_wrist",), 1.0),
+    (21, ("right_wrist",), 1.0),
+)
+
+SMPL_INDEX = np.array([m[0] for m in JOINT_MAP], dtype=np.intp)
+JOINT_WEIGHTS = np.array([m[2] for m in JOINT_MAP], dtype=np.float64)
+
+# Prior di posa per giunto SMPL: colonna, collo, mani e piedi sono poco
+# osservabili da 2D e restano vicini alla posa di riposo.
+_STIFF = {3: 4.0, 6: 4.0, 9: 4.0, 10: 8.0, 11: 8.0, 12: 4.0, 13: 4.0, 14: 4.0, 15: 2.0, 22: 8.0, 23: 8.0}
+POSE_PRIOR = np.repeat([0.0] + [_STIFF.get(j, 0.5) for j in range(1, NUM_JOINTS)], 3)
+
+MIN_VISIBILITY = 0.3
+FD_EPS = 1e-5  # passo delle differenze finite per lo Jacobiano numerico
+
+
+class FitOptions:
+    """Parametri del fitting, di default dalle variabili d'ambiente `SMPL_FIT_*`."""
+
+    def __init__(
+        self,
+        window: Optional[int] = None,
+        iterations: Optional[int] = None,
+        budget_s: Optional[float] = None,
+        stride: Optional[int] = None,
+        tol: float = 1e-2,
+        pose_prior: float = 1e-4,
+        beta_prior: float = 1e-2,
+        smoothness: float = 5e-3,
+    ) -> None:
+        self.window = window or int(os.getenv("SMPL_FIT_WINDOW", "16"))
+        self.iterations = iterations or int(os.getenv("SMPL_FIT_ITERS", "15"))
+        self.budget_s = budget_s if budget_s is not None else float(os.getenv("SMPL_FIT_BUDGET_S", "60"))
+        self.stride = stride or int(os.getenv("SMPL_FIT_STRIDE", "1"))
+        self.tol = tol
+        self.pose_prior = pose_prior
+        self.beta_prior = beta_prior
+        self.smoothness = smoothness
+
+
+def observations(keypoints: np.ndarray, width: int, height: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Keypoint MediaPipe `(T, 33, 4)` -> punti `(T, K, 2)` in unità di altezza immagine e pesi `(T, K)`."""
+    keypoints = np.asarray(keypoints, dtype=np.float64).reshape(-1, 33, 4)
+    aspect = width / float(height or 1)
+    obs = np.zeros((len(keypoints), len(JOINT_MAP), 2))
+    vis = np.zeros((len(keypoints), len(JOINT_MAP)))
+    for k, (_, names, _) in enumerate(JOINT_MAP):
+        src = keypoints[:, [LANDMARK_INDEX[n] for n in names]]
+        obs[:, k, 0] = src[..., 0].mean(axis=1) * aspect
+        obs[:, k, 1] = src[..., 1].mean(axis=1)
+        vis[:, k] = src[..., 3].min(axis=1)
+    bad = np.isnan(obs).any(axis=-1) | np.isnan(vis) | (vis < MIN_VISIBILITY)
+    obs[bad] = 0.0
+    vis = np.where(bad, 0.0, vis)
+    return obs, vis * JOINT_WEIGHTS
+
+
+class BatchFitter:
+    """Fitting di pose SMPL per frame e forma condivisa su finestre di keypoint 2D.
+
+    Camera a prospettiva debole per frame (`s, tx, ty`), residui pesati per
+    visibilità. Ogni iterazione è un passo di Levenberg-Marquardt per frame
+    (Jacobiano numerico di tutti i frame della finestra in forma vettoriale)
+    e un passo di Gauss-Newton sui beta.
+    La levigatezza temporale usa i vicini dell'iterazione precedente, così i
+    sistemi restano indipendenti per frame (75x75, risolti in batch).
+    """
+
+    def __init__(self, model: SmplLbs, options: Optional[FitOptions] = None) -> None:
+        self.model = model
+        self.options = options or FitOptions()
+        self.num_betas = min(model.num_betas, 10)
+        # discendenti (stretti) di ogni giunto, ristretti ai giunti osservati
+        ancestors = np.zeros((NUM_JOINTS, NUM_JOINTS), dtype=bool)
+        for d in range(1, NUM_JOINTS):
+            p = model.parents[d]
+            while p >= 0:
+                ancestors[p, d] = True
+                p = model.parents[p] if p > 0 else -1
+        self._descendants = ancestors[:, SMPL_INDEX]  # (24, K)
+
+    # ---------------------------------------------------------------- modello
+    def project(self, params: np.ndarray, j_rest: np.ndarray) -> np.ndarray:
+        """Parametri `(N, 75)` = posa 72 + camera 3 -> giunti mappati proiettati `(N, K, 2)`."""
+        joints = self.model.posed_joints(params[:, :POSE_DIM], j_rest)[:, SMPL_INDEX]
+        scale = params[:, POSE_DIM, None]
+        # asse y di SMPL verso l'alto, immagine verso il basso
+        u = scale * joints[..., 0] + params[:, POSE_DIM + 1, None]
+        v = -scale * joints[..., 1] + params[:, POSE_DIM + 2, None]
+        return np.stack([u, v], axis=-1)
+
+    def _jacobian(self, params: np.ndarray, j_rest: np.ndarray, sw: np.ndarray) -> np.ndarray:
+        """Jacobiano dei residui `(75, T, 2K)`: differenze finite sulla posa, analitico sulla camera.
+
+        Perturbare la rotazione locale del giunto j ruota solo i suoi
+        discendenti attorno a j: dalla cinematica già calcolata basta
+        ΔR = G_parent · R'_j · R_jᵀ · G_parentᵀ, senza rifare la catena.
+        """
+        n = len(params)
+        pose = params[:, :POSE_DIM].reshape(n, NUM_JOINTS, 3)
+        rot = rodrigues(pose)
+        g_rot, g_t = self.model._chain(rot, j_rest)
+        parent_rot = np.concatenate([np.broadcast_to(np.eye(3), (n, 1, 3, 3)), g_rot[:, self.model.parents[1:]]], axis=1)
+        bumped = rodrigues(pose[:, :, None, :] + np.eye(3) * FD_EPS)  # (n, 24, 3 assi, 3, 3)
+        parent_rot = parent_rot[:, :, None]
+        # ΔR per giunto e asse: (n, 24, 3, 3, 3)
+        delta = parent_rot @ bumped @ rot[:, :, None].swapaxes(-1, -2) @ parent_rot.swapaxes(-1, -2)
+        observed = g_t[:, SMPL_INDEX]  # (n, K, 3)
+        offsets = observed[:, None, :, :] - g_t[:, :, None, :]  # (n, 24, K, 3)
+        moved = (delta @ offsets[:, :, None].swapaxes(-1, -2)).swapaxes(-1, -2) - offsets[:, :, None]  # (n, 24, 3, K, 3)
+        moved *= self._descendants[None, :, None, :, None]
+        scale = params[:, POSE_DIM, None, None, None]
+        dproj = np.stack([scale * moved[..., 0], -scale * moved[..., 1]], axis=-1) / FD_EPS  # (n, 24, 3, K, 2)
+        jac = np.empty((POSE_DIM + 3, n, len(SMPL_INDEX) * 2))
+        jac[:POSE_DIM] = (dproj * sw[:, None, None, :, None]).reshape(n, POSE_DIM, -1).transpose(1, 0, 2)
+        cam = np.zeros((3, n, len(SMPL_INDEX), 2))
+        cam[0, ..., 0] = observed[..., 0]
+        cam[0, ..., 1] = -observed[..., 1]
+        cam[1, ..., 0] = 1.0
+        cam[2, ..., 1] = 1.0
+        jac[POSE_DIM:] = (cam * sw[None, ..., None]).reshape(3, n, -1)
+        return jac
+
+    def _residuals(self, params: np.ndarray, j_rest: np.ndarray, obs: np.ndarray, sw: np.ndarray) -> np.ndarray:
+        return ((self.project(params, j_rest) - obs) * sw[..., None]).reshape(len(params), -1)
+
+    def _prior_cost(self, params: np.ndarray, neighbours: np.ndarray, lam: np.ndarray) -> np.ndarray:
+        pose = params[:, :POSE_DIM]
+        return (lam * pose**2).sum(axis=1) + self.options.smoothness * ((params - neighbours) ** 2).sum(axis=1)
+
+    def init_camera(self, params: np.ndarray, j_rest: np.ndarray, obs: np.ndarray, w: np.ndarray) -> None:
+        # scala e traslazione ai minimi quadrati pesati, dati posa e forma correnti
+        cam = params.copy()
+        cam[:, POSE_DIM :] = (1.0, 0.0, 0.0)
+        proj = self.project(cam, j_rest)
+        wsum = np.maximum(w.sum(axis=1, keepdims=True), 1e-9)
+        pm = (proj * w[..., None]).sum(axis=1) / wsum
+        om = (obs * w[..., None]).sum(axis=1) / wsum
+        dp = proj - pm[:, None]
+        do = obs - om[:, None]
+        num = (w[..., None] * dp * do).sum(axis=(1, 2))
+        den = np.maximum((w[..., None] * dp * dp).sum(axis=(1, 2)), 1e-9)
+        scale = np.where(num > 0, num / den, 1.0)
+        params[:, POSE_DIM] = scale
+        params[:, POSE_DIM + 1 :] = om - scale[:, None] * pm
+
+    def _initial_yaw(self, params: np.ndarray, j_rest: np.ndarray, obs: np.ndarray, w: np.ndarray) -> None:
+        # partenza a freddo: orientamento globale (frontale, di lato, di schiena) col residuo minore
+        best = None
+        for yaw in (0.0, np.pi / 2, np.pi, -np.pi / 2):
+            trial = params.copy()
+            trial[:, :3] = (0.0, yaw, 0.0)
+            self.init_camera(trial, j_rest, obs, w)
+            cost = (self._residuals(trial, j_rest, obs, np.sqrt(w)) ** 2).sum()
+            if best is None or cost < best[0]:
+                best = (cost, trial)
+        params[:] = best[1]
+
+    # -------------------------------------------------------------- finestra
+    def fit_window(
+        self,
+        obs: np.ndarray,
+        w: np.ndarray,
+        init: Optional[np.ndarray] = None,
+        betas: Optional[np.ndarray] = None,
+        before: Optional[np.ndarray] = None,
+        deadline: Optional[float] = None,
+    ) -> dict:
+        """Ottimizza una finestra `(T, K, 2)`; `init`/`betas`/`before` sono la soluzione precedente (warm start)."""
+        opts = self.options
+        n = len(obs)
+        sw = np.sqrt(w)
+        betas = np.zeros(self.num_betas) if betas is None else np.array(betas[: self.num_betas], dtype=np.float64)
+        j_rest = self.model.rest_joints(betas)
+        params = np.zeros((n, POSE_DIM + 3))
+        if init is not None:
+            params[:] = init
+            self.init_camera(params, j_rest, obs, w)
+        else:
+            self._initial_yaw(params, j_rest, obs, w)
+        lam = opts.pose_prior * POSE_PRIOR
+        prior_diag = np.concatenate([lam, np.zeros(3)]) + opts.smoothness
+        mu = np.full(n, 1e-2)
+        eye = np.eye(POSE_DIM + 3)
+
+        def neighbours(p: np.ndarray) -> np.ndarray:
+            prev = np.concatenate([p[:1] if before is None else before[None], p[:-1]])
+            nxt = np.concatenate([p[1:], p[-1:]])
+            return 0.5 * (prev + nxt)
+
+        res = self._residuals(params, j_rest, obs, sw)
+        nb = neighbours(params)
+        cost = (res**2).sum(axis=1) + self._prior_cost(params, nb, lam)
+        total = float(cost.sum()) + opts.beta_prior * float(betas @ betas)
+        start_cost = total
+        iterations = 0
+        stalled = 0
+        converged = False
+        while iterations < opts.iterations:
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+            iterations += 1
+            jac = self._jacobian(params, j_rest, sw)  # (P, T, R)
+            jt = jac.transpose(1, 0, 2)  # (T, P, R)
+            jtj = jt @ jt.transpose(0, 2, 1)
+            grad = (jt @ res[..., None])[..., 0]
+            grad[:, :POSE_DIM] += lam * params[:, :POSE_DIM]
+            grad += opts.smoothness * (params - nb)
+            hess = jtj + prior_diag * eye
+            damped = hess + mu[:, None, None] * (np.diagonal(hess, axis1=1, axis2=2)[:, :, None] * eye + 1e-9 * eye)
+            step = -np.linalg.solve(damped, grad[..., None])[..., 0]
+            trial = params + step
+            trial_res = self._residuals(trial, j_rest, obs, sw)
+            trial_cost = (trial_res**2).sum(axis=1) + self._prior_cost(trial, nb, lam)
+            better = trial_cost < cost
+            params = np.where(better[:, None], trial, params)
+            res = np.where(better[:, None], trial_res, res)
+            mu = np.where(better, mu / 3.0, mu * 4.0)
+
+            # forma condivisa: un passo di Gauss-Newton sui beta con le pose fissate
+            betas, j_rest, res = self._betas_step(params, betas, j_rest, res, obs, sw)
+            previous = total
+            nb = neighbours(params)
+            cost = (res**2).sum(axis=1) + self._prior_cost(params, nb, lam)
+            total = float(cost.sum()) + opts.beta_prior * float(betas @ betas)
+            # convergenza: passi accettati quasi ovunque ma guadagno trascurabile, o nessun passo utile
+            stalled = 0 if better.any() else stalled + 1
+            if (better.mean() > 0.5 and previous - total < opts.tol * max(previous, 1e-12)) or stalled >= 3:
+                converged = True
+                break
+        return {
+            "params": params,
+            "betas": betas,
+            "iterations": iterations,
+            "converged": converged,
+            "start_cost": start_cost,
+            "cost": total,
+        }
+
+    def _betas_step(self, params, betas, j_rest, res, obs, sw):
+        opts = self.options
+        n, b = len(params), self.num_betas
+        # Jacobiano numerico sui beta: B copie della finestra, ognuna con un beta perturbato
+        rests = np.repeat(self.model.rest_joints(betas[None] + np.eye(b) * FD_EPS), n, axis=0)
+        shifted = self._residuals(np.tile(params, (b, 1)), rests, np.tile(obs, (b, 1, 1)), np.tile(sw, (b, 1)))
+        flat = res.reshape(-1)
+        jac = (shifted.reshape(b, -1) - flat[None]) / FD_EPS  # (B, T*R)
+        hess = jac @ jac.T + opts.beta_prior * np.eye(b)
+        grad = jac @ flat + opts.beta_prior * betas
+        trial = betas - np.linalg.solve(hess, grad)
+        trial_rest = self.model.rest_joints(trial)
+        trial_res = self._residuals(params, trial_rest, obs, sw)
+        old = float(flat @ flat) + opts.beta_prior * float(betas @ betas)
+        new = float((trial_res**2).sum()) + opts.beta_prior * float(trial @ trial)
+        if new < old:
+            return trial, trial_rest, trial_res
+        return betas, j_rest, res
+
+    # -------------------------------------------------------------- sequenza
+    def fit_sequence(self, keypoints: np.ndarray, width: int, height: int) -> dict:
+        """Fitting di un'intera registrazione a finestre, ciascuna partita dalla soluzione precedente.
+
+        Il tempo residuo è diviso tra le finestre rimanenti: oltre il budget le
+        finestre fanno meno iterazioni invece di saltare frame.
+        """
+        opts = self.options
+        started = time.perf_counter()
+        keypoints = np.asarray(keypoints).reshape(-1, 33, 4)
+        frames = np.arange(0, len(keypoints), max(1, opts.stride))
+        obs, w = observations(keypoints[frames], width, height)
+        params = np.zeros((len(frames), POSE_DIM + 3))
+        betas: Optional[np.ndarray] = None
+        last: Optional[np.ndarray] = None
+        windows = list(range(0, len(frames), max(1, opts.window)))
+        iterations = 0
+        converged = 0
+        for i, start in enumerate(windows):
+            end = min(len(frames), start + opts.window)
+            left = opts.budget_s - (time.perf_counter() - started)
+            deadline = time.perf_counter() + max(left, 0.0) / (len(windows) - i) if opts.budget_s > 0 else None
+            out = self.fit_window(
+                obs[start:end],
+                w[start:end],
+                init=None if last is None else np.repeat(last[None], end - start, axis=0),
+                betas=betas,
+                before=last,
+                deadline=deadline,
+            )
+            params[start:end] = out["params"]
+            betas = out["betas"]
+            last = out["params"][-1]
+            iterations += out["iterations"]
+            converged += bool(out["converged"])
+        betas = np.zeros(self.num_betas) if betas is None else betas
+        error = self.reprojection_error(params, betas, obs, w) * height
+        return {
+            "frames": frames,
+            "poses": params[:, :POSE_DIM].astype(np.float32),
+            "cameras": params[:, POSE_DIM:].astype(np.float32),
+            "betas": betas.astype(np.float32),
+            "error_px": error.astype(np.float32),
+            "windows": len(windows),
+            "converged_windows": converged,
+            "iterations": iterations,
+            "elapsed_s": time.perf_counter() - started,
+        }
+
+    def reprojection_error(self, params: np.ndarray, betas: np.ndarray, obs: np.ndarray, w: np.ndarray) -> np.ndarray:
+        """Distanza media per frame tra giunti proiettati e keypoint visibili (unità di altezza immagine; NaN se nessuno)."""
+        proj = self.project(params, self.model.rest_joints(betas))
+        dist = np.linalg.norm(proj - obs, axis=-1)
+        visible = w > 0
+        count = visible.sum(axis=1)
+        return np.where(count > 0, (dist * visible).sum(axis=1) / np.maximum(count, 1), np.nan)
+
+
+def fit_summary(result: dict, fps: Optional[float] = None) -> dict:
+    """Riepilogo JSON del fitting, con l'errore di riproiezione per frame."""
+    error = result["error_px"].astype(np.float64)
+    valid = error[~np.isnan(error)]
+    return {
+        "frames": int(len(result["frames"])),
+        "windows": result["windows"],
+        "converged_windows": result["converged_windows"],
+        "iterations": result["iterations"],
+        "elapsed_s": round(result["elapsed_s"], 3),
+        "realtime_factor": round(len(result["frames"]) / fps / result["elapsed_s"], 2) if fps and result["elapsed_s"] else None,
+        "reprojection_error_px": {
+            "mean": round(float(valid.mean()), 2) if len(valid) else None,
+            "p95": round(float(np.percentile(valid, 95)), 2) if len(valid) else None,
+            "max": round(float(valid.max()), 2) if len(valid) else None,
+            "per_frame": [None if e != e else round(e, 2) for e in error.tolist()],
+        },
+    }
+
+
+def save_fit(path: str, result: dict, seq: Optional[np.ndarray] = None) -> None:
+    # Soluzione completa per frame (pose, camere, errore), riutilizzabile per l'animazione
+    arrays: Dict[str, np.ndarray] = {k: result[k] for k in ("frames", "poses", "cameras", "betas", "error_px")}
+    if seq is not None:
+        arrays["seq"] = np.asarray(seq)[result["frames"]]
+    np.savez_compressed(path, **arrays)
+
+
+def load_fit(path: str) -> Dict[str, np.ndarray]:
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
+
+
+def best_frame(result: dict, quality: Optional[np.ndarray] = None) -> int:
+    """Indice (nel risultato) del frame più affidabile: qualità alta, errore basso."""
+    error = np.nan_to_num(result["error_px"].astype(np.float64), nan=np.inf)
+    if quality is None:
+        return int(np.argmin(error))
+    q = np.asarray(quality, dtype=np.float64)[result["frames"]]
+    return int(np.argmax(np.where(np.isfinite(error), q / (1.0 + error), -np.inf)))
+
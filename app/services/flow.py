@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+
+# Livelli di qualità video (scala, qualità JPEG); None = qualità di default dell'encoder.
+# Ogni livello viene codificato al più una volta per frame e condiviso tra i client.
+QUALITY_TIERS: Tuple[Tuple[float, Optional[int]], ...] = (
+    (1.0, None),
+    (1.0, 75),
+    (0.75, 65),
+    (0.5, 55),
+    (0.5, 40),
+    (0.25, 35),
+)
+
+WINDOW_S = 2.0
+STEP_INTERVAL_S = 0.5
+MAX_INFLIGHT = 2
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+class FlowControl:
+    """Controllo di flusso e qualità adattiva del video per una connessione WS.
+
+    Segnali di congestione: durata dell'invio (il send si blocca quando il
+    buffer del socket è pieno), frame più vecchi di `max_lag_ms` e, se il
+    client conferma i frame (`{"ack": seq}`), il numero di frame non ancora
+    confermati. Su congestione si scende prima di livello di qualità e poi di
+    fps; dopo un periodo stabile si risale in ordine inverso. I frame scartati
+    non vengono mai accodati: al giro dopo si invia quello più recente.
+    """
+
+    def __init__(
+        self,
+        max_fps: Optional[float] = None,
+        min_fps: Optional[float] = None,
+        max_lag_ms: Optional[float] = None,
+        tier: Optional[int] = None,
+        max_tier: Optional[int] = None,
+        adaptive: bool = True,
+    ) -> None:
+        lowest = len(QUALITY_TIERS) - 1
+        self.max_fps = max_fps or _env_float("WS_MAX_FPS", 30.0)
+        self.min_fps = min(min_fps or _env_float("WS_MIN_FPS", 2.0), self.max_fps)
+        self.max_lag_ms = max_lag_ms or _env_float("WS_MAX_LAG_MS", 500.0)
+        self.max_tier = min(lowest, int(_env_float("WS_MAX_TIER", lowest)) if max_tier is None else max_tier)
+        self.adaptive = adaptive and tier is None
+        self.tier = min(tier if tier is not None else 0, self.max_tier)
+        self.fps = self.max_fps
+        self.dropped_stale = 0
+        self.dropped_backlog = 0
+        self._next_video = 0.0
+        self._last_step = 0.0
+        self._good_since: Optional[float] = None
+        self._send_ms = 0.0
+        self._rtt_ms: Optional[float] = None
+        self._unacked: Dict[int, float] = {}
+        self._acks = False
+        self._window: Deque[Tuple[float, int, bool]] = deque()
+
+    @property
+    def scale(self) -> float:
+        return QUALITY_TIERS[self.tier][0]
+
+    @property
+    def quality(self) -> Optional[int]:
+        return QUALITY_TIERS[self.tier][1]
+
+    def admit(self, now: float, age_s: Optional[float]) -> bool:
+        """True se il frame corrente va inviato (fps adattivo, freschezza, backlog)."""
+        if age_s is not None and age_s * 1000.0 > self.max_lag_ms:
+            self.dropped_stale += 1
+            self._congested(now)
+            return False
+        if self._acks:
+            # frame mai confermati (persi o client che non invia più ack)
+            for s in [s for s, t in self._unacked.items() if now - t > WINDOW_S]:
+                del self._unacked[s]
+        if self._acks and len(self._unacked) >= MAX_INFLIGHT:
+            self.dropped_backlog += 1
+            self._congested(now)
+            return False
+        if now < self._next_video:
+            return False
+        # cadenza senza recupero a raffica dei tick persi
+        period = 1.0 / self.fps
+        self._next_video += period
+        if self._next_video <= now:
+            self._next_video = now + period
+        return True
+
+    def on_sent(self, seq: int, nbytes: int, seconds: float, video: bool) -> None:
+        now = time.monotonic()
+        self._window.append((now, nbytes, video))
+        while self._window and now - self._window[0][0] > WINDOW_S:
+            self._window.popleft()
+        if not video:
+            return
+        ms = seconds * 1000.0
+        self._send_ms = ms if not self._send_ms else 0.8 * self._send_ms + 0.2 * ms
+        if self._acks:
+            self._unacked[seq] = now
+        period_ms = 1000.0 / self.fps
+        if ms > max(0.5 * period_ms, 20.0):
+            self._congested(now)
+        elif ms < 0.2 * period_ms:
+            if self._good_since is None:
+                self._good_since = now
+            elif now - self._good_since >= WINDOW_S:
+                self._improve(now)
+
+    def on_ack(self, seq: int) -> None:
+        now = time.monotonic()
+        self._acks = True
+        sent = self._unacked.get(seq)
+        if sent is not None:
+            rtt = (now - sent) * 1000.0
+            self._rtt_ms = rtt if self._rtt_ms is None else 0.8 * self._rtt_ms + 0.2 * rtt
+        # l'ack di un frame conferma anche quelli precedenti
+        for s in [s for s in self._unacked if s <= seq]:
+            del self._unacked[s]
+
+    def _congested(self, now: float) -> None:
+        self._good_since = None
+        if not self.adaptive or now - self._last_step < STEP_INTERVAL_S:
+            return
+        self._last_step = now
+        if self.tier < self.max_tier:
+            self.tier += 1
+        else:
+            self.fps = max(self.min_fps, self.fps * 0.7)
+
+    def _improve(self, now: float) -> None:
+        self._good_since = now
+        if not self.adaptive:
+            return
+        self._last_step = now
+        if self.fps < self.max_fps:
+            self.fps = min(self.max_fps, self.fps * 1.25)
+        elif self.tier > 0:
+            self.tier -= 1
+
+    def stats(self) -> dict:
+        window = list(self._window)
+        span = max(time.monotonic() - window[0][0], 0.5) if window else WINDOW_S
+        frames = sum(1 for _, _, video in window if video)
+        nbytes = sum(n for _, n, _ in window)
+        return {
+            "adaptive": self.adaptive,
+            "target_fps": round(self.fps, 2),
+            "effective_fps": round(frames / span, 2),
+            "bitrate_kbps": round(nbytes * 8 / span / 1000.0, 1),
+            "tier": self.tier,
+            "scale": self.scale,
+            "jpeg_quality": self.quality,
+            "send_ms": round(self._send_ms, 2),
+            "rtt_ms": round(self._rtt_ms, 2) if self._rtt_ms is not None else None,
+            "inflight": len(self._unacked),
+            "dropped_stale": self.dropped_stale,
+            "dropped_backlog": self.dropped_backlog,
+        }
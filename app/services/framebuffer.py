@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+FrameRef = Tuple[int, float, np.ndarray]  # (seq, capture_ts, view read-only)
+
+
+class FrameRing:
+    """Ring buffer di slot frame preallocati con sequenza monotona.
+
+    Il produttore scrive direttamente nello slot successivo (`next_slot` +
+    `commit`) e i consumatori ricevono viste read-only senza copia. Una vista
+    resta valida finché lo slot non viene riscritto, cioè per `slots - 1`
+    frame: `is_valid(seq)` permette di verificarlo dopo l'uso.
+    """
+
+    def __init__(self, slots: int, shape: Tuple[int, ...], dtype=np.uint8) -> None:
+        if slots < 2:
+            raise ValueError("servono almeno 2 slot")
+        self.slots = slots
+        self._cond = threading.Condition()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self.seq = 0
+        self._last_commit = 0.0
+        self._interval = 0.0  # media mobile dell'intervallo tra commit (s)
+        self._alloc(shape, dtype)
+
+    def _alloc(self, shape: Tuple[int, ...], dtype) -> None:
+        self._buf = np.zeros((self.slots,) + tuple(shape), dtype=dtype)
+        self._ts = np.zeros(self.slots, dtype=np.float64)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self._buf.shape[1:]
+
+    @property
+    def measured_fps(self) -> float:
+        # 0 se non arrivano frame da oltre un secondo
+        if not self._interval or time.monotonic() - self._last_commit > max(1.0, 4 * self._interval):
+            return 0.0
+        return 1.0 / self._interval
+
+    def resize(self, shape: Tuple[int, ...]) -> None:
+        # Solo dal produttore, es. se la camera non rispetta la risoluzione richiesta
+        with self._cond:
+            self._alloc(shape, self._buf.dtype)
+
+    def next_slot(self) -> np.ndarray:
+        """Slot scrivibile per il prossimo frame (non visibile ai consumatori fino a `commit`)."""
+        return self._buf[(self.seq + 1) % self.slots]
+
+    def commit(self, ts: Optional[float] = None) -> int:
+        with self._cond:
+            seq = self.seq + 1
+            i = seq % self.slots
+            self._ts[i] = time.time() if ts is None else ts
+            self.seq = seq
+            now = time.monotonic()
+            if self._last_commit:
+                dt = now - self._last_commit
+                self._interval = dt if not self._interval else 0.9 * self._interval + 0.1 * dt
+            self._last_commit = now
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, fut in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, fut)
+            except RuntimeError:
+                pass  # loop chiuso
+        return seq
+
+    def write(self, frame: np.ndarray, ts: Optional[float] = None) -> int:
+        slot = self.next_slot()
+        if frame.shape != slot.shape:
+            self.resize(frame.shape)
+            slot = self.next_slot()
+        np.copyto(slot, frame)
+        return self.commit(ts)
+
+    def _ref(self, seq: int) -> FrameRef:
+        i = seq % self.slots
+        view = self._buf[i]
+        view.flags.writeable = False
+        return seq, float(self._ts[i]), view
+
+    def latest(self) -> Optional[FrameRef]:
+        seq = self.seq
+        return self._ref(seq) if seq else None
+
+    def is_valid(self, seq: int) -> bool:
+        return 0 < seq and self.seq - seq < self.slots - 1
+
+    def wait_next(self, after_seq: int, timeout: Optional[float] = None) -> Optional[FrameRef]:
+        """Blocca il thread finché esiste un frame con seq > after_seq (l'ultimo)."""
+        with self._cond:
+            if self.seq <= after_seq:
+                self._cond.wait_for(lambda: self.seq > after_seq, timeout)
+            if self.seq <= after_seq:
+                return None
+            return self._ref(self.seq)
+
+    async def wait_next_async(self, after_seq: int) -> FrameRef:
+        """Variante asyncio di `wait_next`: nessun polling, risveglio al commit."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self.seq > after_seq:
+                    return self._ref(self.seq)
+                fut = loop.create_future()
+                waiter = (loop, fut)
+                self._waiters.append(waiter)
+            try:
+                await fut
+            finally:
+                if fut.cancelled():
+                    # attesa annullata (es. timeout di wait_for): niente waiter orfani a camera ferma
+                    with self._cond:
+                        if waiter in self._waiters:
+                            self._waiters.remove(waiter)
+
+
+def _resolve(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+class Pacer:
+    """Cadenza a intervalli fissi su clock monotono, senza accumulare ritardo."""
+
+    def __init__(self, fps: float) -> None:
+        self.fps = fps
+        self._next = time.monotonic()
+
+    def wait(self) -> None:
+        period = 1.0 / max(self.fps, 1)
+        self._next += period
+        delay = self._next - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -period:
+            # in ritardo di oltre un periodo: riallinea invece di recuperare a raffica
+            self._next = time.monotonic()
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from .capabilities import optional_import
+from .framebuffer import FrameRing
+from .metrics import metrics
+
+
+class MotionGate:
+    """Rilevatore di movimento economico per saltare l'inferenza sui frame fermi.
+
+    Ogni frame viene ridotto a una miniatura in scala di grigi (`width` px di
+    lato); l'energia è la media della differenza assoluta rispetto alla
+    miniatura dell'ultimo frame elaborato (non del precedente, così un
+    movimento lento non sfugge accumulandosi). Sotto `threshold` il frame si
+    salta, ma al massimo per `max_interval` secondi di fila.
+    """
+
+    def __init__(self, threshold: float = 2.0, max_interval: float = 1.0, width: int = 64) -> None:
+        self.threshold = threshold
+        self.max_interval = max_interval
+        self.width = width
+        self.energy = 0.0
+        self._ref: Optional[np.ndarray] = None
+        self._ref_at = 0.0
+
+    def thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        h, w = frame.shape[:2]
+        cv2 = optional_import("cv2")
+        if cv2 is not None:
+            # INTER_AREA media i pixel: il rumore del sensore si attenua
+            size = (self.width, max(1, h * self.width // w))
+            small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.int16)
+        step = max(1, w // self.width)
+        small = frame[::step, ::step].astype(np.int16)
+        return (small[..., 0] * 29 + small[..., 1] * 150 + small[..., 2] * 77) >> 8
+
+    def should_infer(self, frame: np.ndarray, now: float) -> bool:
+        thumb = self.thumbnail(frame)
+        ref = self._ref
+        if ref is not None and ref.shape == thumb.shape:
+            self.energy = float(np.abs(thumb - ref).mean())
+            if self.energy < self.threshold and now - self._ref_at < self.max_interval:
+                return False
+        self._ref = thumb
+        self._ref_at = now
+        return True
+
+
+class PoseWorker:
+    """Stadio di inferenza in background che consuma i frame del ring di cattura.
+
+    Ad ogni giro elabora solo l'ultimo frame disponibile: se l'inferenza è più
+    lenta della cattura, i frame intermedi vengono saltati e conteggiati come
+    scartati. Con il `MotionGate` attivo i frame senza movimento riusano
+    l'ultima analisi invece di ripetere l'inferenza.
+    I risultati sono dict (keypoint come array `(33, 4)`) marcati con `seq` e
+    timestamp di cattura; la lettura (`latest`) non blocca mai.
+    """
+
+    def __init__(
+        self,
+        estimator_factory: Callable[[], Any],
+        ring: FrameRing,
+        on_result: Optional[Callable[[dict], None]] = None,
+    ) -> None:
+        self._factory = estimator_factory
+        self._ring = ring
+        self._on_result = on_result
+        self._lock = threading.Lock()
+        self._latest: Optional[dict] = None
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self.available = True
+        self.processed = 0
+        self.dropped = 0
+        self._infer_ms = 0.0
+        self._latency_ms = 0.0
+        self._estimator: Any = None
+        # POSE_MOTION_THRESHOLD=0 disattiva il gate (inferenza su ogni frame)
+        threshold = float(os.getenv("POSE_MOTION_THRESHOLD", "2.0"))
+        self._gate: Optional[MotionGate] = (
+            MotionGate(threshold, float(os.getenv("POSE_MAX_SKIP_S", "1.0"))) if threshold > 0 else None
+        )
+        self.skipped = 0
+        self._saved_ms = 0.0
+
+    def start(self) -> None:
+        with self._lock:
+            if not self.available:
+                return
+            self._running = True
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="pose-worker", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        self._running = False
+
+    def latest(self) -> Optional[dict]:
+        return self._latest
+
+    def stats(self) -> dict:
+        last = self._latest
+        return {
+            "available": self.available,
+            "running": self._running,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "last_seq": last["seq"] if last else None,
+            "inference_ms": round(self._infer_ms, 2),
+            "latency_ms": round(self._latency_ms, 2),
+            "skipped": self.skipped,
+            "skip_ratio": round(self.skipped / max(1, self.skipped + self.processed), 3),
+            "saved_ms": round(self._saved_ms, 1),
+            "motion_energy": round(self._gate.energy, 3) if self._gate is not None else None,
+            "estimator": self._estimator.stats() if hasattr(self._estimator, "stats") else None,
+        }
+
+    def _loop(self) -> None:
+        # L'estimatore viene creato nel thread del worker: niente grafo MediaPipe all'import
+        try:
+            estimator = self._estimator = self._factory()
+        except Exception:
+            self.available = False
+            self._running = False
+            return
+        last_seq = self._ring.seq
+        while self._running:
+            ref = self._ring.wait_next(last_seq, timeout=0.5)
+            if ref is None:
+                continue
+            seq, capture_ts, frame = ref
+            if last_seq and seq > last_seq + 1:
+                self.dropped += seq - last_seq - 1
+            last_seq = seq
+            latest = self._latest
+            if latest is not None and self._gate is not None and not self._gate.should_infer(frame, time.monotonic()):
+                # frame fermo: si riusa l'ultima analisi con seq e timestamp del nuovo frame
+                self.skipped += 1
+                self._saved_ms += self._infer_ms
+                self._publish(
+                    dict(
+                        latest,
+                        timestamp=datetime.fromtimestamp(capture_ts, timezone.utc).isoformat(),
+                        seq=seq,
+                        capture_ts=capture_ts,
+                    )
+                )
+                continue
+            t0 = time.perf_counter()
+            try:
+                kps, quality = estimator.process(frame)
+                t1 = time.perf_counter()
+                angles = estimator.derive_angles(kps)
+                symmetry = estimator.derive_symmetry(kps)
+            except Exception:
+                continue
+            t2 = time.perf_counter()
+            metrics.observe("inference", t1 - t0)
+            metrics.observe("angles", t2 - t1)
+            elapsed = (t2 - t0) * 1000.0
+            # media mobile esponenziale del tempo di inferenza
+            self._infer_ms = elapsed if not self.processed else 0.9 * self._infer_ms + 0.1 * elapsed
+            # latenza cattura -> risultato (attesa nel ring + inferenza)
+            latency = (time.time() - capture_ts) * 1000.0
+            self._latency_ms = latency if not self.processed else 0.9 * self._latency_ms + 0.1 * latency
+            self.processed += 1
+            self._publish(
+                {
+                    "keypoints": kps,
+                    "angles": angles,
+                    "symmetry": symmetry,
+                    "timestamp": datetime.fromtimestamp(capture_ts, timezone.utc).isoformat(),
+                    "frame_quality": quality,
+                    "seq": seq,
+                    "capture_ts": capture_ts,
+                }
+            )
+
+    def _publish(self, result: dict) -> None:
+        self._latest = result
+        if self._on_result is not None:
+            try:
+                self._on_result(result)
+            except Exception:
+                pass
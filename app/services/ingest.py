@@ -0,0 +1,338 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, List, Optional, Tuple
+
+import numpy as np
+
+from .capabilities import optional_import
+from .metrics import metrics
+from .recording import SessionRecorder, lock_recording, recording_path, remove_keyframes
+
+
+UPLOADS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "..", "data", "uploads")
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v", ".3gp")
+
+Chunk = Tuple[int, int, int]  # (warm_start, start, end) in indici di frame
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+# margine per intestazioni e altri campi di un corpo multipart
+MULTIPART_OVERHEAD = 1024 * 1024
+
+
+class MultipartFile:
+    """Parser multipart incrementale che conserva solo il campo `file`.
+
+    `feed` consuma un blocco del corpo; i byte del file restano in `pending`
+    finché il chiamante non li scrive su disco. Nulla viene accumulato in memoria
+    oltre il blocco corrente.
+    """
+
+    def __init__(self, content_type: str, field: str = "file") -> None:
+        from multipart.multipart import MultipartParser, parse_options_header
+
+        _, params = parse_options_header(content_type)
+        boundary = params.get(b"boundary")
+        if not boundary:
+            raise UploadError("Missing multipart boundary")
+        self.field = field
+        self.filename: Optional[str] = None
+        self.started = False
+        self.pending = bytearray()
+        self._parse_header = parse_options_header
+        self._in_file = False
+        self._header: List[bytes] = [b"", b""]
+        self._disposition = b""
+        self._parser = MultipartParser(
+            boundary,
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": lambda data, start, end: self._on_header(0, data[start:end]),
+                "on_header_value": lambda data, start, end: self._on_header(1, data[start:end]),
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+            },
+        )
+
+    def feed(self, chunk: bytes) -> None:
+        self._parser.write(chunk)
+
+    def _on_part_begin(self) -> None:
+        self._disposition = b""
+        self._header = [b"", b""]
+
+    def _on_header(self, i: int, data: bytes) -> None:
+        self._header[i] += data
+
+    def _on_header_end(self) -> None:
+        if self._header[0].lower() == b"content-disposition":
+            self._disposition = self._header[1]
+        self._header = [b"", b""]
+
+    def _on_headers_finished(self) -> None:
+        _, params = self._parse_header(self._disposition)
+        if not self.started and params.get(b"name", b"").decode("latin-1") == self.field:
+            self._in_file = self.started = True
+            self.filename = params.get(b"filename", b"").decode("utf-8", "replace") or None
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            self.pending += data[start:end]
+
+    def _on_part_end(self) -> None:
+        self._in_file = False
+
+
+async def save_upload(
+    chunks: AsyncIterator[bytes], content_type: str, visit_id: str, filename: str, max_bytes: int
+) -> Tuple[str, int]:
+    """Scrive su disco, mentre arriva, il video di un upload grezzo o multipart (campo `file`).
+
+    Il limite `max_bytes` vale durante la ricezione; le scritture girano in un
+    thread per non bloccare l'event loop. Restituisce percorso e byte del file.
+    """
+    multipart = MultipartFile(content_type) if content_type.startswith("multipart/form-data") else None
+    limit = max_bytes + (MULTIPART_OVERHEAD if multipart is not None else 0)
+    path: Optional[str] = None
+    f = None
+    received = size = 0
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            if received > limit:
+                raise UploadTooLarge()
+            if multipart is not None:
+                multipart.feed(chunk)
+                if not multipart.started:
+                    continue
+                data = bytes(multipart.pending)
+                multipart.pending.clear()
+            else:
+                data = chunk
+            if f is None:
+                path = upload_path(visit_id, (multipart.filename if multipart is not None else None) or filename)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = await asyncio.to_thread(open, path, "wb")
+            size += len(data)
+            if size > max_bytes:
+                raise UploadTooLarge()
+            if data:
+                await asyncio.to_thread(f.write, data)
+        if f is None and multipart is not None:
+            raise UploadError("Missing file field")
+        if not size:
+            raise UploadError("Empty upload")
+    except BaseException:
+        if f is not None:
+            f.close()
+            os.remove(path)
+        raise
+    await asyncio.to_thread(f.close)
+    return path, size
+
+
+def upload_path(visit_id: str, filename: str) -> str:
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext not in VIDEO_EXTENSIONS:
+        ext = ".mp4"
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}{ext}"
+    return os.path.abspath(os.path.join(UPLOADS_DIR, visit_id, name))
+
+
+def probe_video(path: str) -> dict:
+    """Numero di frame, fps e risoluzione (conteggio esplicito se il container non lo dichiara)."""
+    cv2 = optional_import("cv2")
+    if cv2 is None:
+        raise RuntimeError("OpenCV non disponibile")
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise ValueError("video non leggibile")
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if frames <= 0:
+            frames = 0
+            while cap.grab():
+                frames += 1
+    finally:
+        cap.release()
+    if not frames:
+        raise ValueError("video senza frame")
+    # alcuni telefoni scrivono fps nulli o assurdi nel container
+    if not fps or not math.isfinite(fps) or fps > 240:
+        fps = 30.0
+    return {"frames": frames, "fps": float(fps), "width": width, "height": height}
+
+
+def plan_chunks(frames: int, fps: float, chunk_s: float, overlap_s: float) -> List[Chunk]:
+    """Divide il video in blocchi da `chunk_s` secondi.
+
+    Ogni blocco parte `overlap_s` secondi prima del proprio inizio: quei frame
+    servono solo a scaldare il tracking temporale (MediaPipe + ROI) e vengono
+    scartati, così i punti di giunzione non perdono qualità.
+    """
+    size = max(1, int(round(chunk_s * fps)))
+    warm = max(0, int(round(overlap_s * fps)))
+    return [(max(0, start - warm), start, min(frames, start + size)) for start in range(0, frames, size)]
+
+
+def _open_at(path: str, index: int):
+    cv2 = optional_import("cv2")
+    cap = cv2.VideoCapture(path)
+    if index and cap.isOpened():
+        cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+        if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != index:
+            # seek non accurato per questo codec: si riparte e si avanza senza decodificare in RGB
+            cap.release()
+            cap = cv2.VideoCapture(path)
+            for _ in range(index):
+                if not cap.grab():
+                    break
+    return cap
+
+
+def extract_chunk(path: str, chunk: Chunk, stride: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float]:
+    """Pose dei frame `[start, end)` di un blocco; eseguita in un processo del pool.
+
+    Un `PoseEstimator` nuovo per blocco: lo stato di tracking non deve passare
+    da un blocco all'altro, ci pensa la sovrapposizione.
+    """
+    from .pose import PoseEstimator
+
+    warm_start, start, end = chunk
+    estimator = PoseEstimator()
+    cap = _open_at(path, warm_start)
+    indices: List[int] = []
+    keypoints: List[np.ndarray] = []
+    quality: List[float] = []
+    t0 = time.perf_counter()
+    try:
+        index = warm_start
+        while index < end:
+            ok = cap.grab()
+            if not ok:
+                break
+            if index % stride == 0:
+                ok, frame = cap.retrieve()
+                if not ok:
+                    break
+                kps, q = estimator.process(frame)
+                if index >= start:
+                    indices.append(index)
+                    keypoints.append(kps)
+                    quality.append(q)
+            index += 1
+    finally:
+        cap.release()
+    kps_arr = np.stack(keypoints) if keypoints else np.zeros((0, 33, 4), dtype=np.float32)
+    return np.asarray(indices, dtype=np.int64), kps_arr, np.asarray(quality, dtype=np.float32), time.perf_counter() - t0
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def video_pool() -> ProcessPoolExecutor:
+    # Pool separato da quello dei job: un processo per core, ognuno col proprio MediaPipe
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            workers = int(os.getenv("VIDEO_WORKERS", "0")) or os.cpu_count() or 2
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _write_recording(visit_id: str, info: dict, path: str, parts: List[tuple]) -> int:
+    # con il lock di scrittura della visita: nessun recorder live sul file sostituito
+    tmp = recording_path(visit_id) + ".ingest"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    # ts epoch come la cattura live: il video parte all'istante dell'upload
+    base_ts = os.path.getmtime(path)
+    rec = SessionRecorder(
+        visit_id,
+        info["width"],
+        info["height"],
+        path=tmp,
+        extra_meta={"source": "video", "fps": info["fps"], "video": os.path.basename(path), "base_ts": base_ts},
+    )
+    written = 0
+    for indices, kps, quality, _ in parts:
+        for idx, k, q in zip(indices.tolist(), kps, quality.tolist()):
+            # seq 1-based: indice del frame nel video
+            rec.append(idx + 1, base_ts + idx / info["fps"], k, q)
+        written += rec.flush()
+    rec.close()
+    os.replace(tmp, recording_path(visit_id))
+    remove_keyframes(visit_id)
+    return written
+
+
+def ingest_video_job(ctx, visit_id: str, path: str, stride: int = 1) -> dict:
+    """Job: video caricato -> registrazione della visita (stesso formato della cattura live)."""
+    started = time.perf_counter()
+    ctx.report(0.01, "probing")
+    info = probe_video(path)
+    chunks = plan_chunks(
+        info["frames"],
+        info["fps"],
+        float(os.getenv("VIDEO_CHUNK_S", "10")),
+        float(os.getenv("VIDEO_OVERLAP_S", "1")),
+    )
+
+    ctx.report(0.05, "extracting")
+    parts: List[Optional[tuple]] = [None] * len(chunks)
+    done_frames = 0
+    worker_s = 0.0
+    for i, result in ctx.map_in_process(extract_chunk, [(path, c, stride) for c in chunks], video_pool()):
+        parts[i] = result
+        worker_s += result[3]
+        done_frames += chunks[i][2] - chunks[i][1]
+        ctx.report(0.05 + 0.85 * done_frames / info["frames"], f"extracting {sum(p is not None for p in parts)}/{len(chunks)}")
+
+    # ricucitura: i blocchi non si sovrappongono nei frame restituiti, basta l'ordine
+    ctx.report(0.92, "writing")
+    lock_fd = lock_recording(visit_id)
+    if lock_fd is None:
+        raise RuntimeError("visita in registrazione live su un altro worker")
+    try:
+        written = _write_recording(visit_id, info, path, parts)
+    finally:
+        os.close(lock_fd)
+
+    elapsed = time.perf_counter() - started
+    duration = info["frames"] / info["fps"]
+    metrics.observe("video_ingest", elapsed)
+    return {
+        "visit_id": visit_id,
+        "frames": written,
+        "video_frames": info["frames"],
+        "fps": round(info["fps"], 3),
+        "duration_s": round(duration, 3),
+        "chunks": len(chunks),
+        "stride": stride,
+        "elapsed_s": round(elapsed, 3),
+        "realtime_factor": round(duration / elapsed, 2) if elapsed else None,
+        # somma dei tempi dei blocchi: / elapsed_s = parallelismo effettivo
+        "worker_s": round(worker_s, 3),
+    }
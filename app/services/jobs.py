@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+ACTIVE = ("queued", "running")
+
+
+class Job:
+    def __init__(self, kind: str, key: str, visit_id: Optional[str] = None) -> None:
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.visit_id = visit_id
+        self.status = "queued"
+        self.progress = 0.0
+        self.stage = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.cancel_requested = False
+        self._child: Optional[Future] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "key": self.key,
+            "visit_id": self.visit_id,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "stage": self.stage,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobContext:
+    """Handle passato alla funzione del job: progress, cancellazione e process pool."""
+
+    def __init__(self, queue: "JobQueue", job: Job) -> None:
+        self._queue = queue
+        self.job = job
+
+    def report(self, progress: float, stage: str) -> None:
+        self.check_cancelled()
+        self.job.progress = max(0.0, min(1.0, progress))
+        self.job.stage = stage
+
+    def check_cancelled(self) -> None:
+        if self.job.cancel_requested:
+            raise JobCancelled()
+
+    def run_in_process(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Esegue `fn` nel process pool condiviso e ne attende il risultato."""
+        self.check_cancelled()
+        fut = self._queue.process_pool().submit(fn, *args)
+        self.job._child = fut
+        try:
+            result = fut.result()
+        finally:
+            self.job._child = None
+        self.check_cancelled()
+        return result
+
+    def map_in_process(
+        self, fn: Callable[..., Any], items: Sequence[tuple], executor: Optional[Executor] = None
+    ) -> Iterator[Tuple[int, Any]]:
+        """Esegue `fn(*item)` in parallelo e restituisce `(indice, risultato)` man mano che finiscono.
+
+        Su cancellazione i task non ancora partiti vengono annullati; un errore
+        in un task annulla gli altri e si propaga al job.
+        """
+        self.check_cancelled()
+        pool = executor or self._queue.process_pool()
+        futures = {pool.submit(fn, *item): i for i, item in enumerate(items)}
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                self.check_cancelled()
+                for fut in done:
+                    yield futures[fut], fut.result()
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+
+class JobQueue:
+    """Coda di job con concorrenza limitata e deduplicazione per chiave.
+
+    Ogni job gira in un thread coordinatore (max `concurrency` insieme) che
+    delega il lavoro CPU-bound a un `ProcessPoolExecutor` condiviso. Un
+    secondo submit con la stessa chiave mentre il job è attivo restituisce il
+    job esistente.
+    """
+
+    def __init__(
+        self,
+        concurrency: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        retention: int = 500,
+    ) -> None:
+        self.concurrency = concurrency or int(os.getenv("JOB_CONCURRENCY", "2"))
+        self.max_pending = max_pending or int(os.getenv("JOB_MAX_PENDING", "32"))
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._by_key: Dict[str, str] = {}
+        self._threads = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="job")
+        self._procs: Optional[ProcessPoolExecutor] = None
+        self._listeners: List[Callable[[Job], None]] = []
+        self._initializer: Optional[Callable[[], None]] = None
+
+    def set_process_initializer(self, fn: Callable[[], None]) -> None:
+        self._initializer = fn
+
+    def add_listener(self, fn: Callable[[Job], None]) -> None:
+        if fn not in self._listeners:
+            self._listeners.append(fn)
+
+    def process_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._procs is None:
+                # spawn: i worker non ereditano thread di cattura né socket aperti
+                self._procs = ProcessPoolExecutor(
+                    max_workers=self.concurrency,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self._initializer,
+                )
+            return self._procs
+
+    def submit(
+        self,
+        kind: str,
+        key: str,
+        fn: Callable[..., Any],
+        *args: Any,
+        visit_id: Optional[str] = None,
+    ) -> Tuple[Job, bool]:
+        with self._lock:
+            existing = self._jobs.get(self._by_key.get(key, ""))
+            if existing is not None and existing.status in ACTIVE:
+                return existing, False
+            active = sum(1 for j in self._jobs.values() if j.status in ACTIVE)
+            if active >= self.max_pending:
+                raise QueueFull(f"troppi job in coda ({active})")
+            job = Job(kind, key, visit_id)
+            self._jobs[job.id] = job
+            self._by_key[key] = job.id
+            self._prune()
+        self._threads.submit(self._run, job, fn, args)
+        return job, True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def find(self, key: str) -> Optional[Job]:
+        return self._jobs.get(self._by_key.get(key, ""))
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is None or job.status not in ACTIVE:
+            return job
+        job.cancel_requested = True
+        child = job._child
+        if child is not None:
+            # efficace solo se il task non è ancora partito nel process pool
+            child.cancel()
+        if job.status == "queued":
+            self._finish(job, "cancelled")
+        return job
+
+    def stats(self) -> dict:
+        counts: Dict[str, int] = {}
+        for j in list(self._jobs.values()):
+            counts[j.status] = counts.get(j.status, 0) + 1
+        return {"concurrency": self.concurrency, "max_pending": self.max_pending, "jobs": counts}
+
+    def _run(self, job: Job, fn: Callable[..., Any], args: tuple) -> None:
+        with self._lock:
+            if job.status != "queued":
+                return
+            job.status = "running"
+            job.started_at = time.time()
+        ctx = JobContext(self, job)
+        try:
+            ctx.check_cancelled()
+            job.result = fn(ctx, *args)
+            job.progress = 1.0
+            self._finish(job, "completed")
+        except JobCancelled:
+            self._finish(job, "cancelled")
+        except Exception as exc:
+            if job.cancel_requested:
+                self._finish(job, "cancelled")
+            else:
+                job.error = str(exc) or exc.__class__.__name__
+                self._finish(job, "failed")
+
+    def _finish(self, job: Job, status: str) -> None:
+        with self._lock:
+            if job.status not in ACTIVE:
+                return
+            job.status = status
+            job.stage = status
+            job.finished_at = time.time()
+        for fn in list(self._listeners):
+            try:
+                fn(job)
+            except Exception:
+                pass
+
+    def _prune(self) -> None:
+        # conserva solo gli ultimi `retention` job conclusi
+        done = [j for j in self._jobs.values() if j.status not in ACTIVE]
+        for j in sorted(done, key=lambda j: j.created_at)[: max(0, len(done) - self.retention)]:
+            self._jobs.pop(j.id, None)
+            if self._by_key.get(j.key) == j.id:
+                self._by_key.pop(j.key, None)
+
+
+jobs = JobQueue()
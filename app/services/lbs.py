@@ -0,0 +1,382 @@
+from __future__ import annotations
+
+import glob
+import os
+import pickle
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .mesh import Mesh
+
+
+NUM_JOINTS = 24
+POSE_DIM = NUM_JOINTS * 3
+DEFAULT_CHUNK = 64  # frame per blocco: (chunk, 6890, 12) float32 ~ 21 MB di trasformazioni
+
+GENDER_ALIASES = {"NEUTRAL": ("neutral",), "MALE": ("_m_", "male"), "FEMALE": ("_f_", "female")}
+
+
+class _ChumpyStub:
+    """Sostituto degli oggetti chumpy nei pickle SMPL ufficiali: conserva solo lo stato."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.args = args
+
+    def __setstate__(self, state) -> None:
+        if isinstance(state, dict):
+            self.__dict__.update(state)
+        else:
+            self.state = state
+
+
+class _SmplUnpickler(pickle.Unpickler):
+    def find_class(self, module: str, name: str):
+        if module.split(".")[0] == "chumpy":
+            return _ChumpyStub
+        return super().find_class(module, name)
+
+
+def _as_array(value) -> np.ndarray:
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return value
+    if isinstance(value, np.ndarray):  # npz: matrice sparsa salvata come oggetto
+        value = value.item()
+    if isinstance(value, _ChumpyStub):
+        for key in ("x", "a", "r"):
+            if key in value.__dict__:
+                return _as_array(value.__dict__[key])
+        if value.args:
+            return _as_array(value.args[0])
+        raise ValueError("oggetto chumpy senza dati")
+    if hasattr(value, "toarray"):  # scipy.sparse (J_regressor)
+        return value.toarray()
+    return np.asarray(value)
+
+
+def load_model_file(path: str) -> Dict[str, np.ndarray]:
+    """Array SMPL da `.npz` o dal `.pkl` ufficiale (Python 2, chumpy, J_regressor sparso).
+
+    Il pickle con regressore sparso richiede scipy installato; il `.npz`
+    prodotto da `convert` no.
+    """
+    if path.endswith(".npz"):
+        with np.load(path, allow_pickle=True) as data:
+            raw = {k: data[k] for k in data.files}
+    else:
+        with open(path, "rb") as f:
+            raw = _SmplUnpickler(f, encoding="latin1").load()
+    keys = ("v_template", "shapedirs", "posedirs", "J_regressor", "weights", "kintree_table", "f")
+    missing = [k for k in keys if k not in raw]
+    if missing:
+        raise ValueError(f"modello SMPL incompleto, mancano: {', '.join(missing)}")
+    return {k: _as_array(raw[k]) for k in keys}
+
+
+def find_model_file(model_dir: Optional[str], gender: str = "NEUTRAL") -> Optional[str]:
+    """Stessa struttura di smplx (`<dir>/smpl/SMPL_<GENDER>.npz|pkl`) o nomi ufficiali `basicModel_*`."""
+    if not model_dir:
+        return None
+    gender = gender.upper()
+    for folder in (os.path.join(model_dir, "smpl"), model_dir):
+        for ext in ("npz", "pkl"):
+            path = os.path.join(folder, f"SMPL_{gender}.{ext}")
+            if os.path.isfile(path):
+                return path
+        for path in sorted(glob.glob(os.path.join(folder, "basic*odel*.pkl"))):
+            name = os.path.basename(path).lower()
+            if any(alias in name for alias in GENDER_ALIASES.get(gender, ())):
+                return path
+    return None
+
+
+def rodrigues(rot_vecs: np.ndarray) -> np.ndarray:
+    """Asse-angolo (..., 3) -> matrici di rotazione (..., 3, 3), come `batch_rodrigues` di smplx."""
+    rot_vecs = np.asarray(rot_vecs)
+    if rot_vecs.dtype != np.float64:
+        rot_vecs = rot_vecs.astype(np.float32)
+    angle = np.linalg.norm(rot_vecs + 1e-8, axis=-1, keepdims=True)
+    x, y, z = np.moveaxis(rot_vecs / angle, -1, 0)
+    zero = np.zeros_like(x)
+    k = np.stack([zero, -z, y, z, zero, -x, -y, x, zero], axis=-1).reshape(rot_vecs.shape[:-1] + (3, 3))
+    sin = np.sin(angle)[..., None]
+    cos = np.cos(angle)[..., None]
+    return np.eye(3, dtype=rot_vecs.dtype) + sin * k + (1.0 - cos) * (k @ k)
+
+
+class SmplLbs:
+    """Modello SMPL in NumPy puro: `forward` genera vertici per batch di pose `(T, 72)`.
+
+    Nessun import di torch/smplx: i pesi si leggono una volta dal pickle
+    ufficiale o dalla sua conversione `.npz`. Le parti dipendenti solo dalla
+    forma sono fattorizzate: i giunti a riposo si ottengono dai beta con
+    `J_regressor` già applicato a template e shape dirs, senza passare dai
+    6890 vertici.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray], path: Optional[str] = None) -> None:
+        self.path = path
+        v_template = arrays["v_template"].astype(np.float32)
+        shapedirs = arrays["shapedirs"].astype(np.float32)
+        posedirs = arrays["posedirs"].astype(np.float32)
+        j_regressor = arrays["J_regressor"].astype(np.float32)
+        self.num_vertices = len(v_template)
+        self.num_betas = shapedirs.shape[-1]
+        self.v_template = v_template
+        self.shapedirs = shapedirs.reshape(-1, self.num_betas)  # (V*3, B)
+        self.posedirs = posedirs.reshape(-1, posedirs.shape[-1]).T.copy()  # (207, V*3)
+        self.j_template = j_regressor @ v_template  # (24, 3)
+        self.j_shapedirs = np.einsum("jv,vcb->jcb", j_regressor, shapedirs).reshape(-1, self.num_betas)
+        self.weights = arrays["weights"].astype(np.float32)  # (V, 24)
+        self.parents = arrays["kintree_table"][0].astype(np.int64)
+        self.parents[0] = -1
+        self.faces = arrays["f"].astype(np.int64)
+        self.load_ms = 0.0
+
+    @classmethod
+    def from_smplx(cls, model) -> "SmplLbs":
+        # Stessi pesi di un modello smplx già caricato (backend torch): niente secondo file
+        num_vertices = model.v_template.shape[0]
+        return cls(
+            {
+                "v_template": model.v_template.detach().cpu().numpy(),
+                "shapedirs": model.shapedirs.detach().cpu().numpy(),
+                "posedirs": model.posedirs.detach().cpu().numpy().T.reshape(num_vertices, 3, -1),
+                "J_regressor": model.J_regressor.detach().cpu().numpy(),
+                "weights": model.lbs_weights.detach().cpu().numpy(),
+                "kintree_table": np.stack([model.parents.detach().cpu().numpy(), np.arange(NUM_JOINTS)]),
+                "f": np.asarray(model.faces),
+            }
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "SmplLbs":
+        t0 = time.perf_counter()
+        model = cls(load_model_file(path), path)
+        model.load_ms = (time.perf_counter() - t0) * 1000.0
+        return model
+
+    @property
+    def memory_bytes(self) -> int:
+        arrays = (self.v_template, self.shapedirs, self.posedirs, self.j_template, self.j_shapedirs, self.weights)
+        return sum(a.nbytes for a in arrays)
+
+    def _betas(self, betas: Optional[np.ndarray], frames: int) -> np.ndarray:
+        out = np.zeros((frames, self.num_betas), dtype=np.float32)
+        if betas is not None:
+            betas = np.asarray(betas, dtype=np.float32)
+            betas = np.broadcast_to(betas, (frames,) + betas.shape[-1:])
+            n = min(betas.shape[-1], self.num_betas)
+            out[:, :n] = betas[:, :n]
+        return out
+
+    def iter_forward(
+        self,
+        poses: np.ndarray,
+        betas: Optional[np.ndarray] = None,
+        transl: Optional[np.ndarray] = None,
+        chunk: int = DEFAULT_CHUNK,
+    ) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """Come `forward`, a blocchi di `chunk` frame: (inizio, vertici, giunti) senza tenere tutto in memoria."""
+        poses = np.asarray(poses, dtype=np.float32).reshape(-1, POSE_DIM)
+        frames = len(poses)
+        shared = betas is None or np.asarray(betas).ndim == 1
+        betas = self._betas(betas, frames)
+        transl = np.zeros((frames, 3), np.float32) if transl is None else np.broadcast_to(
+            np.asarray(transl, dtype=np.float32), (frames, 3)
+        )
+        if shared:
+            # stessa forma per tutta la sequenza (caso tipico dell'animazione): calcolata una volta
+            v_shaped_one = self.v_template + (self.shapedirs @ betas[0]).reshape(-1, 3)
+            j_rest_one = self.j_template + (self.j_shapedirs @ betas[0]).reshape(-1, 3)
+        for start in range(0, frames, max(1, chunk)):
+            end = min(frames, start + max(1, chunk))
+            n = end - start
+            if shared:
+                v_shaped = np.broadcast_to(v_shaped_one, (n,) + v_shaped_one.shape)
+                j_rest = np.broadcast_to(j_rest_one, (n,) + j_rest_one.shape)
+            else:
+                b = betas[start:end]
+                v_shaped = self.v_template + (b @ self.shapedirs.T).reshape(n, -1, 3)
+                j_rest = self.j_template + (b @ self.j_shapedirs.T).reshape(n, -1, 3)
+            verts, joints = self._skin(poses[start:end], v_shaped, j_rest)
+            yield start, verts + transl[start:end, None, :], joints + transl[start:end, None, :]
+
+    def forward(
+        self,
+        poses: np.ndarray,
+        betas: Optional[np.ndarray] = None,
+        transl: Optional[np.ndarray] = None,
+        chunk: int = DEFAULT_CHUNK,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Vertici `(T, V, 3)` e giunti `(T, 24, 3)` per pose `(T, 72)` e beta `(T, 10)` o `(10,)`."""
+        poses = np.asarray(poses, dtype=np.float32).reshape(-1, POSE_DIM)
+        verts = np.empty((len(poses), self.num_vertices, 3), dtype=np.float32)
+        joints = np.empty((len(poses), NUM_JOINTS, 3), dtype=np.float32)
+        for start, v, j in self.iter_forward(poses, betas, transl, chunk):
+            verts[start : start + len(v)] = v
+            joints[start : start + len(j)] = j
+        return verts, joints
+
+    def _skin(self, poses: np.ndarray, v_shaped: np.ndarray, j_rest: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        n = len(poses)
+        rot = rodrigues(poses.reshape(n, NUM_JOINTS, 3))  # (n, 24, 3, 3)
+        # correttivi di posa: (R - I) dei 23 giunti non radice, un solo GEMM per il blocco
+        pose_feature = (rot[:, 1:] - np.eye(3, dtype=np.float32)).reshape(n, -1)
+        v_posed = v_shaped + (pose_feature @ self.posedirs).reshape(n, -1, 3)
+
+        g_rot, g_t = self._chain(rot, j_rest)
+        joints = g_t.copy()
+
+        # trasformazioni relative alla posa di riposo, in forma 3x4, fuse con i pesi di skinning
+        rel_t = g_t - np.einsum("njik,njk->nji", g_rot, j_rest)
+        transforms = np.concatenate([g_rot, rel_t[..., None]], axis=-1).reshape(n, NUM_JOINTS, 12)
+        blended = (self.weights @ transforms).reshape(n, -1, 3, 4)  # (n, V, 3, 4)
+        verts = np.einsum("nvij,nvj->nvi", blended[..., :3], v_posed) + blended[..., 3]
+        return verts.astype(np.float32, copy=False), joints
+
+    def _chain(self, rot: np.ndarray, j_rest: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # catena cinematica: ciclo sui 24 giunti, vettoriale sui frame
+        n = len(rot)
+        rel = np.array(np.broadcast_to(j_rest, (n, NUM_JOINTS, 3)), dtype=rot.dtype)
+        rel[:, 1:] -= rel[:, self.parents[1:]].copy()
+        g_rot = np.empty_like(rot)
+        g_t = np.empty((n, NUM_JOINTS, 3), dtype=rot.dtype)
+        g_rot[:, 0] = rot[:, 0]
+        g_t[:, 0] = rel[:, 0]
+        for i in range(1, NUM_JOINTS):
+            p = self.parents[i]
+            g_rot[:, i] = g_rot[:, p] @ rot[:, i]
+            g_t[:, i] = (g_rot[:, p] @ rel[:, i, :, None])[..., 0] + g_t[:, p]
+        return g_rot, g_t
+
+    def rest_joints(self, betas: Optional[np.ndarray] = None) -> np.ndarray:
+        """Giunti a riposo `(24, 3)` (o `(T, 24, 3)` per beta `(T, B)`), senza calcolare i vertici."""
+        j_template = self.j_template.astype(np.float64)
+        if betas is None:
+            return j_template
+        betas = np.asarray(betas, dtype=np.float64)
+        n = min(betas.shape[-1], self.num_betas)
+        offsets = betas[..., :n] @ self.j_shapedirs[:, :n].T.astype(np.float64)
+        return j_template + offsets.reshape(betas.shape[:-1] + (NUM_JOINTS, 3))
+
+    def posed_joints(self, poses: np.ndarray, j_rest: np.ndarray) -> np.ndarray:
+        """Solo cinematica diretta: giunti `(N, 24, 3)` per pose `(N, 72)`, in float64 se le pose lo sono.
+
+        È la parte usata dal fitting, che valuta migliaia di pose perturbate per iterazione.
+        """
+        poses = np.asarray(poses)
+        rot = rodrigues(poses.reshape(len(poses), NUM_JOINTS, 3))
+        return self._chain(rot, j_rest)[1]
+
+    def neutral_mesh(self) -> Mesh:
+        verts, _ = self.forward(np.zeros((1, POSE_DIM), np.float32))
+        return Mesh(verts[0], self.faces)
+
+
+class LbsRegistry:
+    """Cache di processo dei modelli NumPy, uno per genere (solo SMPL, 24 giunti)."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._models: Dict[str, SmplLbs] = {}
+        self.error: Optional[str] = None
+
+    @property
+    def model_dir(self) -> str:
+        return os.getenv("SMPL_MODEL_DIR") or os.path.abspath("models")
+
+    def model_file(self, gender: str = "NEUTRAL") -> Optional[str]:
+        return find_model_file(self.model_dir, gender)
+
+    @property
+    def available(self) -> bool:
+        return bool(self._models) or self.model_file() is not None
+
+    def get(self, gender: str = "NEUTRAL") -> SmplLbs:
+        gender = gender.upper()
+        model = self._models.get(gender)
+        if model is not None:
+            return model
+        with self._lock:
+            model = self._models.get(gender)
+            if model is None:
+                path = self.model_file(gender)
+                if path is None:
+                    raise RuntimeError(f"modello SMPL {gender} non trovato in {self.model_dir}")
+                model = SmplLbs.load(path)
+                self._models[gender] = model
+        return model
+
+    def warmup(self, genders: Optional[List[str]] = None) -> None:
+        try:
+            for gender in genders or ["NEUTRAL"]:
+                if self.model_file(gender) is not None:
+                    self.get(gender)
+        except Exception as exc:
+            self.error = str(exc)
+
+    def status(self) -> dict:
+        # Nessun accesso al disco: la disponibilità è nel probe delle capabilities
+        return {
+            "loaded": [
+                {
+                    "gender": g,
+                    "path": m.path,
+                    "load_ms": round(m.load_ms, 1),
+                    "memory_mb": round(m.memory_bytes / (1024 * 1024), 2),
+                }
+                for g, m in self._models.items()
+            ],
+            "error": self.error,
+        }
+
+
+lbs_registry = LbsRegistry()
+
+
+def _check(frames: int, gender: str) -> None:
+    # Confronto con smplx/torch sugli stessi pesi: pose e forme casuali
+    from .smpl import model_registry
+
+    engine = lbs_registry.get(gender)
+    entry = model_registry.get("smpl", gender)
+    torch = model_registry._torch  # type: ignore
+    rng = np.random.default_rng(0)
+    poses = rng.normal(0.0, 0.4, size=(frames, POSE_DIM)).astype(np.float32)
+    betas = rng.normal(0.0, 1.0, size=(frames, engine.num_betas)).astype(np.float32)
+    t0 = time.perf_counter()
+    verts, joints = engine.forward(poses, betas)
+    numpy_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    expected = []
+    with torch.no_grad():
+        for i in range(frames):
+            out = entry.model(
+                betas=torch.from_numpy(betas[i : i + 1]),
+                global_orient=torch.from_numpy(poses[i : i + 1, :3]),
+                body_pose=torch.from_numpy(poses[i : i + 1, 3:]),
+                pose2rot=True,
+            )
+            expected.append((out.vertices[0].numpy(), out.joints[0, :NUM_JOINTS].numpy()))
+    torch_s = time.perf_counter() - t0
+    dv = max(float(np.abs(verts[i] - v).max()) for i, (v, _) in enumerate(expected))
+    dj = max(float(np.abs(joints[i] - j).max()) for i, (_, j) in enumerate(expected))
+    print(f"frames={frames} max|dv|={dv:.2e} m max|dj|={dj:.2e} m")
+    print(f"numpy {numpy_s * 1000 / frames:.2f} ms/frame, torch {torch_s * 1000 / frames:.2f} ms/frame")
+
+
+if __name__ == "__main__":
+    # python -m app.services.lbs convert SMPL_NEUTRAL.pkl SMPL_NEUTRAL.npz -> niente chumpy/scipy a runtime
+    # python -m app.services.lbs check [frames]                            -> confronto con smplx/torch
+    if sys.argv[1:2] == ["convert"] and len(sys.argv) == 4:
+        arrays = load_model_file(sys.argv[2])
+        np.savez(sys.argv[3], **arrays)
+        print(", ".join(f"{k}{v.shape}" for k, v in arrays.items()))
+    elif sys.argv[1:2] == ["check"]:
+        _check(int(sys.argv[2]) if len(sys.argv) > 2 else 16, "NEUTRAL")
+    else:
+        print("usage: python -m app.services.lbs convert SRC.pkl DST.npz | check [frames]")
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+import struct
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+class Mesh:
+    __slots__ = ("vertices", "faces")
+
+    def __init__(self, vertices, faces) -> None:
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float32).reshape(-1, 3)
+        faces = np.asarray(faces, dtype=np.int64)
+        self.faces = faces.reshape(len(faces), -1)
+
+    def triangles(self) -> np.ndarray:
+        """Facce triangolate (fan), necessarie per glTF/PLY."""
+        k = self.faces.shape[1]
+        if k == 3:
+            return self.faces.astype(np.uint32)
+        tris = [self.faces[:, [0, i, i + 1]] for i in range(1, k - 1)]
+        return np.stack(tris, axis=1).reshape(-1, 3).astype(np.uint32)
+
+
+def cube_mesh() -> Mesh:
+    vertices = [
+        [-0.5, -0.5, -0.5],
+        [0.5, -0.5, -0.5],
+        [0.5, 0.5, -0.5],
+        [-0.5, 0.5, -0.5],
+        [-0.5, -0.5, 0.5],
+        [0.5, -0.5, 0.5],
+        [0.5, 0.5, 0.5],
+        [-0.5, 0.5, 0.5],
+    ]
+    faces = [
+        [0, 1, 2, 3],
+        [4, 5, 6, 7],
+        [0, 4, 7, 3],
+        [1, 5, 6, 2],
+        [3, 2, 6, 7],
+        [0, 1, 5, 4],
+    ]
+    return Mesh(vertices, faces)
+
+
+def to_obj(mesh: Mesh, name: str = "SMPL") -> bytes:
+    # Formattazione in blocco: un solo '%' per tutti i vertici e uno per le facce
+    v = mesh.vertices
+    f = mesh.faces + 1  # OBJ usa indici 1-based
+    k = f.shape[1]
+    head = f"# {name} mesh\no {name}\n"
+    verts = ("v %.6f %.6f %.6f\n" * len(v)) % tuple(v.ravel().tolist())
+    faces = (("f" + " %d" * k + "\n") * len(f)) % tuple(f.ravel().tolist())
+    return (head + verts + faces).encode("ascii")
+
+
+def to_ply(mesh: Mesh) -> bytes:
+    tris = mesh.triangles()
+    header = (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        f"element vertex {len(mesh.vertices)}\n"
+        "property float x\nproperty float y\nproperty float z\n"
+        f"element face {len(tris)}\n"
+        "property list uchar int vertex_indices\n"
+        "end_header\n"
+    ).encode("ascii")
+    face_rec = np.empty(len(tris), dtype=[("n", "u1"), ("idx", "<i4", (3,))])
+    face_rec["n"] = 3
+    face_rec["idx"] = tris
+    return header + mesh.vertices.astype("<f4").tobytes() + face_rec.tobytes()
+
+
+def to_glb(mesh: Mesh) -> bytes:
+    positions = mesh.vertices.astype("<f4").tobytes()
+    tris = mesh.triangles()
+    indices = tris.astype("<u4").tobytes()
+    pos_len = len(positions)
+    gltf = {
+        "asset": {"version": "2.0", "generator": "physioplus-backend"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1, "mode": 4}]}],
+        "buffers": [{"byteLength": pos_len + len(indices)}],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": pos_len, "target": 34962},
+            {"buffer": 0, "byteOffset": pos_len, "byteLength": len(indices), "target": 34963},
+        ],
+        "accessors": [
+            {
+                "bufferView": 0,
+                "componentType": 5126,  # FLOAT
+                "count": len(mesh.vertices),
+                "type": "VEC3",
+                "min": mesh.vertices.min(axis=0).tolist(),
+                "max": mesh.vertices.max(axis=0).tolist(),
+            },
+            {"bufferView": 1, "componentType": 5125, "count": int(tris.size), "type": "SCALAR"},  # UINT
+        ],
+    }
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    bin_chunk = positions + indices
+    bin_chunk += b"\x00" * (-len(bin_chunk) % 4)
+    total = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+    return b"".join(
+        [
+            struct.pack("<4sII", b"glTF", 2, total),
+            struct.pack("<I4s", len(json_chunk), b"JSON"),
+            json_chunk,
+            struct.pack("<I4s", len(bin_chunk), b"BIN\x00"),
+            bin_chunk,
+        ]
+    )
+
+
+MESH_FORMATS: Dict[str, Tuple[str, object]] = {
+    # estensione -> (media type, writer)
+    "obj": ("text/plain", to_obj),
+    "glb": ("model/gltf-binary", to_glb),
+    "ply": ("application/octet-stream", to_ply),
+}
+
+
+def write_gzip(path: str, data: bytes) -> None:
+    """Scrive `data` gzip in modo atomico (tmp + rename), mtime fisso per ETag stabili."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6, mtime=0) as gz:
+            gz.write(data)
+    os.replace(tmp, path)
+
+
+_etag_cache: Dict[Tuple[str, int, int], str] = {}
+
+
+def file_etag(path: str) -> Optional[str]:
+    # Hash del contenuto, calcolato una volta per (path, mtime, size)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_mtime_ns, st.st_size)
+    tag = _etag_cache.get(key)
+    if tag is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+        tag = h.hexdigest()[:32]
+        _etag_cache[key] = tag
+    return tag
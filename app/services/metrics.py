@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+# Limiti superiori dei bucket (secondi): da 0.5 ms (encode, serialize) a 60 s (finalize)
+BUCKETS_S: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+# Stadi noti, esportati anche senza osservazioni (serie stabili per le dashboard)
+STAGES: Tuple[str, ...] = (
+    "capture",
+    "inference",
+    "angles",
+    "encode",
+    "serialize",
+    "send",
+    "end_to_end",
+    "finalize",
+    "smpl_forward",
+    "smpl_fit",
+    "video_ingest",
+)
+
+Exported = Dict[str, Tuple[List[int], float, int]]
+
+
+class Histogram:
+    """Istogramma a bucket fissi: `observe` è una bisezione e tre somme sotto lock."""
+
+    __slots__ = ("counts", "sum", "count", "_lock")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS_S) + 1)  # ultimo = +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        i = bisect_left(BUCKETS_S, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def export(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+def _add(a: Tuple[List[int], float, int], b: Tuple[List[int], float, int]) -> Tuple[List[int], float, int]:
+    return [x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]
+
+
+def _empty() -> Tuple[List[int], float, int]:
+    return [0] * (len(BUCKETS_S) + 1), 0.0, 0
+
+
+def quantile(counts: List[int], q: float) -> Optional[float]:
+    """Stima del quantile per interpolazione lineare nel bucket (come histogram_quantile)."""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, n in enumerate(counts):
+        if seen + n >= rank and n:
+            if i == len(BUCKETS_S):
+                return BUCKETS_S[-1]
+            lower = BUCKETS_S[i - 1] if i else 0.0
+            return lower + (BUCKETS_S[i] - lower) * (rank - seen) / n
+        seen += n
+    return BUCKETS_S[-1]
+
+
+class _Timer:
+    __slots__ = ("_metrics", "_stage", "_t0")
+
+    def __init__(self, metrics: "Metrics", stage: str) -> None:
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self) -> "_Timer":
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._metrics.observe(self._stage, time.perf_counter() - self._t0)
+
+
+class Metrics:
+    """Latenze per stadio del percorso cattura -> client e del finalize.
+
+    Le istanze vivono nel processo che misura: i processi dei dispositivi
+    (`device_process`) inviano periodicamente i propri istogrammi cumulativi,
+    che vengono sommati a quelli locali in esportazione. `METRICS_ENABLED=0`
+    rende `observe` una no-op.
+    """
+
+    def __init__(self, enabled: Optional[bool] = None) -> None:
+        self.enabled = os.getenv("METRICS_ENABLED", "1") != "0" if enabled is None else enabled
+        self._hist: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        self._lock = threading.Lock()
+        # istogrammi dei processi figli: ultimo snapshot + quanto accumulato prima di un riavvio
+        self._remote: Dict[str, Exported] = {}
+        self._retired: Exported = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        hist = self._hist.get(stage)
+        if hist is None:
+            with self._lock:
+                hist = self._hist.setdefault(stage, Histogram())
+        hist.observe(seconds)
+
+    def time(self, stage: str) -> _Timer:
+        return _Timer(self, stage)
+
+    def export(self) -> Exported:
+        return {stage: hist.export() for stage, hist in list(self._hist.items())}
+
+    def set_remote(self, source: str, exported: Exported) -> None:
+        """Aggiorna gli istogrammi (cumulativi) ricevuti da un processo figlio."""
+        with self._lock:
+            previous = self._remote.get(source, {})
+            for stage, old in previous.items():
+                new = exported.get(stage)
+                # processo riavviato: i contatori ripartono da zero, si conserva il vecchio totale
+                if new is None or new[2] < old[2]:
+                    self._retired[stage] = _add(self._retired.get(stage, _empty()), old)
+            self._remote[source] = {stage: (list(c), float(s), int(n)) for stage, (c, s, n) in exported.items()}
+
+    def merged(self) -> Exported:
+        out = self.export()
+        with self._lock:
+            extra = [self._retired, *self._remote.values()]
+            for part in extra:
+                for stage, data in part.items():
+                    out[stage] = _add(out.get(stage, _empty()), data)
+        return out
+
+    def summary(self) -> Dict[str, dict]:
+        result = {}
+        for stage, (counts, total, n) in self.merged().items():
+            row = result[stage] = {"count": n, "mean_ms": round(total / n * 1000.0, 3) if n else None}
+            for q in (0.5, 0.95, 0.99):
+                value = quantile(counts, q)
+                row[f"p{int(q * 100)}_ms"] = round(value * 1000.0, 3) if value is not None else None
+        return result
+
+
+def _labels(labels: Dict[str, object]) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        text = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{text}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_histograms(name: str, help_text: str, exported: Exported) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for stage in sorted(exported):
+        counts, total, n = exported[stage]
+        cumulative = 0
+        for le, c in zip(BUCKETS_S + (float("inf"),), counts):
+            cumulative += c
+            lines.append(f"{name}_bucket{_labels({'stage': stage, 'le': _number(le)})} {cumulative}")
+        lines.append(f"{name}_sum{_labels({'stage': stage})} {_number(total)}")
+        lines.append(f"{name}_count{_labels({'stage': stage})} {n}")
+    return lines
+
+
+def render_metric(
+    name: str, kind: str, help_text: str, samples: Iterable[Tuple[Dict[str, object], float]]
+) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        if value is None:
+            continue
+        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+    return lines
+
+
+metrics = Metrics()
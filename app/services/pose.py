@@ -1,13 +1,12 @@
 from __future__ import annotations
 
-from typing import Dict, Tuple
+import os
+import time
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 
-try:
-    import mediapipe as mp  # type: ignore
-except Exception:  # pragma: no cover
-    mp = None
+from .capabilities import optional_import
 
 
 LANDMARK_NAMES = [
@@ -22,58 +21,276 @@ LANDMARK_NAMES = [
 ]
 
 
+LANDMARK_INDEX: Dict[str, int] = {name: i for i, name in enumerate(LANDMARK_NAMES)}
+
+# Punti virtuali (media di due landmark) usati da tronco e collo
+VIRTUAL_POINTS: Dict[str, Tuple[str, str]] = {
+    "mid_shoulder": ("left_shoulder", "right_shoulder"),
+    "mid_hip": ("left_hip", "right_hip"),
+    "mid_knee": ("left_knee", "right_knee"),
+    "mid_ear": ("left_ear", "right_ear"),
+}
+
+# Tabella articolazioni: nome -> (a, b, c), angolo in b tra i segmenti b->a e b->c
+JOINT_TRIPLETS: Dict[str, Tuple[str, str, str]] = {
+    "left_elbow": ("left_shoulder", "left_elbow", "left_wrist"),
+    "right_elbow": ("right_shoulder", "right_elbow", "right_wrist"),
+    "left_knee": ("left_hip", "left_knee", "left_ankle"),
+    "right_knee": ("right_hip", "right_knee", "right_ankle"),
+    "left_hip": ("left_shoulder", "left_hip", "left_knee"),
+    "right_hip": ("right_shoulder", "right_hip", "right_knee"),
+    "left_shoulder": ("left_hip", "left_shoulder", "left_elbow"),
+    "right_shoulder": ("right_hip", "right_shoulder", "right_elbow"),
+    "left_ankle": ("left_knee", "left_ankle", "left_foot_index"),
+    "right_ankle": ("right_knee", "right_ankle", "right_foot_index"),
+    "trunk": ("mid_shoulder", "mid_hip", "mid_knee"),
+    "neck": ("mid_ear", "mid_shoulder", "mid_hip"),
+}
+
+KeypointsLike = Union[np.ndarray, Dict[str, dict]]
+
+
+def empty_keypoints() -> np.ndarray:
+    # Landmark non rilevati = NaN
+    return np.full((len(LANDMARK_NAMES), 4), np.nan, dtype=np.float32)
+
+
+def keypoints_from_dict(kps: Dict[str, dict]) -> np.ndarray:
+    arr = empty_keypoints()
+    for name, kp in kps.items():
+        i = LANDMARK_INDEX.get(name)
+        if i is not None:
+            arr[i] = (kp["x"], kp["y"], kp["z"], kp["visibility"])
+    return arr
+
+
+def keypoints_to_dict(arr: np.ndarray) -> Dict[str, dict]:
+    """Formato dict-of-dicts dell'API; i landmark NaN vengono omessi."""
+    out: Dict[str, dict] = {}
+    # float32 -> 6 decimali, per non serializzare il rumore della conversione
+    for name, row in zip(LANDMARK_NAMES, np.round(arr.astype(np.float64), 6).tolist()):
+        if row[0] == row[0]:  # non NaN
+            out[name] = {"x": row[0], "y": row[1], "z": row[2], "visibility": row[3]}
+    return out
+
+
+def as_keypoint_array(kps: KeypointsLike) -> np.ndarray:
+    if isinstance(kps, np.ndarray):
+        return kps
+    return keypoints_from_dict(kps)
+
+
+def analysis_for_api(analysis: dict) -> dict:
+    kps = analysis.get("keypoints")
+    if isinstance(kps, np.ndarray):
+        analysis = dict(analysis, keypoints=keypoints_to_dict(kps))
+    return analysis
+
+
+class JointAngleEngine:
+    """Calcola tutti gli angoli articolari in un unico passaggio vettoriale.
+
+    Accetta un frame `(33, 4)` o una registrazione `(T, 33, 4)` e restituisce
+    rispettivamente `(J,)` o `(T, J)` gradi, nell'ordine di `names`.
+    Gli angoli con landmark mancanti valgono NaN.
+    """
+
+    def __init__(self, triplets: Dict[str, Tuple[str, str, str]] = JOINT_TRIPLETS) -> None:
+        self.names: List[str] = list(triplets)
+        virtual = list(VIRTUAL_POINTS)
+        index = dict(LANDMARK_INDEX)
+        for j, name in enumerate(virtual):
+            index[name] = len(LANDMARK_NAMES) + j
+        self._virtual_pairs = np.array(
+            [[LANDMARK_INDEX[a], LANDMARK_INDEX[b]] for a, b in VIRTUAL_POINTS.values()], dtype=np.intp
+        )
+        idx = np.array([[index[p] for p in triplets[n]] for n in self.names], dtype=np.intp)
+        self._a, self._b, self._c = idx[:, 0], idx[:, 1], idx[:, 2]
+
+    def compute(self, kps: np.ndarray) -> np.ndarray:
+        xy = np.asarray(kps, dtype=np.float32)[..., :2]
+        mids = xy[..., self._virtual_pairs, :].mean(axis=-2)
+        pts = np.concatenate([xy, mids], axis=-2)
+        ba = pts[..., self._a, :] - pts[..., self._b, :]
+        bc = pts[..., self._c, :] - pts[..., self._b, :]
+        num = (ba * bc).sum(axis=-1)
+        den = np.linalg.norm(ba, axis=-1) * np.linalg.norm(bc, axis=-1) + 1e-6
+        return np.degrees(np.arccos(np.clip(num / den, -1.0, 1.0)))
+
+    def as_dict(self, angles: np.ndarray) -> Dict[str, float]:
+        # Angoli non calcolabili -> 0.0 come nel formato storico
+        return {n: (v if v == v else 0.0) for n, v in zip(self.names, angles.tolist())}
+
+
+ANGLE_ENGINE = JointAngleEngine()
+
+
+def symmetry_array(kps: np.ndarray) -> np.ndarray:
+    """Simmetria spalle per frame (o stack di frame), in [0, 1]."""
+    ls = LANDMARK_INDEX["left_shoulder"]
+    rs = LANDMARK_INDEX["right_shoulder"]
+    val = 1.0 - np.abs(kps[..., ls, 1] - kps[..., rs, 1])
+    return np.clip(np.nan_to_num(val, nan=0.0), 0.0, 1.0)
+
+
+Roi = Tuple[int, int, int, int]  # (x0, y0, x1, y1) in pixel
+
+
+class InferencePreprocessor:
+    """Prepara il frame per MediaPipe: ROI tracciata, ridimensionamento e RGB contiguo.
+
+    La ROI deriva dai keypoint visibili del frame precedente (bbox + margine)
+    e si sposta solo quando la persona si avvicina al bordo o la ROI diventa
+    troppo larga, così il tracking interno di MediaPipe vede un'immagine
+    stabile. Il ritaglio viene ridotto a `input_size` sul lato lungo e
+    convertito in RGB in buffer riutilizzati. Con pochi keypoint visibili il
+    tracking è perso e si torna al frame intero.
+    """
+
+    def __init__(
+        self,
+        input_size: int = 256,
+        pad: float = 0.25,
+        min_visible: int = 8,
+        min_visibility: float = 0.5,
+    ) -> None:
+        self.input_size = input_size
+        self.pad = pad
+        self.min_visible = min_visible
+        self.min_visibility = min_visibility
+        self.roi: Optional[Roi] = None
+        self.lost = 0
+        self._bufs: Dict[Tuple[str, Tuple[int, ...]], np.ndarray] = {}
+
+    def _buffer(self, key: str, shape: Tuple[int, ...]) -> np.ndarray:
+        buf = self._bufs.get((key, shape))
+        if buf is None:
+            # al più un buffer per forma: ROI e risoluzione cambiano di rado
+            self._bufs = {k: v for k, v in self._bufs.items() if k[0] != key}
+            buf = self._bufs[(key, shape)] = np.empty(shape, dtype=np.uint8)
+        return buf
+
+    def prepare(self, frame_bgr: np.ndarray) -> Tuple[np.ndarray, Roi]:
+        """Restituisce (immagine RGB contigua per l'inferenza, ROI usata)."""
+        h, w = frame_bgr.shape[:2]
+        x0, y0, x1, y1 = self.roi or (0, 0, w, h)
+        crop = frame_bgr[y0:y1, x0:x1]
+        ch, cw = crop.shape[:2]
+        scale = min(1.0, self.input_size / max(cw, ch))
+        cv2 = optional_import("cv2")
+        if cv2 is not None:
+            if scale < 1.0:
+                size = (max(1, round(cw * scale)), max(1, round(ch * scale)))
+                small = self._buffer("small", (size[1], size[0], 3))
+                cv2.resize(crop, size, dst=small, interpolation=cv2.INTER_AREA)
+                crop = small
+            rgb = self._buffer("rgb", crop.shape)
+            cv2.cvtColor(crop, cv2.COLOR_BGR2RGB, dst=rgb)
+        else:
+            step = max(1, int(np.ceil(1.0 / scale)))
+            crop = crop[::step, ::step]
+            rgb = self._buffer("rgb", crop.shape)
+            np.copyto(rgb, crop[..., ::-1])
+        return rgb, (x0, y0, x1, y1)
+
+    @staticmethod
+    def to_frame(kps: np.ndarray, roi: Roi, frame_shape: Tuple[int, ...]) -> np.ndarray:
+        """Riporta i keypoint dalla ROI a coordinate normalizzate sul frame intero."""
+        h, w = frame_shape[:2]
+        x0, y0, x1, y1 = roi
+        sx, sy = (x1 - x0) / w, (y1 - y0) / h
+        kps[:, 0] = x0 / w + kps[:, 0] * sx
+        kps[:, 1] = y0 / h + kps[:, 1] * sy
+        # z di MediaPipe è nella scala della larghezza dell'immagine
+        kps[:, 2] *= sx
+        return kps
+
+    def update(self, kps: np.ndarray, frame_shape: Tuple[int, ...]) -> None:
+        """Aggiorna la ROI dai keypoint (già in coordinate del frame intero)."""
+        h, w = frame_shape[:2]
+        visible = kps[kps[:, 3] >= self.min_visibility]
+        if len(visible) < self.min_visible:
+            if self.roi is not None:
+                self.lost += 1
+            self.roi = None
+            return
+        bx0, by0 = visible[:, 0].min() * w, visible[:, 1].min() * h
+        bx1, by1 = visible[:, 0].max() * w, visible[:, 1].max() * h
+        margin = self.pad * max(bx1 - bx0, by1 - by0)
+        want = (
+            max(0, int(bx0 - margin)),
+            max(0, int(by0 - margin)),
+            min(w, int(np.ceil(bx1 + margin))),
+            min(h, int(np.ceil(by1 + margin))),
+        )
+        if want[2] - want[0] < 2 or want[3] - want[1] < 2:
+            self.roi = None
+            return
+        roi = self.roi
+        if roi is not None:
+            # isteresi: si tiene la ROI se contiene ancora il corpo (con mezzo margine)
+            # e non è più del doppio del necessario
+            half = margin / 2
+            inside = (
+                roi[0] <= max(0, bx0 - half)
+                and roi[1] <= max(0, by0 - half)
+                and roi[2] >= min(w, bx1 + half)
+                and roi[3] >= min(h, by1 + half)
+            )
+            area = (roi[2] - roi[0]) * (roi[3] - roi[1])
+            if inside and area <= 2 * (want[2] - want[0]) * (want[3] - want[1]):
+                return
+        self.roi = want
+
+
 class PoseEstimator:
     def __init__(self) -> None:
+        # mediapipe importato solo qui: l'import del modulo resta leggero
+        mp = optional_import("mediapipe")
         if mp is None:
             raise RuntimeError("mediapipe non disponibile")
-        self._pose = mp.solutions.pose.Pose(static_image_mode=False, model_complexity=1)
+        self._pose = mp.solutions.pose.Pose(
+            static_image_mode=False,
+            model_complexity=int(os.getenv("POSE_MODEL_COMPLEXITY", "1")),
+        )
+        self._pre = InferencePreprocessor(
+            input_size=int(os.getenv("POSE_INPUT_SIZE", "256")),
+            pad=float(os.getenv("POSE_ROI_PAD", "0.25")),
+        )
+        self._roi_enabled = os.getenv("POSE_ROI", "1") != "0"
+        self._pre_ms = 0.0
 
-    def process(self, frame_bgr: np.ndarray) -> Tuple[Dict[str, dict], float]:
-        # MediaPipe richiede RGB
-        frame_rgb = frame_bgr[..., ::-1]
-        results = self._pose.process(frame_rgb)
-        keypoints: Dict[str, dict] = {}
+    def process(self, frame_bgr: np.ndarray) -> Tuple[np.ndarray, float]:
+        """Restituisce i keypoint come array `(33, 4)` float32 (x, y, z, visibility)."""
+        t0 = time.perf_counter()
+        rgb, roi = self._pre.prepare(frame_bgr)
+        ms = (time.perf_counter() - t0) * 1000.0
+        self._pre_ms = ms if not self._pre_ms else 0.9 * self._pre_ms + 0.1 * ms
+        results = self._pose.process(rgb)
+        keypoints = empty_keypoints()
         quality = 0.0
         if results.pose_landmarks:
             lms = results.pose_landmarks.landmark
             count = min(len(lms), len(LANDMARK_NAMES))
-            for i in range(count):
-                kp = lms[i]
-                keypoints[LANDMARK_NAMES[i]] = {
-                    "x": float(kp.x),
-                    "y": float(kp.y),
-                    "z": float(kp.z),
-                    "visibility": float(kp.visibility),
-                }
-                quality += float(kp.visibility)
             if count:
-                quality /= count
+                keypoints[:count] = [(kp.x, kp.y, kp.z, kp.visibility) for kp in lms[:count]]
+                quality = float(keypoints[:count, 3].mean())
+                self._pre.to_frame(keypoints, roi, frame_bgr.shape)
+        if self._roi_enabled:
+            self._pre.update(keypoints, frame_bgr.shape)
         return keypoints, quality
 
-    def derive_angles(self, kps: Dict[str, dict]) -> Dict[str, float]:
-        def angle(a, b, c) -> float:
-            if a not in kps or b not in kps or c not in kps:
-                return 0.0
-            A = np.array([kps[a]["x"], kps[a]["y"]], dtype=float)
-            B = np.array([kps[b]["x"], kps[b]["y"]], dtype=float)
-            C = np.array([kps[c]["x"], kps[c]["y"]], dtype=float)
-            BA = A - B
-            BC = C - B
-            num = float(np.dot(BA, BC))
-            den = float(np.linalg.norm(BA) * np.linalg.norm(BC) + 1e-6)
-            val = np.clip(num / den, -1.0, 1.0)
-            return float(np.degrees(np.arccos(val)))
-
+    def stats(self) -> dict:
+        roi = self._pre.roi
         return {
-            "left_elbow": angle("left_shoulder", "left_elbow", "left_wrist"),
-            "right_elbow": angle("right_shoulder", "right_elbow", "right_wrist"),
-            "left_knee": angle("left_hip", "left_knee", "left_ankle"),
-            "right_knee": angle("right_hip", "right_knee", "right_ankle"),
+            "input_size": self._pre.input_size,
+            "roi": list(roi) if roi is not None else None,
+            "roi_lost": self._pre.lost,
+            "preprocess_ms": round(self._pre_ms, 3),
         }
 
-    def derive_symmetry(self, kps: Dict[str, dict]) -> Dict[str, float]:
-        val = 0.0
-        if "left_shoulder" in kps and "right_shoulder" in kps:
-            val = 1.0 - abs(kps["left_shoulder"]["y"] - kps["right_shoulder"]["y"])
-        return {"shoulders": float(np.clip(val, 0.0, 1.0))}
+    def derive_angles(self, kps: KeypointsLike) -> Dict[str, float]:
+        return ANGLE_ENGINE.as_dict(ANGLE_ENGINE.compute(as_keypoint_array(kps)))
 
+    def derive_symmetry(self, kps: KeypointsLike) -> Dict[str, float]:
+        return {"shoulders": float(symmetry_array(as_keypoint_array(kps)))}
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+
+MAX_PROFILES = 20
+MAX_DEPTH = 64
+
+
+class SamplingProfiler:
+    """Profiler a campionamento: ogni `interval` s legge lo stack di tutti i thread.
+
+    Nessun hook di tracing: il costo è nel solo thread di campionamento e i
+    thread misurati girano a velocità normale. Il risultato è in formato
+    "collapsed stack" (una riga `thread;mod:funzione;... conteggio`), leggibile
+    da flamegraph.pl e speedscope.
+    """
+
+    _active = threading.Lock()  # un profiler alla volta nel processo
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._started = 0.0
+        self.duration = 0.0
+
+    def start(self) -> bool:
+        if not SamplingProfiler._active.acquire(blocking=False):
+            return False
+        self._running = True
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._loop, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> None:
+        if not self._running:
+            return
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        SamplingProfiler._active.release()
+
+    def _loop(self) -> None:
+        me = threading.get_ident()
+        while self._running:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                parts: List[str] = []
+                while frame is not None and len(parts) < MAX_DEPTH:
+                    code = frame.f_code
+                    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+                    parts.append(f"{module}:{code.co_name}")
+                    frame = frame.f_back
+                parts.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(parts))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common()) + "\n"
+
+    def summary(self, label: str) -> dict:
+        return {
+            "label": label,
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000.0,
+            "duration_s": round(self.duration, 3),
+            "top": [{"stack": stack.rsplit(";", 1)[-1], "samples": n} for stack, n in self._leaves().most_common(10)],
+        }
+
+    def _leaves(self) -> Counter:
+        leaves: Counter = Counter()
+        for stack, n in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += n
+        return leaves
+
+
+class ProfileStore:
+    """Ultimi profili raccolti, consultabili da `/api/metrics/profiles`."""
+
+    def __init__(self, limit: int = MAX_PROFILES) -> None:
+        self.limit = limit
+        self._items: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, profiler: SamplingProfiler, label: str) -> str:
+        profile_id = uuid.uuid4().hex[:12]
+        entry = dict(profiler.summary(label), id=profile_id, collapsed=profiler.collapsed(), created=time.time())
+        with self._lock:
+            self._items[profile_id] = entry
+            while len(self._items) > self.limit:
+                self._items.popitem(last=False)
+        return profile_id
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        return self._items.get(profile_id)
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            return [{k: v for k, v in e.items() if k != "collapsed"} for e in reversed(self._items.values())]
+
+
+profiles = ProfileStore()
+
+
+def profiling_enabled() -> bool:
+    return os.getenv("PROFILING_ENABLED", "0") == "1"
+
+
+class ProfilingMiddleware:
+    """Profila una singola richiesta HTTP con `?profile=1` o header `X-Profile: 1`.
+
+    Middleware ASGI puro: le richieste non marcate passano con un solo
+    controllo su query e header. L'id del profilo torna nell'header
+    `X-Profile-Id`. Viene aggiunto solo con `PROFILING_ENABLED=1`.
+    """
+
+    def __init__(self, app, interval: Optional[float] = None) -> None:
+        self.app = app
+        self.interval = interval or float(os.getenv("PROFILING_INTERVAL_MS", "5")) / 1000.0
+
+    def _requested(self, scope) -> bool:
+        if scope["type"] != "http":
+            return False
+        for key, value in scope.get("headers", ()):
+            if key == b"x-profile" and value not in (b"", b"0"):
+                return True
+        query = scope.get("query_string", b"")
+        return b"profile=" in query and parse_qs(query.decode("latin-1")).get("profile", ["0"])[0] not in ("", "0")
+
+    async def __call__(self, scope, receive, send):
+        if not self._requested(scope):
+            await self.app(scope, receive, send)
+            return
+        profiler = SamplingProfiler(self.interval)
+        if not profiler.start():
+            # un altro profilo è in corso: la richiesta procede senza
+            await self.app(scope, receive, send)
+            return
+        label = f"{scope.get('method', '')} {scope.get('path', '')}"
+        holder: Dict[str, str] = {}
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start" and "id" not in holder:
+                # il profilo si chiude all'invio degli header: copre tutto il lavoro dell'handler
+                profiler.stop()
+                holder["id"] = profiles.add(profiler, label)
+                headers = list(message.get("headers", [])) + [(b"x-profile-id", holder["id"].encode("ascii"))]
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            if "id" not in holder:
+                profiler.stop()
+                profiles.add(profiler, label)
@@ -0,0 +1,378 @@
+from __future__ import annotations
+
+import json
+import os
+import struct
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .capabilities import optional_import
+from .pose import ANGLE_ENGINE, LANDMARK_NAMES, as_keypoint_array
+
+
+RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "..", "data", "recordings")
+
+MAGIC = b"PPREC\x00\x00\x01"
+HEADER_SIZE = 1024
+FLUSH_INTERVAL = 0.5
+FLUSH_BATCH = 64
+
+# Indice dei keyframe JPEG: record fissi, i byte stanno nel file dati affiancato
+KEYFRAME_DTYPE = np.dtype([("seq", "<u8"), ("ts", "<f8"), ("offset", "<u8"), ("size", "<u4")])
+
+
+def keyframe_interval() -> float:
+    """`REPLAY_KEYFRAME_S`: secondi tra due keyframe JPEG salvati per il replay (0 = disattivato)."""
+    try:
+        return max(float(os.getenv("REPLAY_KEYFRAME_S", "0")), 0.0)
+    except ValueError:
+        return 0.0
+
+
+def record_dtype(angle_names: List[str]) -> np.dtype:
+    # Record a dimensione fissa: il file si legge come un unico array strutturato
+    return np.dtype(
+        [
+            ("seq", "<u8"),
+            ("ts", "<f8"),
+            ("keypoints", "<f4", (len(LANDMARK_NAMES), 4)),
+            ("angles", "<f4", (len(angle_names),)),
+            ("quality", "<f4"),
+        ]
+    )
+
+
+def recording_path(visit_id: str) -> str:
+    return os.path.abspath(os.path.join(RECORDINGS_DIR, f"{visit_id}.rec"))
+
+
+def keyframe_paths(visit_id: str) -> Tuple[str, str]:
+    base = recording_path(visit_id)
+    return base + ".kf", base + ".kfi"
+
+
+def remove_keyframes(visit_id: str) -> None:
+    # keyframe di una registrazione sostituita (es. video caricato): seq non più validi
+    for path in keyframe_paths(visit_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def lock_recording(visit_id: str) -> Optional[int]:
+    """Lock esclusivo di scrittura della registrazione (flock, tra i worker uvicorn).
+
+    Restituisce il descrittore da tenere aperto finché si scrive, None se la
+    registrazione è già scritta da un altro processo.
+    """
+    path = recording_path(visit_id) + ".lock"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl = optional_import("fcntl")
+    if fcntl is None:
+        return fd  # senza flock non c'è memoria condivisa: un solo processo
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _write_header(f, meta: dict) -> None:
+    payload = json.dumps(meta).encode("utf-8")
+    if len(payload) + 12 > HEADER_SIZE:
+        raise ValueError("header registrazione troppo grande")
+    f.write(MAGIC + struct.pack("<I", len(payload)) + payload)
+    f.write(b"\x00" * (HEADER_SIZE - 12 - len(payload)))
+
+
+def read_header(path: str) -> dict:
+    with open(path, "rb") as f:
+        head = f.read(HEADER_SIZE)
+    if len(head) < 12 or head[:8] != MAGIC:
+        raise ValueError(f"non è una registrazione: {path}")
+    (size,) = struct.unpack("<I", head[8:12])
+    return json.loads(head[12 : 12 + size].decode("utf-8"))
+
+
+def recording_source(visit_id: str) -> Optional[str]:
+    """`source` dell'header ("camera" se assente), None senza registrazione."""
+    path = recording_path(visit_id)
+    try:
+        return read_header(path).get("source", "camera")
+    except (OSError, ValueError):
+        return None
+
+
+def open_recording(path: str) -> Tuple[dict, np.ndarray]:
+    """Apre una registrazione come array strutturato memory-mapped (zero copy).
+
+    Un eventuale record finale incompleto (scrittura interrotta) viene ignorato.
+    """
+    meta = read_header(path)
+    dtype = record_dtype(meta["angles"])
+    count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if count <= 0:
+        return meta, np.zeros(0, dtype=dtype)
+    return meta, np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+
+
+class SessionRecorder:
+    """Scrittore append-only di una visita; `append` non blocca mai."""
+
+    def __init__(
+        self,
+        visit_id: str,
+        width: int,
+        height: int,
+        path: Optional[str] = None,
+        extra_meta: Optional[dict] = None,
+        keyframe_s: float = 0.0,
+        lock_fd: Optional[int] = None,
+    ) -> None:
+        self.visit_id = visit_id
+        # lock di scrittura (`lock_recording`), rilasciato alla chiusura
+        self._lock_fd = lock_fd
+        self.path = path or recording_path(visit_id)
+        self.angle_names = list(ANGLE_ENGINE.names)
+        self._pending: Deque[Tuple[int, float, np.ndarray, float]] = deque()
+        # keyframe JPEG opzionali per il replay, uno ogni `keyframe_s` secondi
+        self.keyframe_s = keyframe_s
+        self._pending_kf: Deque[Tuple[int, float, bytes]] = deque()
+        self._last_kf_ts = -float("inf")
+        self._kf_files = None
+        self._write_lock = threading.Lock()
+        self.last_seq = -1
+        self.written = 0
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= HEADER_SIZE:
+            meta = read_header(self.path)
+            self.angle_names = meta["angles"]
+            _, existing = open_recording(self.path)
+            # i seq del file vengono da sessioni precedenti (il ring riparte da 1 a
+            # ogni avvio): il dedup vale solo per questa sessione di scrittura
+            self.written = len(existing)
+            del existing
+            # tronca un eventuale record parziale prima di riprendere ad accodare
+            dtype = record_dtype(self.angle_names)
+            with open(self.path, "r+b") as f:
+                f.truncate(HEADER_SIZE + self.written * dtype.itemsize)
+        else:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "wb") as f:
+                _write_header(
+                    f,
+                    {
+                        "version": 1,
+                        "visit_id": visit_id,
+                        "landmarks": LANDMARK_NAMES,
+                        "angles": self.angle_names,
+                        "width": width,
+                        "height": height,
+                        **(extra_meta or {}),
+                    },
+                )
+        self.dtype = record_dtype(self.angle_names)
+        self._file = open(self.path, "ab")
+        if keyframe_s > 0:
+            data_path, index_path = keyframe_paths(visit_id)
+            if os.path.exists(index_path):
+                # ripresa: si tronca un eventuale record d'indice parziale
+                count = os.path.getsize(index_path) // KEYFRAME_DTYPE.itemsize
+                with open(index_path, "r+b") as f:
+                    f.truncate(count * KEYFRAME_DTYPE.itemsize)
+                    if count:
+                        f.seek((count - 1) * KEYFRAME_DTYPE.itemsize)
+                        last = np.frombuffer(f.read(KEYFRAME_DTYPE.itemsize), dtype=KEYFRAME_DTYPE)[0]
+                        self._last_kf_ts = float(last["ts"])
+            self._kf_files = (open(data_path, "ab"), open(index_path, "ab"))
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def append(self, seq: int, ts: float, keypoints: np.ndarray, quality: float) -> None:
+        # stesso risultato consegnato due volte: scartato; seq all'indietro = produttore riavviato
+        if seq == self.last_seq:
+            return
+        self.last_seq = seq
+        self._pending.append((seq, ts, keypoints, quality))
+
+    def wants_keyframe(self, ts: float) -> bool:
+        return self._kf_files is not None and ts - self._last_kf_ts >= self.keyframe_s
+
+    def append_keyframe(self, seq: int, ts: float, jpeg: bytes) -> None:
+        # ts strettamente crescenti nell'indice (anche tra sessioni): il replay cerca per istante
+        if not self.wants_keyframe(ts):
+            return
+        self._last_kf_ts = ts
+        self._pending_kf.append((seq, ts, jpeg))
+
+    def _flush_keyframes(self) -> None:
+        if self._kf_files is None or not self._pending_kf:
+            return
+        data, index = self._kf_files
+        offset = data.seek(0, os.SEEK_END)
+        entries = np.zeros(len(self._pending_kf), dtype=KEYFRAME_DTYPE)
+        for i in range(len(entries)):
+            seq, ts, jpeg = self._pending_kf.popleft()
+            entries[i] = (seq, ts, offset, len(jpeg))
+            data.write(jpeg)
+            offset += len(jpeg)
+        # prima i byte, poi l'indice: un record d'indice punta sempre a dati completi
+        data.flush()
+        index.write(entries.tobytes())
+        index.flush()
+
+    def flush(self) -> int:
+        with self._write_lock:
+            if self._file is None:
+                return 0
+            self._flush_keyframes()
+            batch = []
+            while self._pending:
+                batch.append(self._pending.popleft())
+            if not batch:
+                return 0
+            rec = np.zeros(len(batch), dtype=self.dtype)
+            rec["seq"] = [b[0] for b in batch]
+            rec["ts"] = [b[1] for b in batch]
+            rec["keypoints"] = np.stack([b[2] for b in batch])
+            rec["quality"] = [b[3] for b in batch]
+            # angoli dell'intero batch in un solo passaggio vettoriale
+            rec["angles"] = ANGLE_ENGINE.compute(rec["keypoints"])
+            self._file.write(rec.tobytes())
+            self._file.flush()
+            self.written += len(batch)
+            return len(batch)
+
+    def close(self) -> None:
+        self.flush()
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._kf_files is not None:
+                for f in self._kf_files:
+                    f.close()
+                self._kf_files = None
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+
+class RecordingManager:
+    """Registrazioni attive per visita, svuotate a batch da un thread dedicato.
+
+    Una visita ha un solo scrittore tra tutti i worker (`lock_recording`): gli
+    altri processi che la registrano restano in attesa e subentrano quando lo
+    scrittore si ferma, senza record duplicati o intercalati.
+    """
+
+    def __init__(self, width: int = 640, height: int = 480) -> None:
+        self.width = width
+        self.height = height
+        self._lock = threading.Lock()
+        self._wanted: set = set()
+        self._active: Dict[str, SessionRecorder] = {}
+        # visite la cui registrazione viene da un video caricato: la cattura live non vi accoda
+        self._skipped: Dict[str, str] = {}
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, visit_id: str) -> Optional[SessionRecorder]:
+        with self._lock:
+            self._wanted.add(visit_id)
+            rec = self._active.get(visit_id) or self._open(visit_id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="recording-flush", daemon=True)
+                self._thread.start()
+            return rec
+
+    def _open(self, visit_id: str) -> Optional[SessionRecorder]:
+        # chiamato con self._lock; None se la visita è scritta da un altro processo
+        # o se la sua registrazione viene da un video (seq e ts non confrontabili col live)
+        if recording_source(visit_id) == "video":
+            self._skipped[visit_id] = "video"
+            return None
+        fd = lock_recording(visit_id)
+        if fd is None:
+            return None
+        try:
+            rec = SessionRecorder(visit_id, self.width, self.height, keyframe_s=keyframe_interval(), lock_fd=fd)
+        except Exception:
+            os.close(fd)
+            raise
+        self._active[visit_id] = rec
+        return rec
+
+    def stop(self, visit_id: str) -> None:
+        with self._lock:
+            self._wanted.discard(visit_id)
+            self._skipped.pop(visit_id, None)
+            rec = self._active.pop(visit_id, None)
+        if rec is not None:
+            rec.close()
+
+    def is_active(self, visit_id: str) -> bool:
+        return visit_id in self._wanted and visit_id not in self._skipped
+
+    def feed(self, result: dict) -> None:
+        # Chiamato dal worker di inferenza per ogni nuovo risultato
+        if not self._active:
+            return
+        kps = as_keypoint_array(result["keypoints"])
+        for rec in list(self._active.values()):
+            rec.append(result["seq"], result["capture_ts"], kps, result["frame_quality"])
+            if rec.pending >= FLUSH_BATCH:
+                self._wake.set()
+
+    def feed_keyframe(self, seq: int, ts: float, encode: Callable[[], Optional[bytes]]) -> None:
+        # Chiamato dal fan-out per ogni frame: codifica (o riusa) il JPEG solo se serve un keyframe
+        wanting = [rec for rec in list(self._active.values()) if rec.wants_keyframe(ts)]
+        if not wanting:
+            return
+        jpeg = encode()
+        if jpeg:
+            for rec in wanting:
+                rec.append_keyframe(seq, ts, jpeg)
+
+    def load(self, visit_id: str) -> Optional[Tuple[dict, np.ndarray]]:
+        rec = self._active.get(visit_id)
+        if rec is not None:
+            rec.flush()
+        path = recording_path(visit_id)
+        if not os.path.exists(path):
+            return None
+        return open_recording(path)
+
+    def status(self) -> dict:
+        active, skipped = dict(self._active), dict(self._skipped)
+        return {
+            vid: (
+                {"writer": True, "written": rec.written, "pending": rec.pending, "last_seq": rec.last_seq}
+                if rec is not None
+                else {"writer": False, "skipped": skipped.get(vid)}
+            )
+            for vid, rec in ((v, active.get(v)) for v in list(self._wanted))
+        }
+
+    def _loop(self) -> None:
+        while True:
+            self._wake.wait(FLUSH_INTERVAL)
+            self._wake.clear()
+            for rec in list(self._active.values()):
+                try:
+                    rec.flush()
+                except Exception:
+                    pass
+            if len(self._wanted) > len(self._active) + len(self._skipped):
+                # visite scritte da un altro worker: si subentra appena il lock si libera
+                with self._lock:
+                    for vid in self._wanted - self._active.keys() - self._skipped.keys():
+                        try:
+                            self._open(vid)
+                        except Exception:
+                            pass
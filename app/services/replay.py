@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import os
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .broadcast import FramePacket
+from .pose import symmetry_array
+from .recording import KEYFRAME_DTYPE, keyframe_paths
+
+
+SPEED_RANGE = (0.1, 16.0)
+
+
+def clamp_speed(value) -> float:
+    return min(max(float(value), SPEED_RANGE[0]), SPEED_RANGE[1])
+
+
+class KeyframeIndex:
+    """Keyframe JPEG di una registrazione: indice e dati memory-mapped, letti solo su richiesta."""
+
+    def __init__(self, visit_id: str) -> None:
+        # ricerca per istante di cattura, crescente nel file anche se i seq ripartono
+        # (riavvio del produttore, ripresa della registrazione)
+        self._ts = np.zeros(0, dtype=np.float64)
+        self._entries: Optional[np.ndarray] = None
+        self._data: Optional[np.ndarray] = None
+        data_path, index_path = keyframe_paths(visit_id)
+        if not (os.path.exists(index_path) and os.path.exists(data_path)):
+            return
+        count = os.path.getsize(index_path) // KEYFRAME_DTYPE.itemsize
+        size = os.path.getsize(data_path)
+        if not count or not size:
+            return
+        entries = np.memmap(index_path, dtype=KEYFRAME_DTYPE, mode="r", shape=(count,))
+        # record d'indice oltre la fine dei dati (scrittura interrotta) esclusi
+        complete = entries["offset"] + entries["size"] <= size
+        count = int(np.argmin(complete)) if not complete.all() else count
+        self._entries = entries[:count]
+        self._ts = np.array(self._entries["ts"])
+        self._data = np.memmap(data_path, dtype=np.uint8, mode="r", shape=(size,))
+
+    def __len__(self) -> int:
+        return len(self._ts)
+
+    def at(self, ts: float) -> Optional[Tuple[int, bytes]]:
+        """Ultimo keyframe catturato entro `ts`, come (indice del keyframe, JPEG)."""
+        i = int(np.searchsorted(self._ts, ts, side="right")) - 1
+        if i < 0:
+            return None
+        entry = self._entries[i]
+        offset, size = int(entry["offset"]), int(entry["size"])
+        return i, self._data[offset : offset + size].tobytes()
+
+
+class ReplayCursor:
+    """Accesso per indice a una registrazione memory-mapped.
+
+    La posizione (secondi dall'inizio) diventa un indice stimandolo dalla
+    frequenza media, poi ricerca esponenziale attorno alla stima: O(1) per le
+    registrazioni a fps costante, O(log d) se la stima sbaglia di d frame.
+    Nessuna lettura dell'intero file; ogni frame inviato tocca un solo record.
+    """
+
+    def __init__(self, visit_id: str, meta: dict, rec: np.ndarray, keyframes: Optional[KeyframeIndex] = None) -> None:
+        self.visit_id = visit_id
+        self.meta = meta
+        self.rec = rec
+        self.angle_names = list(meta["angles"])
+        self.keyframes = keyframes if keyframes is not None else KeyframeIndex(visit_id)
+        self._ts = rec["ts"]
+        self.frames = len(rec)
+        self.t0 = float(self._ts[0]) if self.frames else 0.0
+        self.duration = float(self._ts[-1]) - self.t0 if self.frames else 0.0
+        self.fps = (self.frames - 1) / self.duration if self.duration > 0 else float(meta.get("fps") or 0.0)
+
+    def index_at(self, position: float) -> int:
+        """Ultimo frame con istante <= `position`."""
+        last = self.frames - 1
+        if last <= 0 or position <= 0:
+            return 0
+        if position >= self.duration:
+            return last
+        at, target = self._ts.item, self.t0 + position
+        # intervallo [lo, hi) attorno alla stima, allargato a passi doppi finché contiene il frame
+        i = min(int(position * self.fps), last)
+        lo, hi, step = i, i + 1, 1
+        while lo > 0 and at(lo) > target:
+            lo, step = max(lo - step, 0), step * 2
+        while hi <= last and at(hi) <= target:
+            hi, step = min(hi + step, last + 1), step * 2
+        return lo + int(np.searchsorted(self._ts[lo:hi], target, side="right")) - 1
+
+    def position_of(self, index: int) -> float:
+        index = min(max(index, 0), self.frames - 1)
+        return float(self._ts[index]) - self.t0
+
+    def analysis(self, index: int) -> dict:
+        # stessa forma dell'analisi live (PostureAnalysis)
+        record = self.rec[index]
+        kps = np.array(record["keypoints"])
+        return {
+            "keypoints": kps,
+            "angles": {n: (v if v == v else 0.0) for n, v in zip(self.angle_names, record["angles"].tolist())},
+            "symmetry": {"shoulders": float(symmetry_array(kps))},
+            "timestamp": datetime.fromtimestamp(float(record["ts"]), timezone.utc).isoformat(),
+            "frame_quality": float(record["quality"]),
+        }
+
+    def packet(self, index: int) -> Tuple[FramePacket, Optional[int]]:
+        """Pacchetto del frame `index` (serializzato come lo stream live) e indice del keyframe allegato."""
+        seq = int(self.rec[index]["seq"])
+        keyframe = self.keyframes.at(self._ts.item(index)) if len(self.keyframes) else None
+        jpeg = keyframe[1] if keyframe is not None else None
+        packet = FramePacket(None, seq, self.analysis(index), None, jpeg=jpeg)
+        return packet, keyframe[0] if keyframe is not None else None
+
+    def info(self) -> dict:
+        return {
+            "frames": self.frames,
+            "duration_s": round(self.duration, 3),
+            "fps": round(self.fps, 2),
+            "keyframes": len(self.keyframes),
+            "source": self.meta.get("source", "camera"),
+        }
+
+
+class ReplayClock:
+    """Posizione di riproduzione (secondi di registrazione) con pausa e velocità."""
+
+    def __init__(self, duration: float, speed: float = 1.0, position: float = 0.0, paused: bool = False) -> None:
+        self.duration = duration
+        self.speed = clamp_speed(speed)
+        self.paused = paused
+        self._anchor_pos = min(max(position, 0.0), duration)
+        self._anchor_at = 0.0
+
+    def position(self, now: float) -> float:
+        if self.paused:
+            return self._anchor_pos
+        return min(self._anchor_pos + (now - self._anchor_at) * self.speed, self.duration)
+
+    def ended(self, now: float) -> bool:
+        return self.position(now) >= self.duration
+
+    def _rebase(self, now: float, position: Optional[float] = None) -> None:
+        pos = self.position(now) if position is None else position
+        self._anchor_pos = min(max(pos, 0.0), self.duration)
+        self._anchor_at = now
+
+    def start(self, now: float) -> None:
+        self._rebase(now, self._anchor_pos)
+
+    def seek(self, position: float, now: float) -> None:
+        self._rebase(now, position)
+
+    def pause(self, now: float) -> None:
+        self._rebase(now)
+        self.paused = True
+
+    def play(self, now: float) -> None:
+        self._rebase(now)
+        # a fine registrazione "play" riparte dall'inizio
+        if self._anchor_pos >= self.duration:
+            self._anchor_pos = 0.0
+        self.paused = False
+
+    def set_speed(self, speed: float, now: float) -> None:
+        self._rebase(now)
+        self.speed = clamp_speed(speed)
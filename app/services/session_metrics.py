@@ -0,0 +1,505 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from .pose import ANGLE_ENGINE, as_keypoint_array, symmetry_array
+
+
+# Parole chiave del nome esercizio -> articolazioni da cui contare le ripetizioni.
+# Il primo match vince: le voci più specifiche stanno prima di quelle generiche.
+EXERCISE_LIBRARY: Tuple[Tuple[Tuple[str, ...], Tuple[str, ...]], ...] = (
+    (("squat", "accosciat"), ("knee",)),
+    (("affond", "lunge"), ("knee",)),
+    (("curl", "bicipit", "flessione gomit", "gomito", "elbow"), ("elbow",)),
+    (("abduzion", "abduction", "alzate laterali", "lateral raise"), ("shoulder",)),
+    (("flessione spalla", "shoulder", "spalla", "spalle"), ("shoulder",)),
+    (("estensione ginocchi", "knee", "ginocchi"), ("knee",)),
+    (("ponte", "bridge", "anca", "anche", "hip", "marcia"), ("hip",)),
+    (("caviglia", "ankle", "calf", "polpacc"), ("ankle",)),
+    (("tronco", "busto", "trunk"), ("trunk",)),
+    (("collo", "cervical", "neck"), ("neck",)),
+)
+
+SMOOTHING = 0.5  # EMA degli angoli: attenua il jitter di MediaPipe su min/max e ripetizioni
+MIN_QUALITY = 0.3  # sotto questa qualità il frame pesa nelle medie ma non in ROM/ripetizioni
+MIN_ROM = 20.0  # escursione minima (gradi) perché un movimento sia una ripetizione
+MIN_REP_S = 0.4
+PUSH_INTERVAL_S = 0.5
+MAX_SESSIONS = 64
+REP_HISTORY = 200
+
+
+def resolve_joints(exercise: dict, names: Sequence[str] = ANGLE_ENGINE.names) -> List[str]:
+    """Angoli usati per il conteggio: `joint` esplicito ("knee", "left_knee", [...]) o dal nome."""
+    wanted = exercise.get("joint") or exercise.get("joints")
+    if isinstance(wanted, str):
+        wanted = [wanted]
+    if not wanted:
+        label = str(exercise.get("name") or exercise.get("nome") or "").lower()
+        wanted = next((list(joints) for keys, joints in EXERCISE_LIBRARY if any(k in label for k in keys)), [])
+    joints: List[str] = []
+    for joint in wanted:
+        joint = str(joint).lower()
+        matches = [joint] if joint in names else [f"left_{joint}", f"right_{joint}"]
+        joints += [m for m in matches if m in names and m not in joints]
+    return joints
+
+
+class AngleStats:
+    """Statistiche incrementali di tutti gli angoli insieme (vettori lunghi J).
+
+    Media e varianza pesate con la qualità del frame (Welford/West), ROM da
+    min/max del segnale smussato; ogni update costa O(J) indipendentemente
+    dalla durata della sessione.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.frames = np.zeros(size, dtype=np.int64)
+        self.weight = np.zeros(size)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+        self.min = np.full(size, np.inf)
+        self.max = np.full(size, -np.inf)
+
+    def update(self, angles: np.ndarray, smoothed: np.ndarray, weight: float) -> None:
+        ok = ~np.isnan(angles)
+        if weight <= 0.0 or not ok.any():
+            return
+        w = np.where(ok, weight, 0.0)
+        x = np.where(ok, angles, 0.0)
+        total = self.weight + w
+        delta = x - self.mean
+        step = np.divide(w, total, out=np.zeros_like(total), where=total > 0)
+        self.mean += step * delta
+        self.m2 += w * delta * (x - self.mean)
+        self.weight = total
+        self.frames += ok
+        if weight >= MIN_QUALITY:
+            self.min = np.fmin(self.min, smoothed)
+            self.max = np.fmax(self.max, smoothed)
+
+    def summary(self, names: Sequence[str]) -> Dict[str, dict]:
+        out = {}
+        for i, name in enumerate(names):
+            if not self.frames[i]:
+                continue
+            lo, hi = self.min[i], self.max[i]
+            has_range = math.isfinite(lo) and math.isfinite(hi)
+            out[name] = {
+                "mean": round(float(self.mean[i]), 2),
+                "std": round(math.sqrt(max(self.m2[i] / self.weight[i], 0.0)), 2) if self.weight[i] else None,
+                "min": round(float(lo), 2) if has_range else None,
+                "max": round(float(hi), 2) if has_range else None,
+                "rom": round(float(hi - lo), 2) if has_range else None,
+                "frames": int(self.frames[i]),
+            }
+        return out
+
+
+class RepCounter:
+    """Macchina a stati su un segnale angolare: una ripetizione = estremo A -> estremo B -> A.
+
+    Le soglie sono fisse (`low`/`high`) oppure al 30% / 70% dell'escursione
+    osservata, con isteresi tra le due. Indipendente dal verso: l'estremo più
+    vicino alla posizione iniziale è la posizione di partenza. Registra i
+    tempi di andata, pausa e ritorno di ogni ripetizione.
+    """
+
+    def __init__(self, low: Optional[float] = None, high: Optional[float] = None, min_rom: float = MIN_ROM) -> None:
+        self.fixed = (low, high) if low is not None and high is not None else None
+        self.min_rom = min_rom
+        self.lo = math.inf
+        self.hi = -math.inf
+        self.state: Optional[str] = None
+        self.start_state: Optional[str] = None
+        self.reps = 0
+        self._first: Optional[float] = None
+        self._left_ts: Optional[float] = None  # ultimo istante nella posizione di partenza
+        self._turn_ts: Optional[float] = None  # arrivo all'estremo opposto
+        self._turn_left_ts: Optional[float] = None  # ultimo istante all'estremo opposto
+        self._rep_lo = math.inf
+        self._rep_hi = -math.inf
+        self._sum = {"duration": 0.0, "out": 0.0, "hold": 0.0, "back": 0.0, "rom": 0.0}
+        self.history: Deque[dict] = deque(maxlen=REP_HISTORY)
+
+    def thresholds(self) -> Optional[Tuple[float, float]]:
+        if self.fixed is not None:
+            return self.fixed
+        span = self.hi - self.lo
+        if not span >= self.min_rom:
+            return None
+        return self.lo + 0.3 * span, self.hi - 0.3 * span
+
+    def update(self, value: float, ts: float) -> bool:
+        """True quando il frame chiude una ripetizione."""
+        if value != value:
+            return False
+        if self._first is None:
+            self._first = value
+            self._left_ts = ts
+        self.lo = min(self.lo, value)
+        self.hi = max(self.hi, value)
+        self._rep_lo = min(self._rep_lo, value)
+        self._rep_hi = max(self._rep_hi, value)
+        limits = self.thresholds()
+        if limits is None:
+            return False
+        if self.start_state is None:
+            # la posizione di partenza è l'estremo più vicino al primo valore osservato
+            self.start_state = "high" if self.hi - self._first <= self._first - self.lo else "low"
+            self.state = self.start_state
+        low, high = limits
+        zone = "low" if value <= low else ("high" if value >= high else None)
+        completed = False
+        # nella fascia intermedia lo stato non cambia (isteresi)
+        if zone is not None and zone != self.state:
+            if zone != self.start_state:
+                self._turn_ts = ts
+            elif self._turn_ts is not None:
+                completed = self._complete(ts, value)
+            self.state = zone
+        if zone == self.start_state:
+            self._left_ts = ts
+        elif zone is not None:
+            self._turn_left_ts = ts
+        return completed
+
+    def _complete(self, ts: float, value: float) -> bool:
+        start, turn = self._left_ts, self._turn_ts
+        turn_left = self._turn_left_ts if self._turn_left_ts is not None else turn
+        self._turn_ts = self._turn_left_ts = None
+        rom = self._rep_hi - self._rep_lo
+        self._rep_lo = self._rep_hi = value
+        duration = ts - start
+        if duration < MIN_REP_S:
+            return False
+        rep = {
+            "t": ts,
+            "duration": duration,
+            "out": turn - start,
+            "hold": max(0.0, turn_left - turn),
+            "back": max(0.0, ts - turn_left),
+            "rom": rom,
+        }
+        self.reps += 1
+        for key in self._sum:
+            self._sum[key] += rep[key]
+        self.history.append({k: round(v, 3) for k, v in rep.items()})
+        return True
+
+    def summary(self, history: bool = False) -> dict:
+        n = self.reps
+        limits = self.thresholds()
+        out = {
+            "reps": n,
+            "phase": None if self.state is None else ("start" if self.state == self.start_state else "turn"),
+            "thresholds": [round(limits[0], 1), round(limits[1], 1)] if limits else None,
+            "tempo": {k: round(v / n, 3) for k, v in self._sum.items()} if n else None,
+            "last": self.history[-1] if self.history else None,
+        }
+        if history:
+            out["history"] = list(self.history)
+        return out
+
+
+class ExerciseTracker:
+    """Accumulatori di un esercizio della visita."""
+
+    def __init__(self, index: int, exercise: dict, names: Sequence[str]) -> None:
+        self.index = index
+        self.exercise = exercise
+        self.names = list(names)
+        self.joints = resolve_joints(exercise, self.names)
+        limits = exercise.get("thresholds")
+        low, high = (float(limits[0]), float(limits[1])) if isinstance(limits, (list, tuple)) and len(limits) == 2 else (None, None)
+        self.counters: Dict[str, RepCounter] = {j: RepCounter(low, high) for j in self.joints}
+        self._joint_idx = [self.names.index(j) for j in self.joints]
+        self.angles = AngleStats(len(self.names))
+        # coppie sinistra/destra per la simmetria nel tempo
+        self.pairs = [
+            (n[len("left_") :], i, self.names.index("right_" + n[len("left_") :]))
+            for i, n in enumerate(self.names)
+            if n.startswith("left_") and "right_" + n[len("left_") :] in self.names
+        ]
+        self._li = np.array([p[1] for p in self.pairs], dtype=np.intp)
+        self._ri = np.array([p[2] for p in self.pairs], dtype=np.intp)
+        self._asym_w = np.zeros(len(self.pairs))
+        self._asym = np.zeros(len(self.pairs))
+        self._shoulders = [0.0, 0.0]  # somma pesata, peso
+        self.frames = 0
+        self.quality = [0.0, 0]  # somma, frame
+        self.first_ts: Optional[float] = None
+        self.last_ts: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        return str(self.exercise.get("name") or self.exercise.get("nome") or f"esercizio {self.index + 1}")
+
+    def update(self, angles: np.ndarray, smoothed: np.ndarray, quality: float, shoulders: Optional[float], ts: float) -> bool:
+        self.frames += 1
+        self.quality[0] += quality
+        self.quality[1] += 1
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts
+        self.angles.update(angles, smoothed, quality)
+        if len(self.pairs):
+            diff = np.abs(smoothed[self._li] - smoothed[self._ri])
+            ok = ~np.isnan(diff)
+            self._asym_w += np.where(ok, quality, 0.0)
+            self._asym += np.where(ok, quality * np.nan_to_num(diff), 0.0)
+        if shoulders is not None and shoulders == shoulders:
+            self._shoulders[0] += quality * shoulders
+            self._shoulders[1] += quality
+        if quality < MIN_QUALITY:
+            return False
+        rep = False
+        for joint, i in zip(self.joints, self._joint_idx):
+            rep = self.counters[joint].update(float(smoothed[i]), ts) or rep
+        return rep
+
+    @property
+    def reps(self) -> int:
+        # esercizi bilaterali simultanei (squat, alzate): conta il lato più completo
+        return max((c.reps for c in self.counters.values()), default=0)
+
+    def symmetry(self, rom: Dict[str, dict]) -> Dict[str, Any]:
+        out: Dict[str, Any] = {}
+        for k, (base, _, _) in enumerate(self.pairs):
+            left, right = rom.get(f"left_{base}", {}).get("rom"), rom.get(f"right_{base}", {}).get("rom")
+            entry = {"mean_abs_diff": round(float(self._asym[k] / self._asym_w[k]), 2) if self._asym_w[k] else None}
+            if left and right:
+                entry["rom_index"] = round(1.0 - abs(left - right) / max(left, right), 3)
+            lc, rc = self.counters.get(f"left_{base}"), self.counters.get(f"right_{base}")
+            if lc is not None and rc is not None:
+                entry["reps"] = {"left": lc.reps, "right": rc.reps}
+            out[base] = entry
+        if self._shoulders[1]:
+            out["shoulders"] = round(self._shoulders[0] / self._shoulders[1], 3)
+        return out
+
+    def target(self) -> Optional[int]:
+        try:
+            reps = int(self.exercise.get("reps") or self.exercise.get("ripetizioni") or 0)
+            sets = int(self.exercise.get("sets") or self.exercise.get("serie") or 1)
+        except (TypeError, ValueError):
+            return None
+        return reps * max(sets, 1) if reps else None
+
+    def live(self) -> dict:
+        roms = {}
+        for j, i in zip(self.joints, self._joint_idx):
+            lo, hi = self.angles.min[i], self.angles.max[i]
+            roms[j] = round(float(hi - lo), 1) if math.isfinite(lo) and math.isfinite(hi) else None
+        return {
+            "index": self.index,
+            "name": self.name,
+            "joints": self.joints,
+            "reps": self.reps,
+            "target": self.target(),
+            "sides": {j: c.summary() for j, c in self.counters.items()},
+            "rom": roms,
+        }
+
+    def summary(self) -> dict:
+        rom = self.angles.summary(self.names)
+        target = self.target()
+        return {
+            "index": self.index,
+            "name": self.name,
+            "joints": self.joints,
+            "frames": self.frames,
+            "duration_s": round(self.last_ts - self.first_ts, 3) if self.first_ts is not None else 0.0,
+            "mean_quality": round(self.quality[0] / self.quality[1], 4) if self.quality[1] else None,
+            "reps": self.reps,
+            "target": target,
+            "completion": round(min(1.0, self.reps / target), 3) if target else None,
+            "sides": {j: c.summary(history=True) for j, c in self.counters.items()},
+            "angles": rom,
+            "symmetry": self.symmetry(rom),
+        }
+
+
+class SessionMetrics:
+    """Metriche di una visita: un tracker per esercizio, uno attivo alla volta."""
+
+    def __init__(self, visit_id: str, exercises: Optional[List[Any]] = None) -> None:
+        self.visit_id = visit_id
+        self.names = list(ANGLE_ENGINE.names)
+        self.trackers: List[ExerciseTracker] = []
+        self.active = 0
+        self._smoothed: Optional[np.ndarray] = None
+        self.last_push = 0.0
+        self.set_exercises(exercises or [])
+
+    def set_exercises(self, exercises: List[Any]) -> None:
+        # gli esercizi già iniziati (stesso indice e nome) conservano gli accumulatori
+        items = [e if isinstance(e, dict) else {"name": str(e)} for e in exercises] or [{"name": "libero"}]
+        old = {(t.index, t.name): t for t in self.trackers}
+        trackers = []
+        for i, ex in enumerate(items):
+            tracker = ExerciseTracker(i, ex, self.names)
+            kept = old.get((i, tracker.name))
+            if kept is not None:
+                kept.exercise = ex
+                tracker = kept
+            trackers.append(tracker)
+        self.trackers = trackers
+        self.active = min(self.active, len(trackers) - 1)
+
+    def select(self, key: Union[int, str]) -> bool:
+        if isinstance(key, int) and not isinstance(key, bool):
+            if 0 <= key < len(self.trackers):
+                self.active = key
+                return True
+            return False
+        for t in self.trackers:
+            if t.name.lower() == str(key).lower():
+                self.active = t.index
+                return True
+        return False
+
+    def feed(self, angles: np.ndarray, quality: float, shoulders: Optional[float], ts: float) -> bool:
+        prev = self._smoothed
+        smoothed = angles if prev is None else np.where(np.isnan(prev), angles, SMOOTHING * angles + (1 - SMOOTHING) * prev)
+        # un landmark perso non azzera lo smussamento
+        self._smoothed = np.where(np.isnan(smoothed), prev, smoothed) if prev is not None else smoothed
+        return self.trackers[self.active].update(angles, smoothed, quality, shoulders, ts)
+
+    def live(self) -> dict:
+        return {
+            "type": "metrics",
+            "visit_id": self.visit_id,
+            "active": self.active,
+            "exercise": self.trackers[self.active].live(),
+            "reps": [t.reps for t in self.trackers],
+        }
+
+    def summary(self) -> dict:
+        return {
+            "active": self.active,
+            "exercises": [t.summary() for t in self.trackers],
+            "total_reps": sum(t.reps for t in self.trackers),
+            "frames": sum(t.frames for t in self.trackers),
+        }
+
+
+def shoulders_symmetry(result: dict) -> Optional[float]:
+    sym = result.get("symmetry")
+    if isinstance(sym, dict):
+        value = sym.get("shoulders")
+        return float(value) if isinstance(value, (int, float)) else None
+    return None
+
+
+class SessionMetricsManager:
+    """Sessioni di metriche delle visite servite da una camera.
+
+    Alimentato dal worker di inferenza come le registrazioni; le sessioni
+    restano in memoria (ultime `MAX_SESSIONS`) anche dopo la disconnessione,
+    così il finalize legge gli accumulatori invece di ricalcolare la storia.
+    `on_update(visit_id, payload)` riceve il riepilogo live, al più ogni
+    `PUSH_INTERVAL_S` secondi e subito a ogni ripetizione.
+    """
+
+    def __init__(self, on_update: Optional[Callable[[str, dict], None]] = None) -> None:
+        self.on_update = on_update
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, SessionMetrics]" = OrderedDict()
+        self._active: Dict[str, int] = {}  # visita -> client connessi
+
+    def start(self, visit_id: str, exercises: Optional[List[Any]] = None) -> SessionMetrics:
+        with self._lock:
+            session = self._sessions.get(visit_id)
+            if session is None:
+                session = self._sessions[visit_id] = SessionMetrics(visit_id, exercises)
+                # le più vecchie senza client connessi; quelle attive restano
+                excess = len(self._sessions) - MAX_SESSIONS
+                for old in [v for v in self._sessions if v not in self._active and v != visit_id][: max(excess, 0)]:
+                    self._sessions.pop(old)
+            elif exercises is not None:
+                session.set_exercises(exercises)
+            self._sessions.move_to_end(visit_id)
+            self._active[visit_id] = self._active.get(visit_id, 0) + 1
+            return session
+
+    def stop(self, visit_id: str) -> None:
+        with self._lock:
+            left = self._active.get(visit_id, 0) - 1
+            if left > 0:
+                self._active[visit_id] = left
+            else:
+                self._active.pop(visit_id, None)
+
+    def set_exercises(self, visit_id: str, exercises: List[Any]) -> None:
+        with self._lock:
+            session = self._sessions.get(visit_id)
+            if session is not None:
+                session.set_exercises(exercises)
+
+    def select(self, visit_id: str, key: Union[int, str]) -> Optional[dict]:
+        with self._lock:
+            session = self._sessions.get(visit_id)
+            if session is None or not session.select(key):
+                return None
+            payload = session.live()
+        self._push(visit_id, payload)
+        return payload
+
+    def feed(self, result: dict) -> None:
+        # Chiamato dal worker di inferenza per ogni nuovo risultato
+        if not self._active:
+            return
+        angles = ANGLE_ENGINE.compute(as_keypoint_array(result["keypoints"])).astype(np.float64)
+        quality = float(result.get("frame_quality") or 0.0)
+        ts = float(result.get("capture_ts") or time.time())
+        shoulders = shoulders_symmetry(result)
+        now = time.monotonic()
+        pushes = []
+        with self._lock:
+            for visit_id in list(self._active):
+                session = self._sessions[visit_id]
+                rep = session.feed(angles, quality, shoulders, ts)
+                if rep or now - session.last_push >= PUSH_INTERVAL_S:
+                    session.last_push = now
+                    pushes.append((visit_id, session.live()))
+        for visit_id, payload in pushes:
+            self._push(visit_id, payload)
+
+    def live(self, visit_id: str) -> Optional[dict]:
+        with self._lock:
+            session = self._sessions.get(visit_id)
+            return session.live() if session is not None else None
+
+    def summary(self, visit_id: str) -> Optional[dict]:
+        with self._lock:
+            session = self._sessions.get(visit_id)
+            return session.summary() if session is not None else None
+
+    def _push(self, visit_id: str, payload: dict) -> None:
+        if self.on_update is not None:
+            try:
+                self.on_update(visit_id, payload)
+            except Exception:
+                pass
+
+
+def metrics_from_recording(visit_id: str, rec: np.ndarray, exercises: Optional[List[Any]] = None) -> dict:
+    """Ricostruisce le metriche da una registrazione (visite senza sessione live, es. video caricati).
+
+    Senza indicazione dell'esercizio per frame, tutta la registrazione va al primo esercizio.
+    """
+    session = SessionMetrics(visit_id, exercises)
+    angles = rec["angles"].astype(np.float64)
+    shoulders = symmetry_array(rec["keypoints"]).tolist()
+    quality = rec["quality"].tolist()
+    ts = rec["ts"].tolist()
+    for i in range(len(rec)):
+        session.feed(angles[i], quality[i], shoulders[i], ts[i])
+    return session.summary()
@@ -0,0 +1,336 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .capabilities import optional_import
+from .framebuffer import FrameRef, FrameRing
+from .pose import ANGLE_ENGINE, LANDMARK_NAMES, as_keypoint_array
+
+
+MAGIC = b"PPSHM001"
+HEADER_SIZE = 256
+ALIGN = 64
+POLL_S = 0.002
+STALE_S = 3.0
+
+HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S8"),
+        ("slots", "<u4"),
+        ("ndim", "<u4"),
+        ("slot_bytes", "<u8"),
+        ("shape", "<u4", (3,)),
+        ("pid", "<u4"),
+        ("seq", "<u8"),
+        ("analysis_seq", "<u8"),
+        ("interval", "<f8"),
+        ("heartbeat", "<f8"),
+        ("stop", "<u4"),
+    ]
+)
+
+ANALYSIS_DTYPE = np.dtype(
+    [
+        ("seq", "<u8"),
+        ("frame_seq", "<u8"),
+        ("ts", "<f8"),
+        ("keypoints", "<f4", (len(LANDMARK_NAMES), 4)),
+        ("angles", "<f4", (len(ANGLE_ENGINE.names),)),
+        ("symmetry", "<f4"),
+        ("quality", "<f4"),
+    ]
+)
+
+
+def _align(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _layout(slots: int, slot_bytes: int) -> Tuple[int, int, int, int]:
+    # header | ts[slots] | analisi[2] | frame[slots]
+    ts_off = HEADER_SIZE
+    analysis_off = _align(ts_off + 8 * slots)
+    data_off = _align(analysis_off + 2 * ANALYSIS_DTYPE.itemsize)
+    return ts_off, analysis_off, data_off, data_off + slots * slot_bytes
+
+
+def _lock_path(name: str) -> str:
+    return os.path.join(tempfile.gettempdir(), f"{name}.lock")
+
+
+class SharedFrameRing(FrameRing):
+    """`FrameRing` in `multiprocessing.shared_memory`, condiviso tra i worker uvicorn.
+
+    Finché non viene collegato (`bind`) si comporta come un ring locale. Al
+    bind il primo processo che ottiene il lock su file diventa il produttore
+    (cattura e inferenza scrivono nel segmento); gli altri si agganciano come
+    consumatori e leggono frame e ultima analisi senza copie. L'header
+    (seq, timestamp per slot, shape) è nel segmento; i consumatori non hanno
+    notifiche dal produttore e attendono i nuovi frame con un polling breve.
+    """
+
+    def __init__(self, name: str, slots: int, shape: Tuple[int, ...], slot_bytes: Optional[int] = None) -> None:
+        self.name = name
+        self.slot_bytes = slot_bytes or int(np.prod(shape))
+        self.role: Optional[str] = None  # None (locale) | "producer" | "consumer"
+        self._shm: Optional[SharedMemory] = None
+        self._retired: List[SharedMemory] = []
+        self._lock_fd: Optional[int] = None
+        self._hdr = np.zeros(1, HEADER_DTYPE)
+        self._analysis: Optional[np.ndarray] = None
+        super().__init__(slots, shape)
+
+    # seq vive nell'header: locale prima del bind, condiviso dopo
+    @property
+    def seq(self) -> int:
+        return int(self._hdr["seq"][0])
+
+    @seq.setter
+    def seq(self, value: int) -> None:
+        self._hdr["seq"][0] = value
+
+    @property
+    def attached(self) -> bool:
+        return self._shm is not None
+
+    def _alloc(self, shape: Tuple[int, ...], dtype) -> None:
+        if self._shm is None:
+            super()._alloc(shape, dtype)
+            return
+        if int(np.prod(shape)) > self.slot_bytes:
+            raise ValueError(f"frame {shape} oltre la capacità dello slot ({self.slot_bytes} byte)")
+        hdr = self._hdr[0]
+        hdr["ndim"] = len(shape)
+        hdr["shape"][:] = tuple(shape) + (0,) * (3 - len(shape))
+        self._map_frames(tuple(shape))
+
+    def _map_frames(self, shape: Tuple[int, ...]) -> None:
+        # slot contigui nel segmento, a passo slot_bytes
+        _, _, data_off, _ = _layout(self.slots, self.slot_bytes)
+        strides = (self.slot_bytes,) + tuple(int(np.prod(shape[i + 1 :])) for i in range(len(shape)))
+        self._buf = np.ndarray((self.slots,) + shape, np.uint8, buffer=self._shm.buf, offset=data_off, strides=strides)
+
+    def _shared_shape(self) -> Tuple[int, ...]:
+        hdr = self._hdr[0]
+        return tuple(int(x) for x in hdr["shape"][: int(hdr["ndim"])])
+
+    # ------------------------------------------------------------- bind/release
+    def bind(self) -> str:
+        """Elegge il ruolo di questo processo: produttore se ottiene il lock, altrimenti consumatore."""
+        if self.role == "producer" and self._lock_fd is not None:
+            return self.role
+        fcntl = optional_import("fcntl")
+        if fcntl is None:
+            raise RuntimeError("memoria condivisa tra worker non supportata su questa piattaforma")
+        fd = os.open(_lock_path(self.name), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            self._attach()
+            return self.role
+        self._lock_fd = fd
+        self._create()
+        return self.role
+
+    def _create(self) -> None:
+        shape, seq = self.shape, self.seq
+        try:
+            # segmento lasciato da un produttore terminato
+            stale = SharedMemory(self.name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        *_, size = _layout(self.slots, self.slot_bytes)
+        shm = SharedMemory(self.name, create=True, size=size)
+        self._map(shm)
+        hdr = self._hdr[0]
+        hdr["magic"] = MAGIC
+        hdr["slots"] = self.slots
+        hdr["slot_bytes"] = self.slot_bytes
+        hdr["pid"] = os.getpid()
+        hdr["seq"] = seq
+        self._alloc(shape, np.uint8)
+        self.role = "producer"
+
+    def reattach(self) -> bool:
+        """Consumatore: si aggancia al segmento di un nuovo produttore, se esiste."""
+        fcntl = optional_import("fcntl")
+        if fcntl is None or self.role == "producer":
+            return False
+        fd = os.open(_lock_path(self.name), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # lock tenuto: c'è un produttore attivo
+            try:
+                self._attach(retries=1)
+            except RuntimeError:
+                return False
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def _attach(self, retries: int = 20) -> None:
+        for _ in range(retries):
+            try:
+                shm = SharedMemory(self.name)
+                break
+            except FileNotFoundError:
+                # lock preso ma segmento non ancora creato
+                time.sleep(0.05)
+        else:
+            raise RuntimeError(f"produttore senza segmento condiviso: {self.name}")
+        # il segmento appartiene al produttore: il resource tracker non deve rimuoverlo
+        resource_tracker.unregister(shm._name, "shared_memory")
+        hdr = np.ndarray((1,), HEADER_DTYPE, buffer=shm.buf)[0].copy()
+        if bytes(hdr["magic"]) != MAGIC:
+            shm.close()
+            raise RuntimeError(f"segmento non valido: {self.name}")
+        self.slots = int(hdr["slots"])
+        self.slot_bytes = int(hdr["slot_bytes"])
+        self._map(shm)
+        self._map_frames(self._shared_shape())
+        self.role = "consumer"
+
+    def _map(self, shm: SharedMemory) -> None:
+        if self._shm is not None:
+            # le viste già consegnate restano valide: il mapping non viene chiuso
+            self._retired.append(self._shm)
+        ts_off, analysis_off, _, _ = _layout(self.slots, self.slot_bytes)
+        self._shm = shm
+        self._hdr = np.ndarray((1,), HEADER_DTYPE, buffer=shm.buf)
+        self._ts = np.ndarray((self.slots,), np.float64, buffer=shm.buf, offset=ts_off)
+        self._analysis = np.ndarray((2,), ANALYSIS_DTYPE, buffer=shm.buf, offset=analysis_off)
+
+    def release(self) -> None:
+        """Il produttore cede il ruolo: il nome del segmento viene rimosso, i mapping esistenti restano leggibili."""
+        if self._lock_fd is not None:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        self.role = None if self._shm is None else "consumer"
+
+    # ---------------------------------------------------------------- produttore
+    def commit(self, ts: Optional[float] = None) -> int:
+        seq = super().commit(ts)
+        if self.role == "producer":
+            hdr = self._hdr[0]
+            hdr["interval"] = self._interval
+            hdr["heartbeat"] = time.time()
+        return seq
+
+    def publish_analysis(self, result: dict) -> None:
+        # doppio buffer: si scrive il record non letto, poi si avanza analysis_seq
+        if self.role != "producer":
+            return
+        hdr = self._hdr[0]
+        a = int(hdr["analysis_seq"]) + 1
+        rec = self._analysis[a % 2]
+        angles = result.get("angles") or {}
+        rec["seq"] = a
+        rec["frame_seq"] = result.get("seq", 0)
+        rec["ts"] = result.get("capture_ts", time.time())
+        rec["keypoints"] = as_keypoint_array(result["keypoints"])
+        rec["angles"] = [angles.get(n, np.nan) for n in ANGLE_ENGINE.names]
+        rec["symmetry"] = (result.get("symmetry") or {}).get("shoulders", np.nan)
+        rec["quality"] = result.get("frame_quality", 0.0)
+        hdr["analysis_seq"] = a
+
+    def request_stop(self) -> None:
+        if self._shm is not None:
+            self._hdr["stop"][0] = 1
+
+    @property
+    def stop_requested(self) -> bool:
+        return self.role == "producer" and bool(self._hdr["stop"][0])
+
+    def clear_stop(self) -> None:
+        self._hdr["stop"][0] = 0
+
+    # -------------------------------------------------------------- consumatore
+    @property
+    def analysis_seq(self) -> int:
+        return int(self._hdr["analysis_seq"][0])
+
+    def read_analysis(self, after_seq: int = 0) -> Optional[Tuple[int, dict]]:
+        """Ultima analisi pubblicata se più recente di `after_seq`: (analysis_seq, dict)."""
+        if self._analysis is None:
+            return None
+        a = self.analysis_seq
+        if a == 0 or a == after_seq:
+            return None
+        slot = self._analysis[a % 2]
+        rec = slot.copy()
+        # il produttore scrive per primo il seq del record: se dopo la copia lo
+        # slot non ha più seq `a`, la riscrittura è iniziata durante la lettura
+        if int(rec["seq"]) != a or int(slot["seq"]) != a:
+            return None  # si riprova al giro dopo
+        ts = float(rec["ts"])
+        return a, {
+            "keypoints": rec["keypoints"],
+            "angles": ANGLE_ENGINE.as_dict(rec["angles"]),
+            "symmetry": {"shoulders": float(np.nan_to_num(rec["symmetry"]))},
+            "timestamp": datetime.fromtimestamp(ts, timezone.utc).isoformat(),
+            "frame_quality": float(rec["quality"]),
+            "seq": int(rec["frame_seq"]),
+            "capture_ts": ts,
+        }
+
+    def producer_alive(self) -> bool:
+        if self._shm is None:
+            return False
+        hdr = self._hdr[0]
+        if time.time() - float(hdr["heartbeat"]) < STALE_S:
+            return True
+        try:
+            os.kill(int(hdr["pid"]), 0)
+        except OSError:
+            return False
+        return not bool(hdr["stop"])
+
+    @property
+    def measured_fps(self) -> float:
+        if self.role != "consumer":
+            return super().measured_fps
+        hdr = self._hdr[0]
+        interval = float(hdr["interval"])
+        if not interval or time.time() - float(hdr["heartbeat"]) > max(1.0, 4 * interval):
+            return 0.0
+        return 1.0 / interval
+
+    def _ref(self, seq: int) -> FrameRef:
+        if self.role == "consumer" and self._buf.shape[1:] != self._shared_shape():
+            self._map_frames(self._shared_shape())
+        return super()._ref(seq)
+
+    def wait_next(self, after_seq: int, timeout: Optional[float] = None) -> Optional[FrameRef]:
+        if self.role != "consumer":
+            return super().wait_next(after_seq, timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.seq <= after_seq:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(POLL_S)
+        return self._ref(self.seq)
+
+    async def wait_next_async(self, after_seq: int) -> FrameRef:
+        if self.role != "consumer":
+            return await super().wait_next_async(after_seq)
+        while self.seq <= after_seq:
+            await asyncio.sleep(POLL_S)
+        return self._ref(self.seq)
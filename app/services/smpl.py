@@ -1,15 +1,54 @@
 from __future__ import annotations
 
 import os
-from typing import Dict, Tuple, Optional
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+
+from .fitting import BatchFitter, FitOptions, fit_summary
+from .lbs import SmplLbs, lbs_registry
+from .mesh import Mesh, cube_mesh
+from .pose import KeypointsLike, as_keypoint_array
+
+
+class _LoadedModel:
+    __slots__ = ("model", "faces", "load_ms", "memory_bytes")
+
+    def __init__(self, model, faces, load_ms: float, memory_bytes: int) -> None:
+        self.model = model
+        self.faces = faces
+        self.load_ms = load_ms
+        self.memory_bytes = memory_bytes
+
+
+class SmplModelRegistry:
+    """Cache di processo dei modelli SMPL, uno per (model_type, gender).
+
+    torch/smplx vengono importati una sola volta; ogni modello è caricato da
+    disco al primo uso (o al warm-up) insieme ai tensori zero di default.
+    """
 
-class SmplFitter:
     def __init__(self) -> None:
-        self.available = False
+        self._lock = threading.Lock()
+        self._models: Dict[Tuple[str, str], _LoadedModel] = {}
+        self._probed = False
+        self._available = False
         self._smplx = None
         self._torch = None
         self.model_dir: Optional[str] = None
+        self.warmup_error: Optional[str] = None
+
+    @property
+    def available(self) -> bool:
+        if not self._probed:
+            with self._lock:
+                if not self._probed:
+                    self._probe()
+        return self._available
+
+    def _probe(self) -> None:
         try:
             import smplx  # type: ignore
             import torch  # type: ignore
@@ -18,88 +57,161 @@ class SmplFitter:
             self._torch = torch
             # Individua directory modelli: env var o cartella locale 'models'
             self.model_dir = os.getenv("SMPL_MODEL_DIR") or os.path.abspath("models")
-            if os.path.isdir(self.model_dir):
-                self.available = True
+            self._available = os.path.isdir(self.model_dir)
         except Exception:
-            self.available = False
+            self._available = False
+            self.model_dir = os.getenv("SMPL_MODEL_DIR")
+        self._probed = True
+
+    def get(self, model_type: str = "smpl", gender: str = "NEUTRAL") -> _LoadedModel:
+        key = (model_type, gender.upper())
+        entry = self._models.get(key)
+        if entry is not None:
+            return entry
+        if not self.available:
+            raise RuntimeError("smplx/torch o modelli SMPL non disponibili")
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                entry = self._load(*key)
+                self._models[key] = entry
+        return entry
+
+    def _load(self, model_type: str, gender: str) -> _LoadedModel:
+        torch = self._torch  # type: ignore
+        t0 = time.perf_counter()
+        device = torch.device("cpu")
+        model = self._smplx.create(  # type: ignore
+            model_path=self.model_dir,  # cartella contenente subdir smpl/smplx
+            model_type=model_type,
+            gender=gender,
+            use_pca=False,
+            batch_size=1,
+        ).to(device)
+        model.eval()
+        tensors = list(model.parameters()) + list(model.buffers())
+        memory = sum(int(t.numel()) * int(t.element_size()) for t in tensors)
+        load_ms = (time.perf_counter() - t0) * 1000.0
+        return _LoadedModel(model, model.faces, load_ms, memory)
+
+    def warmup(self, combos: Optional[List[Tuple[str, str]]] = None) -> None:
+        try:
+            if not self.available:
+                return
+            for model_type, gender in combos or parse_warmup_models(os.getenv("SMPL_WARMUP_MODELS")):
+                self.get(model_type, gender)
+        except Exception as exc:
+            self.warmup_error = str(exc)
+
+    def status(self) -> dict:
+        # Non forza il probe: /api/status non deve importare torch
+        return {
+            "probed": self._probed,
+            "available": self._available,
+            "model_dir": self.model_dir if self._probed else os.getenv("SMPL_MODEL_DIR"),
+            "loaded": [
+                {
+                    "model_type": mt,
+                    "gender": g,
+                    "load_ms": round(e.load_ms, 1),
+                    "memory_mb": round(e.memory_bytes / (1024 * 1024), 2),
+                }
+                for (mt, g), e in self._models.items()
+            ],
+            "warmup_error": self.warmup_error,
+        }
+
 
-    def fit(self, keypoints_2d: Dict[str, dict]) -> Tuple[Dict, str]:
-        # Se SMPLX+Torch e modelli disponibili: genera mesh neutra reale
+def parse_warmup_models(spec: Optional[str]) -> List[Tuple[str, str]]:
+    # "smpl:NEUTRAL,smpl:MALE" -> [("smpl", "NEUTRAL"), ("smpl", "MALE")]
+    out: List[Tuple[str, str]] = []
+    for item in (spec or "smpl:NEUTRAL").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model_type, _, gender = item.partition(":")
+        out.append((model_type.strip().lower(), (gender.strip() or "NEUTRAL").upper()))
+    return out
+
+
+model_registry = SmplModelRegistry()
+
+
+def smpl_backend() -> str:
+    """`SMPL_BACKEND`: `numpy` (LBS senza torch), `torch` (smplx) o `auto` (numpy se c'è il file del modello)."""
+    backend = os.getenv("SMPL_BACKEND", "auto").lower()
+    if backend == "auto":
+        return "numpy" if lbs_registry.available else "torch"
+    return backend
+
+
+class SmplFitter:
+    def __init__(self, registry: SmplModelRegistry = model_registry, backend: Optional[str] = None) -> None:
+        self._registry = registry
+        self.backend = backend or smpl_backend()
+        self._engine: Optional[SmplLbs] = None
+
+    @property
+    def available(self) -> bool:
+        # il backend numpy non deve importare torch nemmeno per il probe
+        if self.backend == "numpy":
+            return lbs_registry.available
+        return self._registry.available
+
+    @property
+    def model_dir(self) -> Optional[str]:
+        return lbs_registry.model_dir if self.backend == "numpy" else self._registry.model_dir
+
+    def engine(self) -> SmplLbs:
+        """Modello NumPy usato dal fitting: dal file o, col backend torch, dai pesi di smplx."""
+        if self._engine is None:
+            if self.backend == "numpy":
+                self._engine = lbs_registry.get("NEUTRAL")
+            else:
+                self._engine = SmplLbs.from_smplx(self._registry.get("smpl", "NEUTRAL").model)
+        return self._engine
+
+    def fit_sequence(self, keypoints: np.ndarray, width: int, height: int, options: Optional[FitOptions] = None) -> dict:
+        """Fitting di una sequenza `(T, 33, 4)`: pose per frame, forma condivisa, errore di riproiezione."""
+        return BatchFitter(self.engine(), options).fit_sequence(keypoints, width, height)
+
+    def mesh(self, pose: np.ndarray, betas: np.ndarray) -> Mesh:
+        verts, _ = self.engine().forward(np.asarray(pose)[None], np.asarray(betas))
+        return Mesh(verts[0], self.engine().faces)
+
+    def fit(self, keypoints_2d: KeypointsLike, width: int = 640, height: int = 480) -> Tuple[Dict, Mesh]:
+        # Fitting sul singolo frame (analisi live); senza modello: cubo e parametri neutri
         if self.available:
             try:
-                torch = self._torch  # type: ignore
-                smplx = self._smplx  # type: ignore
-                device = torch.device("cpu")
-                model = smplx.create(
-                    model_path=self.model_dir,  # cartella contenente subdir smpl/smplx
-                    model_type="smpl",
-                    gender="NEUTRAL",
-                    use_pca=False,
-                    batch_size=1,
-                ).to(device)
-
-                betas = torch.zeros([1, 10], device=device)
-                body_pose = torch.zeros([1, 69], device=device)  # 23x3 axis-angle
-                global_orient = torch.zeros([1, 3], device=device)
-                transl = torch.zeros([1, 3], device=device)
-
-                out = model(
-                    betas=betas,
-                    body_pose=body_pose,
-                    global_orient=global_orient,
-                    transl=transl,
-                    pose2rot=True,
-                )
-                verts = out.vertices[0].detach().cpu().numpy()
-                faces = model.faces
-
+                kps = as_keypoint_array(keypoints_2d) if len(keypoints_2d) else None
+                if kps is None:
+                    raise ValueError("nessun keypoint")
+                result = self.fit_sequence(kps[None], width, height, FitOptions(window=1, budget_s=0))
+                pose, betas = result["poses"][0], result["betas"]
                 params = {
-                    "betas": betas.squeeze(0).tolist(),
-                    "pose": (torch.cat([global_orient, body_pose], dim=1).squeeze(0).tolist()),
-                    "transl": transl.squeeze(0).tolist(),
+                    "betas": betas.tolist(),
+                    "pose": pose.tolist(),
+                    "transl": [0.0, 0.0, 0.0],
+                    "camera": result["cameras"][0].tolist(),
+                    "fit": fit_summary(result),
                 }
-                mesh_obj = self._to_obj(verts, faces)
-                return params, mesh_obj
+                return params, self.mesh(pose, betas)
+            except Exception:
+                pass
+            # keypoint assenti o fitting fallito: posa neutra del modello
+            try:
+                return self._neutral_params(), self.engine().neutral_mesh()
             except Exception:
                 # Se qualcosa va storto, fallback al cubo
                 pass
 
-        # Fallback: ritorna cubo OBJ e parametri neutri
-        params = {
+        # Fallback: ritorna cubo e parametri neutri
+        return self._neutral_params(), cube_mesh()
+
+    @staticmethod
+    def _neutral_params() -> Dict:
+        return {
             "betas": [0.0] * 10,
             "pose": [0.0] * 72,
             "transl": [0.0, 0.0, 0.0],
         }
-        mesh_obj = self._cube_obj()
-        return params, mesh_obj
-
-    def _to_obj(self, vertices, faces) -> str:
-        lines = ["# SMPL mesh", "o SMPL"]
-        for v in vertices:
-            lines.append(f"v {v[0]:.6f} {v[1]:.6f} {v[2]:.6f}")
-        for f in faces:
-            # OBJ usa indici 1-based
-            lines.append(f"f {int(f[0])+1} {int(f[1])+1} {int(f[2])+1}")
-        return "\n".join(lines)
-
-    def _cube_obj(self) -> str:
-        return "\n".join(
-            [
-                "# simple cube",
-                "o Cube",
-                "v -0.5 -0.5 -0.5",
-                "v  0.5 -0.5 -0.5",
-                "v  0.5  0.5 -0.5",
-                "v -0.5  0.5 -0.5",
-                "v -0.5 -0.5  0.5",
-                "v  0.5 -0.5  0.5",
-                "v  0.5  0.5  0.5",
-                "v -0.5  0.5  0.5",
-                "f 1 2 3 4",
-                "f 5 6 7 8",
-                "f 1 5 8 4",
-                "f 2 6 7 3",
-                "f 4 3 7 8",
-                "f 1 2 6 5",
-            ]
-        )
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import glob
+import os
+import time
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from .capabilities import optional_import
+
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".webm", ".m4v")
+
+
+class FrameSource:
+    """Sorgente di frame BGR per `CameraManager`.
+
+    Interfaccia minima di `cv2.VideoCapture`: `open()`, `read(out)` che può
+    scrivere direttamente nel buffer `out` (slot del ring) e `release()`.
+    La cadenza la decide il loop di cattura (`Pacer` a `CameraManager.fps`).
+    `wait_s` è la parte dell'ultima `read` passata ad attendere il dispositivo,
+    esclusa dalla latenza `capture`.
+    """
+
+    kind = "source"
+    wait_s = 0.0
+
+    def open(self) -> bool:
+        return True
+
+    def read(self, out: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        raise NotImplementedError
+
+    def release(self) -> None:
+        pass
+
+
+class OpenCVSource(FrameSource):
+    """Webcam (indice) o stream di rete (rtsp/http) via `cv2.VideoCapture`."""
+
+    kind = "opencv"
+
+    def __init__(self, source: Union[int, str], width: int, height: int, fps: int) -> None:
+        self.source = source
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self._cap = None
+
+    def open(self) -> bool:
+        cv2 = optional_import("cv2")
+        if cv2 is None:
+            return False
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            return False
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        cap.set(cv2.CAP_PROP_FPS, self.fps)
+        self._cap = cap
+        return True
+
+    def read(self, out: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        # grab attende il frame del dispositivo; retrieve lo decodifica nel buffer
+        t0 = time.perf_counter()
+        ok = self._cap.grab()
+        self.wait_s = time.perf_counter() - t0
+        if not ok:
+            return False, None
+        return self._cap.retrieve(out)
+
+    def release(self) -> None:
+        if self._cap is not None:
+            try:
+                self._cap.release()
+            except Exception:
+                pass
+            self._cap = None
+
+
+class VideoFileSource(OpenCVSource):
+    """Replay di un file video in loop, alla cadenza della camera (non a quella del file)."""
+
+    kind = "video"
+
+    def __init__(self, path: str, width: int, height: int, fps: int, loop: bool = True) -> None:
+        super().__init__(path, width, height, fps)
+        self.loop = loop
+
+    def open(self) -> bool:
+        if not os.path.exists(self.source):
+            return False
+        cv2 = optional_import("cv2")
+        if cv2 is None:
+            return False
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            return False
+        self._cap = cap
+        return True
+
+    def read(self, out: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        ok, frame = self._cap.read(out)
+        if not ok and self.loop:
+            cv2 = optional_import("cv2")
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self._cap.read(out)
+        return ok, frame
+
+
+class ImageSequenceSource(FrameSource):
+    """Sequenza di immagini numerate (glob `dir/*.jpg` o pattern `frame_%05d.png`), in loop.
+
+    Le immagini vengono decodificate una volta sola all'apertura: in replay
+    non si paga la decodifica per frame.
+    """
+
+    kind = "images"
+
+    def __init__(self, pattern: str, max_frames: int = 600) -> None:
+        self.pattern = pattern
+        self.max_frames = max_frames
+        self._frames: List[np.ndarray] = []
+        self._index = 0
+
+    def _paths(self) -> List[str]:
+        if "%" in self.pattern:
+            paths = []
+            for i in range(1_000_000):
+                path = self.pattern % i
+                if not os.path.exists(path):
+                    if i > 1:
+                        break
+                    continue
+                paths.append(path)
+            return paths
+        return sorted(glob.glob(self.pattern))
+
+    def open(self) -> bool:
+        cv2 = optional_import("cv2")
+        if cv2 is None:
+            return False
+        frames = []
+        for path in self._paths()[: self.max_frames]:
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is not None:
+                frames.append(img)
+        self._frames = frames
+        self._index = 0
+        return bool(frames)
+
+    def read(self, out: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        frame = self._frames[self._index % len(self._frames)]
+        self._index += 1
+        if out is not None and out.shape == frame.shape:
+            np.copyto(out, frame)
+            return True, out
+        return True, frame
+
+
+class SyntheticSource(FrameSource):
+    """Frame generati: sfondo a gradiente e un rettangolo in movimento (niente OpenCV richiesto).
+
+    Il movimento mantiene attivi motion gate e tracking ROI come con un paziente vero.
+    """
+
+    kind = "synthetic"
+
+    def __init__(self, width: int, height: int) -> None:
+        self.width = width
+        self.height = height
+        y, x = np.mgrid[0:height, 0:width]
+        self._background = np.stack(
+            [x * 255 // max(1, width), y * 255 // max(1, height), np.full_like(x, 64)], axis=-1
+        ).astype(np.uint8)
+        self._t = 0
+
+    def read(self, out: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        frame = out if out is not None and out.shape == self._background.shape else np.empty_like(self._background)
+        np.copyto(frame, self._background)
+        w, h = self.width // 6, self.height // 2
+        span = max(1, self.width - w)
+        x0 = abs((self._t * 4) % (2 * span) - span)
+        y0 = self.height // 4
+        frame[y0 : y0 + h, x0 : x0 + w] = (230, 230, 230)
+        self._t += 1
+        return True, frame
+
+
+def open_source(source: Union[int, str], width: int, height: int, fps: int) -> Optional[FrameSource]:
+    """Crea e apre la sorgente descritta da `source` (None se non apribile).
+
+    - indice intero o URL (`rtsp://`, `http://`): webcam / stream OpenCV
+    - `synthetic`: frame generati
+    - `video:<file>` o file con estensione video: replay del file
+    - `images:<pattern>` o pattern con `*` / `%`: sequenza di immagini
+
+    Un URL resta uno stream anche con `%` (credenziali percent-encoded) o estensione video.
+    """
+    if isinstance(source, int):
+        src: FrameSource = OpenCVSource(source, width, height, fps)
+    elif source == "synthetic":
+        src = SyntheticSource(width, height)
+    elif source.startswith("video:"):
+        src = VideoFileSource(source[len("video:") :], width, height, fps)
+    elif source.startswith("images:"):
+        src = ImageSequenceSource(source[len("images:") :])
+    elif "://" in source:
+        src = OpenCVSource(source, width, height, fps)
+    elif source.lower().endswith(VIDEO_EXTENSIONS):
+        src = VideoFileSource(source, width, height, fps)
+    elif "*" in source or "%" in source:
+        src = ImageSequenceSource(source)
+    else:
+        src = OpenCVSource(source, width, height, fps)
+    return src if src.open() else None
@@ -0,0 +1,365 @@
+from __future__ import annotations
+
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+DATA_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.dirname(__file__)), "..", "data"))
+DB_PATH = os.getenv("PHYSIOPLUS_DB") or os.path.join(DATA_ROOT, "physioplus.db")
+
+VISIT_COLUMNS = ("id", "patient_id", "operator_id", "tipo_analisi", "status", "note", "created_at", "exercises")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS visits (
+    id TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL DEFAULT '',
+    operator_id TEXT NOT NULL DEFAULT '',
+    tipo_analisi TEXT NOT NULL DEFAULT 'completa',
+    status TEXT NOT NULL DEFAULT 'in_progress',
+    note TEXT,
+    created_at TEXT NOT NULL,
+    exercises TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS idx_visits_patient ON visits(patient_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_visits_operator ON visits(operator_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_visits_status ON visits(status, created_at);
+CREATE INDEX IF NOT EXISTS idx_visits_created ON visits(created_at);
+
+CREATE TABLE IF NOT EXISTS results (
+    visit_id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+
+-- Riepilogo numerico per visita (calcolato al finalize) per i trend del paziente:
+-- vettore float32 le cui colonne sono descritte in meta 'summary_layout:<layout>'
+CREATE TABLE IF NOT EXISTS visit_summaries (
+    visit_id TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL DEFAULT '',
+    visit_ts REAL NOT NULL,
+    created_at TEXT NOT NULL,
+    layout TEXT NOT NULL,
+    vector BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_summaries_patient ON visit_summaries(patient_id, visit_ts);
+
+CREATE TABLE IF NOT EXISTS exercise_summaries (
+    visit_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    patient_id TEXT NOT NULL DEFAULT '',
+    visit_ts REAL NOT NULL,
+    name TEXT NOT NULL,
+    reps INTEGER,
+    target INTEGER,
+    completion REAL,
+    rom REAL,
+    mean_quality REAL,
+    duration_s REAL,
+    PRIMARY KEY (visit_id, idx)
+);
+CREATE INDEX IF NOT EXISTS idx_exercise_summaries_patient ON exercise_summaries(patient_id, visit_ts);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+EXERCISE_SUMMARY_COLUMNS = ("name", "reps", "target", "completion", "rom", "mean_quality", "duration_s")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _epoch(value: Optional[str]) -> float:
+    # created_at ISO (anche senza fuso, inteso UTC) -> secondi epoch
+    try:
+        dt = datetime.fromisoformat(str(value))
+    except (TypeError, ValueError):
+        return datetime.now(timezone.utc).timestamp()
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def default_visit(visit_id: str) -> dict:
+    return {
+        "id": visit_id,
+        "patient_id": "",
+        "operator_id": "",
+        "tipo_analisi": "completa",
+        "status": "in_progress",
+        "note": "",
+        "created_at": _now(),
+        "exercises": [],
+    }
+
+
+class VisitStore:
+    """Archivio SQLite (WAL) di visite e risultati.
+
+    Una connessione per thread; le scritture multi-step usano
+    `BEGIN IMMEDIATE` così i PUT concorrenti si serializzano senza perdere
+    aggiornamenti. Al primo avvio importa i vecchi file JSON in `data/`.
+    """
+
+    def __init__(self, path: str = DB_PATH) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if not self._initialized:
+                self._initialize()
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _initialize(self) -> None:
+        with self._init_lock:
+            if self._initialized:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = self._connect()
+            try:
+                conn.executescript(SCHEMA)
+                imported = conn.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone()
+                if imported is None:
+                    import_json_files(self, conn)
+            finally:
+                conn.close()
+            self._initialized = True
+
+    @contextmanager
+    def transaction(self, conn: Optional[sqlite3.Connection] = None) -> Iterator[sqlite3.Connection]:
+        conn = conn or self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # Visite
+    def create_visit(self, visit: dict) -> None:
+        with self.transaction() as conn:
+            self._insert_visit(conn, visit)
+
+    def _insert_visit(self, conn: sqlite3.Connection, visit: dict, replace: bool = False) -> None:
+        row = dict(default_visit(visit["id"]), **visit)
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        conn.execute(
+            f"{verb} INTO visits ({', '.join(VISIT_COLUMNS)}) VALUES ({', '.join('?' * len(VISIT_COLUMNS))})",
+            [json.dumps(row[c], ensure_ascii=False) if c == "exercises" else row[c] for c in VISIT_COLUMNS],
+        )
+
+    def get_visit(self, visit_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT * FROM visits WHERE id = ?", (visit_id,)).fetchone()
+        return _visit_from_row(row) if row is not None else None
+
+    def update_exercises(self, visit_id: str, exercises: List[Any]) -> dict:
+        with self.transaction() as conn:
+            row = conn.execute("SELECT * FROM visits WHERE id = ?", (visit_id,)).fetchone()
+            if row is None:
+                visit = default_visit(visit_id)
+                visit["exercises"] = exercises
+                self._insert_visit(conn, visit)
+                return visit
+            conn.execute(
+                "UPDATE visits SET exercises = ? WHERE id = ?",
+                (json.dumps(exercises, ensure_ascii=False), visit_id),
+            )
+            visit = _visit_from_row(row)
+            visit["exercises"] = exercises
+            return visit
+
+    def list_visits(
+        self,
+        patient_id: Optional[str] = None,
+        operator_id: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = 50,
+        offset: int = 0,
+    ) -> Tuple[List[dict], int]:
+        where: List[str] = []
+        args: List[Any] = []
+        for col, val in (("patient_id", patient_id), ("operator_id", operator_id), ("status", status)):
+            if val is not None:
+                where.append(f"{col} = ?")
+                args.append(val)
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM visits {clause}", args).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT * FROM visits {clause} ORDER BY created_at DESC LIMIT ? OFFSET ?",
+            args + [limit, offset],
+        ).fetchall()
+        return [_visit_from_row(r) for r in rows], int(total)
+
+    # Risultati
+    def save_results(self, visit_id: str, data: dict, summary: Optional[dict] = None) -> None:
+        # risultati e riepilogo per i trend nella stessa transazione
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (visit_id, created_at, data) VALUES (?, ?, ?)",
+                (visit_id, data.get("timestamp") or _now(), json.dumps(data, ensure_ascii=False)),
+            )
+            if summary is not None:
+                self._save_summary(conn, visit_id, summary)
+
+    def get_results(self, visit_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT data FROM results WHERE visit_id = ?", (visit_id,)).fetchone()
+        return json.loads(row["data"]) if row is not None else None
+
+    # Riepiloghi per visita
+    def save_summary(self, visit_id: str, summary: dict) -> None:
+        with self.transaction() as conn:
+            self._save_summary(conn, visit_id, summary)
+
+    def _save_summary(self, conn: sqlite3.Connection, visit_id: str, summary: dict) -> None:
+        """`summary`: `layout`, `columns`, `vector` (bytes float32) ed `exercises` (dict per esercizio)."""
+        visit = conn.execute("SELECT patient_id, created_at FROM visits WHERE id = ?", (visit_id,)).fetchone()
+        patient_id = visit["patient_id"] if visit is not None else ""
+        created_at = visit["created_at"] if visit is not None else _now()
+        visit_ts = _epoch(created_at)
+        conn.execute(
+            "INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)",
+            (f"summary_layout:{summary['layout']}", json.dumps(list(summary["columns"]))),
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO visit_summaries (visit_id, patient_id, visit_ts, created_at, layout, vector) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (visit_id, patient_id, visit_ts, created_at, summary["layout"], summary["vector"]),
+        )
+        conn.execute("DELETE FROM exercise_summaries WHERE visit_id = ?", (visit_id,))
+        conn.executemany(
+            f"INSERT INTO exercise_summaries (visit_id, idx, patient_id, visit_ts, {', '.join(EXERCISE_SUMMARY_COLUMNS)}) "
+            f"VALUES (?, ?, ?, ?, {', '.join('?' * len(EXERCISE_SUMMARY_COLUMNS))})",
+            [
+                [visit_id, i, patient_id, visit_ts] + [ex.get(c) for c in EXERCISE_SUMMARY_COLUMNS]
+                for i, ex in enumerate(summary.get("exercises") or [])
+            ],
+        )
+
+    def patient_summaries(
+        self,
+        patient_id: str,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """Riepiloghi delle visite del paziente in ordine di data, filtrati su `[since, until)` (epoch).
+
+        Una sola lettura indicizzata per tabella; i vettori restano blob da
+        decodificare in blocco.
+        """
+        where = "patient_id = ?"
+        args: List[Any] = [patient_id]
+        if since is not None:
+            where += " AND visit_ts >= ?"
+            args.append(since)
+        if until is not None:
+            where += " AND visit_ts < ?"
+            args.append(until)
+        conn = self._conn()
+        visits = conn.execute(
+            f"SELECT visit_id, visit_ts, created_at, layout, vector FROM visit_summaries WHERE {where} ORDER BY visit_ts, visit_id",
+            args,
+        ).fetchall()
+        exercises = conn.execute(
+            f"SELECT visit_id, visit_ts, idx, {', '.join(EXERCISE_SUMMARY_COLUMNS)} FROM exercise_summaries "
+            f"WHERE {where} ORDER BY visit_ts, visit_id, idx",
+            args,
+        ).fetchall()
+        keys = sorted({f"summary_layout:{r['layout']}" for r in visits})
+        layouts = {}
+        if keys:
+            rows = conn.execute(f"SELECT key, value FROM meta WHERE key IN ({', '.join('?' * len(keys))})", keys).fetchall()
+            layouts = {r["key"].split(":", 1)[1]: json.loads(r["value"]) for r in rows}
+        return {"visits": visits, "exercises": exercises, "layouts": layouts}
+
+    def visits_without_summary(self, layout: Optional[str] = None) -> List[str]:
+        """Visite con risultati ma senza riepilogo (o con un layout diverso da `layout`)."""
+        sql = (
+            "SELECT r.visit_id FROM results r LEFT JOIN visit_summaries s ON s.visit_id = r.visit_id "
+            "WHERE s.visit_id IS NULL"
+        )
+        args: List[Any] = []
+        if layout is not None:
+            sql += " OR s.layout != ?"
+            args.append(layout)
+        return [r[0] for r in self._conn().execute(sql + " ORDER BY r.visit_id", args).fetchall()]
+
+
+def _visit_from_row(row: sqlite3.Row) -> dict:
+    visit = dict(row)
+    visit["exercises"] = json.loads(visit["exercises"] or "[]")
+    return visit
+
+
+def import_json_files(
+    store: VisitStore,
+    conn: Optional[sqlite3.Connection] = None,
+    visits_dir: str = os.path.join(DATA_ROOT, "visits"),
+    results_dir: str = os.path.join(DATA_ROOT, "results"),
+) -> Dict[str, int]:
+    """Migrazione one-shot dei file JSON storici (data/visits, data/results)."""
+    counts = {"visits": 0, "results": 0, "errors": 0}
+    with store.transaction(conn) as c:
+        for path in sorted(glob.glob(os.path.join(visits_dir, "*.json"))):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    visit = json.load(f)
+                visit.setdefault("id", os.path.splitext(os.path.basename(path))[0])
+                store._insert_visit(c, {k: v for k, v in visit.items() if k in VISIT_COLUMNS}, replace=True)
+                counts["visits"] += 1
+            except Exception:
+                counts["errors"] += 1
+        for path in sorted(glob.glob(os.path.join(results_dir, "*.json"))):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                visit_id = data.get("visit_id") or os.path.splitext(os.path.basename(path))[0]
+                c.execute(
+                    "INSERT OR REPLACE INTO results (visit_id, created_at, data) VALUES (?, ?, ?)",
+                    (visit_id, data.get("timestamp") or _now(), json.dumps(data, ensure_ascii=False)),
+                )
+                counts["results"] += 1
+            except Exception:
+                counts["errors"] += 1
+        c.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)",
+            (json.dumps(dict(counts, at=_now())),),
+        )
+    return counts
+
+
+store = VisitStore()
+
+
+if __name__ == "__main__":
+    # python -m app.services.store migrate  -> reimporta i file JSON nel DB
+    if sys.argv[1:2] == ["migrate"]:
+        print(json.dumps(import_json_files(store, store._conn())))
+    else:
+        print("usage: python -m app.services.store migrate")
@@ -0,0 +1,345 @@
+from __future__ import annotations
+
+import json
+import math
+import sys
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .pose import ANGLE_ENGINE
+
+
+JOINTS = tuple(ANGLE_ENGINE.names)
+ANGLE_FIELDS = ("mean", "min", "max", "rom")
+# coppie sinistra/destra, come nella simmetria delle metriche per esercizio
+PAIRS = tuple(n[len("left_") :] for n in JOINTS if n.startswith("left_") and "right_" + n[len("left_") :] in JOINTS)
+SYMMETRY_FIELDS = ("rom_index", "mean_abs_diff")
+SESSION_FIELDS = ("frames", "duration_s", "mean_quality", "reps", "completion", "fit_error_px")
+
+COLUMNS = tuple(
+    [f"angles.{j}.{f}" for j in JOINTS for f in ANGLE_FIELDS]
+    + [f"symmetry.{p}.{f}" for p in PAIRS for f in SYMMETRY_FIELDS]
+    + ["symmetry.shoulders"]
+    + [f"session.{f}" for f in SESSION_FIELDS]
+)
+COLUMN_INDEX = {c: i for i, c in enumerate(COLUMNS)}
+# cambia con le colonne: i riepiloghi salvati con un layout diverso si rimappano per nome
+LAYOUT = f"v1-{zlib.crc32(','.join(COLUMNS).encode()):08x}"
+
+BUCKETS = ("visit", "week", "month")
+DAY_S = 86400.0
+
+
+def _num(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def _weighted(pairs: List[tuple]) -> Optional[float]:
+    # media pesata di (valore, peso) ignorando i valori mancanti
+    pairs = [(v, w) for v, w in pairs if v is not None]
+    if not pairs:
+        return None
+    total = sum(w for _, w in pairs)
+    if total <= 0:
+        return sum(v for v, _ in pairs) / len(pairs)
+    return sum(v * w for v, w in pairs) / total
+
+
+def exercise_outcome(exercise: dict) -> dict:
+    """Esito di un esercizio della visita: ripetizioni, completamento e ROM dell'angolo principale."""
+    angles = exercise.get("angles") or {}
+    roms = [_num((angles.get(j) or {}).get("rom")) for j in exercise.get("joints") or []]
+    roms = [r for r in roms if r is not None]
+    return {
+        "name": str(exercise.get("name") or ""),
+        "reps": exercise.get("reps"),
+        "target": exercise.get("target"),
+        "completion": _num(exercise.get("completion")),
+        "rom": max(roms) if roms else None,
+        "mean_quality": _num(exercise.get("mean_quality")),
+        "duration_s": _num(exercise.get("duration_s")),
+    }
+
+
+def visit_summary(results: dict) -> dict:
+    """Riepilogo a lunghezza fissa dei risultati di una visita (`COLUMNS`), calcolato al finalize.
+
+    Angoli e simmetria vengono dagli accumulatori degli esercizi (media pesata
+    sui frame, ROM = escursione massima tra gli esercizi); senza esercizi si
+    usano le medie di sessione o lo snapshot live, che danno solo la media.
+    """
+    metrics = results.get("metrics") or {}
+    exercises = [e for e in (metrics.get("exercises") or {}).get("exercises") or [] if e.get("frames")]
+    session = metrics.get("session") or {}
+    row = np.full(len(COLUMNS), np.nan, dtype=np.float32)
+
+    def put(name: str, value: Optional[float]) -> None:
+        if value is not None:
+            row[COLUMN_INDEX[name]] = value
+
+    fallback = session.get("angles_mean") or metrics.get("angles") or {}
+    for j in JOINTS:
+        stats = [e["angles"][j] for e in exercises if j in (e.get("angles") or {})]
+        if not stats:
+            put(f"angles.{j}.mean", _num(fallback.get(j)))
+            continue
+        put(f"angles.{j}.mean", _weighted([(_num(s.get("mean")), s.get("frames") or 0) for s in stats]))
+        lows = [v for v in (_num(s.get("min")) for s in stats) if v is not None]
+        highs = [v for v in (_num(s.get("max")) for s in stats) if v is not None]
+        roms = [v for v in (_num(s.get("rom")) for s in stats) if v is not None]
+        put(f"angles.{j}.min", min(lows) if lows else None)
+        put(f"angles.{j}.max", max(highs) if highs else None)
+        put(f"angles.{j}.rom", max(roms) if roms else None)
+
+    for p in PAIRS:
+        for f in SYMMETRY_FIELDS:
+            put(f"symmetry.{p}.{f}", _weighted([(_num((e.get("symmetry") or {}).get(p, {}).get(f)), e["frames"]) for e in exercises]))
+    shoulders = _weighted([(_num((e.get("symmetry") or {}).get("shoulders")), e["frames"]) for e in exercises])
+    put("symmetry.shoulders", shoulders if shoulders is not None else _num((metrics.get("symmetry") or {}).get("shoulders")))
+
+    put("session.frames", _num(session.get("frames")) or (float(sum(e["frames"] for e in exercises)) if exercises else None))
+    put("session.duration_s", _num(session.get("duration_s")))
+    quality = _num(session.get("mean_quality"))
+    put("session.mean_quality", quality if quality is not None else _weighted([(_num(e.get("mean_quality")), e["frames"]) for e in exercises]))
+    if exercises:
+        put("session.reps", float(sum(int(e.get("reps") or 0) for e in exercises)))
+        put("session.completion", _weighted([(_num(e.get("completion")), 1) for e in exercises]))
+    fit = (results.get("smpl") or {}).get("fit") or {}
+    put("session.fit_error_px", _num((fit.get("reprojection_error_px") or {}).get("mean")))
+
+    return {
+        "layout": LAYOUT,
+        "columns": COLUMNS,
+        "vector": row.astype("<f4").tobytes(),
+        "exercises": [exercise_outcome(e) for e in exercises],
+    }
+
+
+def parse_bound(value: Optional[str], end: bool = False) -> Optional[float]:
+    """Data o data-ora ISO -> epoch. Una data sola come estremo finale include tutto il giorno."""
+    if not value:
+        return None
+    value = value.strip()
+    if len(value) == 10:
+        day = date.fromisoformat(value) + timedelta(days=1 if end else 0)
+        return datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp()
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def summary_matrix(rows: Sequence, layouts: Dict[str, List[str]]) -> np.ndarray:
+    """Vettori dei riepiloghi -> matrice (visite, `COLUMNS`); un blocco per layout, rimappato per nome."""
+    out = np.full((len(rows), len(COLUMNS)), np.nan, dtype=np.float32)
+    by_layout: Dict[str, List[int]] = {}
+    for i, r in enumerate(rows):
+        by_layout.setdefault(r["layout"], []).append(i)
+    for layout, idx in by_layout.items():
+        columns = COLUMNS if layout == LAYOUT else layouts.get(layout)
+        if not columns:
+            continue
+        block = np.frombuffer(b"".join(rows[i]["vector"] for i in idx), dtype="<f4").reshape(len(idx), len(columns))
+        if layout == LAYOUT:
+            out[idx] = block
+            continue
+        pairs = [(COLUMN_INDEX[c], k) for k, c in enumerate(columns) if c in COLUMN_INDEX]
+        if pairs:
+            dst, src = zip(*pairs)
+            out[np.ix_(idx, dst)] = block[:, src]
+    return out
+
+
+def bucket_keys(ts: np.ndarray, bucket: str) -> np.ndarray:
+    # inizio del periodo in giorni epoch: settimane da lunedì, mesi di calendario
+    days = np.floor(ts / DAY_S).astype(np.int64)
+    if bucket == "week":
+        return days - (days + 3) % 7  # 1970-01-01 era giovedì
+    if bucket == "month":
+        months = days.astype("datetime64[D]").astype("datetime64[M]")
+        return months.astype("datetime64[D]").astype(np.int64)
+    return np.arange(len(ts), dtype=np.int64)
+
+
+def aggregate(values: np.ndarray, ts: np.ndarray, keys: np.ndarray) -> tuple:
+    """Media per periodo (chiavi ordinate) con `reduceat`; restituisce valori, conteggi e istanti medi."""
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(valid, values, 0.0), starts, axis=0)
+    counts = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    sizes = np.diff(np.concatenate((starts, [len(ts)])))
+    return means, counts, np.add.reduceat(ts, starts) / sizes, starts
+
+
+def column_stats(values: np.ndarray, ts: np.ndarray) -> Dict[str, np.ndarray]:
+    """Statistiche per colonna sulle sole visite con il valore: primo, ultimo, min, max, media e pendenza a 30 giorni."""
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=0)
+    has = n > 0
+    cols = np.arange(values.shape[1])
+    first = values[valid.argmax(axis=0), cols]
+    last = values[len(values) - 1 - valid[::-1].argmax(axis=0), cols]
+    filled = np.where(valid, values, 0.0)
+    t = (ts - ts[0])[:, None] / DAY_S if len(ts) else ts[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = filled.sum(axis=0) / n
+        tm = np.where(valid, t, 0.0).sum(axis=0) / n
+        dt = np.where(valid, t - tm, 0.0)
+        var = (dt * dt).sum(axis=0)
+        slope = np.where(var > 0, (dt * (filled - mean)).sum(axis=0) / var * 30.0, np.nan)
+    return {
+        "n": n,
+        "first": np.where(has, first, np.nan),
+        "last": np.where(has, last, np.nan),
+        "min": np.where(has, np.where(valid, values, np.inf).min(axis=0), np.nan),
+        "max": np.where(has, np.where(valid, values, -np.inf).max(axis=0), np.nan),
+        "mean": np.where(has, mean, np.nan),
+        "change": np.where(has, last - first, np.nan),
+        "slope_30d": slope,
+    }
+
+
+def _clean(values: np.ndarray, digits: int = 3) -> List[Optional[float]]:
+    # arrotondamento vettoriale, NaN -> null nel JSON
+    return [None if v != v else v for v in np.round(values, digits).tolist()]
+
+
+def _iso(day: int) -> str:
+    return (date(1970, 1, 1) + timedelta(days=int(day))).isoformat()
+
+
+def select_columns(fields: Optional[Sequence[str]]) -> np.ndarray:
+    # "angles.left_knee", "symmetry" o "session.reps": prefissi per segmenti
+    if not fields:
+        return np.arange(len(COLUMNS))
+    prefixes = [f.strip() for f in fields if f.strip()]
+    return np.array(
+        [i for i, c in enumerate(COLUMNS) if any(c == p or c.startswith(p + ".") for p in prefixes)],
+        dtype=np.intp,
+    )
+
+
+def exercise_trends(rows: Sequence) -> Dict[str, dict]:
+    """Esiti per esercizio (nome normalizzato) nel tempo."""
+    if not rows:
+        return {}
+    names = np.array([str(r["name"]).strip().lower() for r in rows])
+    ts = np.array([r["visit_ts"] for r in rows], dtype=np.float64)
+    numeric = np.array(
+        [[np.nan if r[c] is None else r[c] for c in ("reps", "target", "completion", "rom")] for r in rows],
+        dtype=np.float64,
+    )
+    out: Dict[str, dict] = {}
+    for k, name in enumerate(np.unique(names)):
+        idx = np.flatnonzero(names == name)
+        sub = numeric[idx]
+        stats = column_stats(sub, ts[idx])
+        out[name] = {
+            "name": rows[idx[-1]]["name"],
+            "visits": int(len(np.unique([rows[i]["visit_id"] for i in idx]))),
+            "dates": [_iso(d) for d in np.floor(ts[idx] / DAY_S).astype(np.int64)],
+            "visit_ids": [rows[i]["visit_id"] for i in idx],
+            "reps": [None if v is None else int(v) for v in _clean(sub[:, 0], 0)],
+            "target": [None if v is None else int(v) for v in _clean(sub[:, 1], 0)],
+            "completion": _clean(sub[:, 2]),
+            "rom": _clean(sub[:, 3], 2),
+            "stats": {
+                "reps_total": int(np.nansum(sub[:, 0])),
+                "completion_mean": _clean(stats["mean"][2:3])[0],
+                "rom_best": _clean(stats["max"][3:4], 2)[0],
+                "rom_last": _clean(stats["last"][3:4], 2)[0],
+                "rom_slope_30d": _clean(stats["slope_30d"][3:4])[0],
+            },
+        }
+    return out
+
+
+def patient_trends(
+    store,
+    patient_id: str,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    bucket: str = "visit",
+    fields: Optional[Sequence[str]] = None,
+) -> dict:
+    """Trend del paziente dai soli riepiloghi salvati: una query indicizzata e aggregazione vettoriale.
+
+    Le serie sono per visita o mediate per settimana/mese; le statistiche
+    (`first`, `last`, `change`, `slope_30d`, ...) sono sempre sulle singole visite.
+    Le colonne senza alcun valore nel periodo vengono omesse.
+    """
+    if bucket not in BUCKETS:
+        raise ValueError(f"bucket must be one of {', '.join(BUCKETS)}")
+    data = store.patient_summaries(patient_id, since, until)
+    rows = data["visits"]
+    out: Dict[str, Any] = {"patient_id": patient_id, "visits": len(rows), "bucket": bucket}
+    if not rows:
+        return dict(out, **{"from": None, "to": None, "dates": [], "series": {}, "stats": {}, "exercises": {}})
+
+    cols = select_columns(fields)
+    values = summary_matrix(rows, data["layouts"])[:, cols].astype(np.float64)
+    ts = np.array([r["visit_ts"] for r in rows], dtype=np.float64)
+    keep = ~np.isnan(values).all(axis=0)
+    cols, values = cols[keep], values[:, keep]
+    names = [COLUMNS[i] for i in cols]
+
+    periods = bucket_keys(ts, bucket)
+    series, counts, _, starts = aggregate(values, ts, periods)
+    stats = column_stats(values, ts)
+    stat_names = [k for k in stats if k != "n"]
+    table = np.array([_clean(stats[k]) for k in stat_names], dtype=object).T.tolist()
+    ids = [r["visit_id"] for r in rows]
+    if bucket == "visit":
+        dates = [r["created_at"] for r in rows]
+        visit_ids: List[Any] = ids
+    else:
+        dates = [_iso(k) for k in periods[starts]]
+        bounds = list(starts) + [len(rows)]
+        visit_ids = [ids[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+    out.update(
+        {
+            "from": rows[0]["created_at"],
+            "to": rows[-1]["created_at"],
+            "dates": dates,
+            "visit_ids": visit_ids,
+            "series": {name: _clean(series[:, k]) for k, name in enumerate(names)},
+            "stats": {name: dict(zip(stat_names, row), n=n) for name, row, n in zip(names, table, stats["n"].tolist())},
+            "exercises": exercise_trends(data["exercises"]),
+        }
+    )
+    if bucket != "visit":
+        out["counts"] = {name: counts[:, k].tolist() for k, name in enumerate(names)}
+    return out
+
+
+def backfill(store, rebuild: bool = False) -> Dict[str, int]:
+    """Calcola i riepiloghi mancanti (visite finalizzate prima dei trend) o con layout vecchio se `rebuild`."""
+    counts = {"summaries": 0, "errors": 0}
+    for visit_id in store.visits_without_summary(LAYOUT if rebuild else None):
+        try:
+            results = store.get_results(visit_id)
+            if results is not None:
+                store.save_summary(visit_id, visit_summary(results))
+                counts["summaries"] += 1
+        except Exception:
+            counts["errors"] += 1
+    return counts
+
+
+if __name__ == "__main__":
+    # python -m app.services.trends backfill [--rebuild]
+    if sys.argv[1:2] == ["backfill"]:
+        from .store import store
+
+        print(json.dumps(backfill(store, rebuild="--rebuild" in sys.argv[2:])))
+    else:
+        print("usage: python -m app.services.trends backfill [--rebuild]")
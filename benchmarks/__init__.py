@@ -0,0 +1,4 @@
+"""Micro-benchmark dei percorsi caldi (cattura, encode, inferenza, serializzazione).
+
+Uso: ``python -m benchmarks [-k filtro] [--baseline benchmarks/baseline.json]``.
+"""
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+
+from . import cases  # noqa: F401  (registra i casi)
+from .harness import compare, load, run, save
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(HERE, "results", "latest.json")
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Micro-benchmark PhysioPlus")
+    parser.add_argument("-k", dest="pattern", help="esegue solo i casi il cui nome contiene questa stringa")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="file JSON dei risultati")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline con cui confrontare")
+    parser.add_argument("--threshold", type=float, default=0.2, help="regressione se la mediana cresce oltre questa frazione")
+    parser.add_argument("--save-baseline", action="store_true", help="salva i risultati anche come nuova baseline")
+    parser.add_argument("--min-time", type=float, default=0.2, help="secondi di misura per caso")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    data = run(args.pattern, min_time=args.min_time, repeat=args.repeat)
+    save(data, args.output)
+    print(f"\nrisultati: {args.output}")
+    if args.save_baseline:
+        save(data, args.baseline)
+        print(f"baseline aggiornata: {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("nessuna baseline: usare --save-baseline per crearla")
+        return 0
+
+    regressions, improvements = compare(data, load(args.baseline), args.threshold)
+    for row in improvements:
+        print(f"  meglio    {row['name']:<40} {row['baseline_us']:>10.2f} -> {row['current_us']:>10.2f} us (x{row['ratio']})")
+    for row in regressions:
+        print(f"  REGRESS.  {row['name']:<40} {row['baseline_us']:>10.2f} -> {row['current_us']:>10.2f} us (x{row['ratio']})")
+    if regressions:
+        print(f"{len(regressions)} regressioni oltre il {args.threshold:.0%}")
+        return 1
+    print("nessuna regressione")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+"""Casi di benchmark: frame sintetici e stub, nessuna camera/MediaPipe/SMPL richiesti."""
+
+from __future__ import annotations
+
+import atexit
+import base64
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import numpy as np
+
+from app.services import camera as camera_module
+from app.services.broadcast import FramePacket
+from app.services.capabilities import optional_import
+from app.services.framebuffer import FrameRing
+from app.services.fitting import BatchFitter, FitOptions, observations
+from app.services.inference import MotionGate
+from app.services.lbs import SmplLbs
+from app.services.mesh import Mesh, to_glb, to_obj, to_ply
+from app.services.metrics import Metrics
+from app.services.pose import (
+    ANGLE_ENGINE,
+    InferencePreprocessor,
+    PoseEstimator,
+    keypoints_to_dict,
+    symmetry_array,
+)
+from app.services.recording import SessionRecorder, open_recording
+from app.services.replay import KeyframeIndex, ReplayCursor
+from app.services.store import SCHEMA, VisitStore, default_visit
+from app.services.trends import JOINTS, PAIRS, patient_trends, visit_summary
+
+from .harness import Skip, case
+
+
+WIDTH, HEIGHT = 640, 480
+SMPL_VERTICES, SMPL_FACES = 6890, 13776
+
+_rng = np.random.default_rng(1234)
+_tmp = tempfile.mkdtemp(prefix="physioplus-bench-")
+atexit.register(shutil.rmtree, _tmp, True)
+
+
+def synthetic_frame(width: int = WIDTH, height: int = HEIGHT) -> np.ndarray:
+    # gradiente + rumore: dimensione JPEG realistica, non un colore pieno
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    noise = _rng.integers(-12, 13, size=base.shape)
+    return np.clip(base + noise, 0, 255).astype(np.uint8)
+
+
+def synthetic_keypoints() -> np.ndarray:
+    kps = np.empty((33, 4), dtype=np.float32)
+    kps[:, :2] = _rng.uniform(0.2, 0.8, size=(33, 2))
+    kps[:, 2] = _rng.normal(0.0, 0.1, size=33)
+    kps[:, 3] = _rng.uniform(0.6, 1.0, size=33)
+    return kps
+
+
+def synthetic_analysis() -> dict:
+    kps = synthetic_keypoints()
+    return {
+        "keypoints": kps,
+        "angles": ANGLE_ENGINE.as_dict(ANGLE_ENGINE.compute(kps)),
+        "symmetry": {"shoulders": float(symmetry_array(kps))},
+        "timestamp": "2024-01-01T00:00:00+00:00",
+        "frame_quality": 0.9,
+        "seq": 1,
+        "capture_ts": 1704067200.0,
+    }
+
+
+FRAME = synthetic_frame()
+_camera = camera_module.CameraManager("bench", 0, fps=30)
+
+
+def _require_cv2():
+    cv2 = optional_import("cv2")
+    if cv2 is None:
+        raise Skip("opencv non installato")
+    return cv2
+
+
+# ---------------------------------------------------------------- cattura
+@case("capture.ring_write")
+def _ring_write():
+    ring = FrameRing(8, FRAME.shape)
+    return lambda: ring.write(FRAME)
+
+
+@case("capture.motion_gate")
+def _motion_gate():
+    gate = MotionGate()
+    return lambda: gate.should_infer(FRAME, 0.0)
+
+
+@case("inference.roi_preprocess")
+def _roi_preprocess():
+    pre = InferencePreprocessor()
+    pre.roi = (160, 40, 480, 470)
+    return lambda: pre.prepare(FRAME)
+
+
+@case("metrics.observe")
+def _metrics_observe():
+    # costo aggiunto a ogni stadio strumentato
+    registry = Metrics(enabled=True)
+    return lambda: registry.observe("capture", 0.0042)
+
+
+# ------------------------------------------------------------------ encode
+@case("encode.jpeg_cv2")
+def _jpeg_cv2():
+    _require_cv2()
+    return lambda: _camera.encode_jpeg(FRAME)
+
+
+@case("encode.jpeg_cv2_half_q55")
+def _jpeg_cv2_tier():
+    _require_cv2()
+    return lambda: _camera.encode_jpeg(FRAME, quality=55, scale=0.5)
+
+
+@case("encode.jpeg_pil_fallback")
+def _jpeg_pil():
+    if optional_import("PIL.Image") is None:
+        raise Skip("Pillow non installato")
+    original = camera_module._cv2
+
+    def encode():
+        # forza il ramo PIL di encode_jpeg
+        camera_module._cv2 = lambda: None
+        try:
+            return _camera.encode_jpeg(FRAME)
+        finally:
+            camera_module._cv2 = original
+
+    return encode
+
+
+# ------------------------------------------------------------ serializzazione
+@case("serialize.base64_jpeg")
+def _base64_jpeg():
+    jpeg = _camera.encode_jpeg(FRAME)
+    return lambda: base64.b64encode(jpeg).decode("ascii")
+
+
+@case("serialize.frame_to_base64")
+def _frame_to_base64():
+    return lambda: _camera.frame_to_base64(FRAME)
+
+
+@case("serialize.stream_message")
+def _stream_message():
+    # payload JSON StreamData completo, JPEG già pronto: misura base64 + JSON
+    jpeg = _camera.encode_jpeg(FRAME)
+    analysis = synthetic_analysis()
+    return lambda: FramePacket(FRAME, 1, analysis, lambda frame, **kw: jpeg).message("visit-bench")
+
+
+@case("serialize.analysis_message")
+def _analysis_message():
+    analysis = synthetic_analysis()
+    return lambda: FramePacket(None, 1, analysis, lambda frame, **kw: b"").analysis_message("visit-bench")
+
+
+@case("serialize.keypoints_to_dict")
+def _keypoints_to_dict():
+    kps = synthetic_keypoints()
+    return lambda: keypoints_to_dict(kps)
+
+
+# -------------------------------------------------------------------- pose
+@case("pose.derive_angles")
+def _derive_angles():
+    # PoseEstimator senza __init__: niente MediaPipe, solo i metodi di derivazione
+    est = PoseEstimator.__new__(PoseEstimator)
+    kps = synthetic_keypoints()
+    return lambda: est.derive_angles(kps)
+
+
+@case("pose.derive_symmetry")
+def _derive_symmetry():
+    est = PoseEstimator.__new__(PoseEstimator)
+    kps = synthetic_keypoints()
+    return lambda: est.derive_symmetry(kps)
+
+
+@case("pose.angles_batch_300")
+def _angles_batch():
+    batch = np.stack([synthetic_keypoints() for _ in range(300)])
+    return lambda: ANGLE_ENGINE.compute(batch)
+
+
+# -------------------------------------------------------------------- mesh
+def _smpl_sized_mesh() -> Mesh:
+    vertices = _rng.normal(0.0, 0.3, size=(SMPL_VERTICES, 3)).astype(np.float32)
+    faces = _rng.integers(0, SMPL_VERTICES, size=(SMPL_FACES, 3))
+    return Mesh(vertices, faces)
+
+
+@case("mesh.to_obj_6890")
+def _to_obj():
+    mesh = _smpl_sized_mesh()
+    return lambda: to_obj(mesh)
+
+
+@case("mesh.to_ply_6890")
+def _to_ply():
+    mesh = _smpl_sized_mesh()
+    return lambda: to_ply(mesh)
+
+
+@case("mesh.to_glb_6890")
+def _to_glb():
+    mesh = _smpl_sized_mesh()
+    return lambda: to_glb(mesh)
+
+
+def _synthetic_smpl() -> SmplLbs:
+    # pesi casuali con le dimensioni di SMPL: stesso costo del modello vero
+    parents = np.array([0, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 12, 13, 14, 16, 17, 18, 19, 20, 21])
+    weights = _rng.random((SMPL_VERTICES, 24)) ** 4
+    return SmplLbs(
+        {
+            "v_template": _rng.normal(0.0, 0.3, size=(SMPL_VERTICES, 3)),
+            "shapedirs": _rng.normal(0.0, 0.01, size=(SMPL_VERTICES, 3, 10)),
+            "posedirs": _rng.normal(0.0, 0.01, size=(SMPL_VERTICES, 3, 207)),
+            "J_regressor": _rng.random((24, SMPL_VERTICES)) / SMPL_VERTICES,
+            "weights": weights / weights.sum(axis=1, keepdims=True),
+            "kintree_table": np.stack([parents, np.arange(24)]),
+            "f": _rng.integers(0, SMPL_VERTICES, size=(SMPL_FACES, 3)),
+        }
+    )
+
+
+@case("smpl.lbs_1")
+def _lbs_single():
+    model = _synthetic_smpl()
+    poses = _rng.normal(0.0, 0.3, size=(1, 72)).astype(np.float32)
+    return lambda: model.forward(poses)
+
+
+@case("smpl.lbs_batch_64")
+def _lbs_batch():
+    # 64 frame di una sessione con la stessa forma: si divide per 64 per il costo a frame
+    model = _synthetic_smpl()
+    poses = _rng.normal(0.0, 0.3, size=(64, 72)).astype(np.float32)
+    betas = _rng.normal(0.0, 1.0, size=10).astype(np.float32)
+    return lambda: model.forward(poses, betas)
+
+
+@case("smpl.fit_window_16")
+def _fit_window():
+    # 10 iterazioni fisse (niente arresto anticipato) su una finestra di 16 frame
+    fitter = BatchFitter(_synthetic_smpl(), FitOptions(iterations=10, tol=0.0))
+    obs, weights = observations(np.stack([synthetic_keypoints() for _ in range(16)]), WIDTH, HEIGHT)
+    return lambda: fitter.fit_window(obs, weights)
+
+
+# ------------------------------------------------------------------ visite
+def _visit(visit_id: str) -> dict:
+    visit = default_visit(visit_id)
+    visit.update(patient_id="p-bench", operator_id="o-bench", tipo_analisi="posturale")
+    visit["exercises"] = [{"name": f"esercizio {i}", "reps": 10, "sets": 3} for i in range(8)]
+    return visit
+
+
+@case("visits.json_write")
+def _json_write():
+    path = os.path.join(_tmp, "visit.json")
+    visit = _visit("v-json")
+
+    def write():
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(visit, f, ensure_ascii=False, indent=2)
+
+    return write
+
+
+@case("visits.json_read")
+def _json_read():
+    path = os.path.join(_tmp, "visit-read.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(_visit("v-json"), f, ensure_ascii=False, indent=2)
+
+    def read():
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    return read
+
+
+_store_ids = itertools.count()
+
+
+def _bench_store() -> VisitStore:
+    path = os.path.join(_tmp, f"bench-{next(_store_ids)}.db")
+    # schema già creato e import JSON marcato come fatto: nessun dato reale coinvolto
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', 'bench')")
+    conn.commit()
+    conn.close()
+    return VisitStore(path)
+
+
+@case("visits.sqlite_create")
+def _sqlite_create():
+    store = _bench_store()
+    ids = itertools.count()
+    return lambda: store.create_visit(_visit(f"v-{next(ids)}"))
+
+
+@case("visits.sqlite_get")
+def _sqlite_get():
+    store = _bench_store()
+    store.create_visit(_visit("v-get"))
+    return lambda: store.get_visit("v-get")
+
+
+@case("visits.sqlite_update_exercises")
+def _sqlite_update():
+    store = _bench_store()
+    store.create_visit(_visit("v-put"))
+    exercises = _visit("v-put")["exercises"]
+    return lambda: store.update_exercises("v-put", exercises)
+
+
+@case("visits.sqlite_list_50")
+def _sqlite_list():
+    store = _bench_store()
+    for i in range(500):
+        store.create_visit(_visit(f"v-{i}"))
+    return lambda: store.list_visits(patient_id="p-bench", limit=50)
+
+
+def _synthetic_results(i: int) -> dict:
+    # risultati di una visita con due esercizi, nella forma scritta dal finalize
+    def exercise(k: int) -> dict:
+        angles = {j: {"mean": 120.0 + i % 7, "min": 80.0 - k, "max": 160.0 + i * 0.05, "rom": 80.0 + i * 0.05, "frames": 900} for j in JOINTS}
+        symmetry = {p: {"mean_abs_diff": 4.0, "rom_index": 0.9} for p in PAIRS}
+        return {"name": f"esercizio {k}", "joints": ["left_knee", "right_knee"], "frames": 900, "reps": 10, "target": 12,
+                "completion": 0.83, "mean_quality": 0.8, "duration_s": 30.0, "angles": angles, "symmetry": symmetry}
+
+    return {"metrics": {"session": {"frames": 1800, "duration_s": 60.0, "mean_quality": 0.8}, "exercises": {"exercises": [exercise(0), exercise(1)]}}}
+
+
+@case("patients.trends_500")
+def _patient_trends():
+    # trend di tutte le colonne su 500 visite, solo dai riepiloghi salvati
+    store = _bench_store()
+    for i in range(500):
+        visit = _visit(f"v-{i}")
+        visit["created_at"] = f"2024-{1 + i // 50:02d}-{1 + i % 28:02d}T10:00:00+00:00"
+        store.create_visit(visit)
+        store.save_summary(visit["id"], visit_summary(_synthetic_results(i)))
+    return lambda: patient_trends(store, "p-bench", bucket="month")
+
+
+# ------------------------------------------------------------------ replay
+@case("replay.seek_frame_1h")
+def _replay_seek():
+    # seek casuale in un'ora a 30 fps con timestamp irregolari: ricerca + lettura + StreamData
+    path = os.path.join(_tmp, "replay.rec")
+    recorder = SessionRecorder("bench-replay", WIDTH, HEIGHT, path=path)
+    ts = 1.7e9 + np.cumsum(_rng.uniform(0.025, 0.042, 108000))
+    kps = synthetic_keypoints()
+    for i, t in enumerate(ts.tolist()):
+        recorder.append(i + 1, t, kps, 0.9)
+        if i % 4096 == 0:
+            recorder.flush()
+    recorder.close()
+    meta, rec = open_recording(path)
+    cursor = ReplayCursor("bench-replay", meta, rec, KeyframeIndex("bench-replay"))
+    positions = itertools.cycle(_rng.uniform(0, cursor.duration, 1024).tolist())
+    return lambda: cursor.packet(cursor.index_at(next(positions)))[0].message("bench-replay")
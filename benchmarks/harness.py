@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class Skip(Exception):
+    """Sollevata dal setup di un caso quando manca una dipendenza opzionale."""
+
+
+# nome -> setup; il setup prepara i dati e restituisce la funzione da cronometrare
+CASES: Dict[str, Callable[[], Callable[[], object]]] = {}
+
+
+def case(name: str):
+    def register(setup: Callable[[], Callable[[], object]]):
+        if name in CASES:
+            raise ValueError(f"benchmark duplicato: {name}")
+        CASES[name] = setup
+        return setup
+
+    return register
+
+
+def measure(fn: Callable[[], object], min_time: float = 0.2, repeat: int = 5) -> dict:
+    """Cronometra `fn` come timeit: calibra il numero di chiamate per ripetizione, poi `repeat` misure."""
+    fn()  # warm-up (cache, import lazy, buffer)
+    number = 1
+    target = min_time / repeat
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= target or number >= 1 << 20:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(target / elapsed) + 1))
+    per_call: List[float] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        per_call.append((time.perf_counter() - t0) / number * 1e6)
+    median = statistics.median(per_call)
+    return {
+        "median_us": round(median, 3),
+        "min_us": round(min(per_call), 3),
+        "mean_us": round(statistics.fmean(per_call), 3),
+        "stdev_pct": round(100.0 * statistics.pstdev(per_call) / median, 2) if median else 0.0,
+        "ops_per_s": round(1e6 / median, 1) if median else None,
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def environment() -> dict:
+    versions = {"python": platform.python_version()}
+    for mod in ("numpy", "cv2", "PIL"):
+        m = sys.modules.get(mod)
+        if m is not None:
+            versions[mod] = getattr(m, "__version__", None)
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions,
+    }
+
+
+def run(pattern: Optional[str] = None, min_time: float = 0.2, repeat: int = 5, log=print) -> dict:
+    results: Dict[str, dict] = {}
+    skipped: Dict[str, str] = {}
+    for name, setup in CASES.items():
+        if pattern and pattern not in name:
+            continue
+        try:
+            fn = setup()
+        except Skip as exc:
+            skipped[name] = str(exc)
+            log(f"{name:<40} skip ({exc})")
+            continue
+        res = results[name] = measure(fn, min_time=min_time, repeat=repeat)
+        log(f"{name:<40} {res['median_us']:>12.2f} us  ±{res['stdev_pct']:.1f}%")
+    return {"environment": environment(), "results": results, "skipped": skipped}
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.2) -> Tuple[List[dict], List[dict]]:
+    """Confronta le mediane: (regressioni, miglioramenti) oltre la soglia relativa."""
+    regressions, improvements = [], []
+    base = baseline.get("results", {})
+    for name, res in current.get("results", {}).items():
+        ref = base.get(name)
+        if not ref or not ref.get("median_us"):
+            continue
+        ratio = res["median_us"] / ref["median_us"]
+        row = {"name": name, "baseline_us": ref["median_us"], "current_us": res["median_us"], "ratio": round(ratio, 3)}
+        if ratio > 1.0 + threshold:
+            regressions.append(row)
+        elif ratio < 1.0 / (1.0 + threshold):
+            improvements.append(row)
+    return regressions, improvements
+
+
+def save(data: dict, path: str) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+
+
+def load(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,285 @@
+"""Load test end-to-end: N client WebSocket + traffico REST contro un server in esecuzione.
+
+    python -m benchmarks.loadtest --url http://127.0.0.1:8000 --clients 20 --duration 30
+
+Ogni client apre `/ws/pose-stream/{visit_id}` e misura la latenza tra la
+cattura del frame (`capture_ts`/`timestamp` dell'analisi) e la ricezione;
+in parallelo si creano visite, si aggiornano gli esercizi e si chiede il
+finalize. La CPU del server è campionata da `/api/status` (tempo CPU per pid).
+Client e server devono condividere l'orologio (stessa macchina o NTP).
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import websockets
+
+from .harness import environment, save
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(HERE, "results", "loadtest.json")
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+
+    return {"count": len(ordered), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 2)}
+
+
+def _capture_time(analysis: dict) -> Optional[float]:
+    ts = analysis.get("capture_ts")
+    if isinstance(ts, (int, float)):
+        return float(ts)
+    iso = analysis.get("timestamp")
+    if isinstance(iso, str):
+        try:
+            return datetime.fromisoformat(iso).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+class Http:
+    """Client REST minimale (urllib in un thread): nessuna dipendenza oltre alla stdlib."""
+
+    def __init__(self, base: str, timeout: float = 10.0) -> None:
+        self.base = base.rstrip("/")
+        self.timeout = timeout
+
+    def _call(self, method: str, path: str, body=None) -> dict:
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(self.base + path, data=data, method=method)
+        req.add_header("Content-Type", "application/json")
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return json.loads(resp.read().decode("utf-8"))
+
+    async def request(self, method: str, path: str, body=None) -> dict:
+        return await asyncio.to_thread(self._call, method, path, body)
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latency_ms: List[float] = []
+        self.clients: List[dict] = []
+        self.rest: Dict[str, List[float]] = {}
+        self.rest_errors: Dict[str, int] = {}
+        self.cpu: Dict[int, List[tuple]] = {}
+        self.device_cpu: List[float] = []
+
+    def rest_op(self, name: str, ms: Optional[float]) -> None:
+        if ms is None:
+            self.rest_errors[name] = self.rest_errors.get(name, 0) + 1
+        else:
+            self.rest.setdefault(name, []).append(ms)
+
+
+async def ws_client(index: int, ws_url: str, visit_id: str, args, stats: Stats, deadline: float) -> None:
+    mode = args.mode
+    url = f"{ws_url}/ws/pose-stream/{visit_id}"
+    query = [f"mode={mode}"] if mode == "binary" else []
+    if args.max_fps:
+        query.append(f"max_fps={args.max_fps}")
+    if query:
+        url += "?" + "&".join(query)
+    row = {"client": index, "visit_id": visit_id, "frames": 0, "video_frames": 0, "bytes": 0, "error": None}
+    first = last = None
+    try:
+        async with websockets.connect(url, max_size=None, open_timeout=10) as ws:
+            while time.monotonic() < deadline:
+                try:
+                    msg = await asyncio.wait_for(ws.recv(), max(0.1, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    break
+                now = time.time()
+                row["bytes"] += len(msg)
+                if isinstance(msg, bytes):
+                    row["video_frames"] += 1
+                    continue
+                data = json.loads(msg)
+                # hello ed eventi job hanno un "type"; i frame JSON no
+                if data.get("type", "analysis") != "analysis":
+                    continue
+                analysis = data if mode == "binary" else data.get("analysis", {})
+                if mode != "binary" and data.get("frame"):
+                    row["video_frames"] += 1
+                captured = _capture_time(analysis)
+                if captured is not None:
+                    stats.latency_ms.append((now - captured) * 1000.0)
+                row["frames"] += 1
+                first = first if first is not None else now
+                last = now
+                seq = analysis.get("seq")
+                if args.ack and isinstance(seq, int):
+                    await ws.send(json.dumps({"ack": seq}))
+    except Exception as exc:  # connessione rifiutata, chiusa dal server, ...
+        row["error"] = f"{type(exc).__name__}: {exc}"
+    span = (last - first) if first is not None and last is not None and last > first else 0.0
+    row["fps"] = round((row["frames"] - 1) / span, 2) if span else 0.0
+    row["video_fps"] = round(row["video_frames"] / span, 2) if span else 0.0
+    stats.clients.append(row)
+
+
+async def timed(stats: Stats, name: str, coro) -> Optional[dict]:
+    t0 = time.perf_counter()
+    try:
+        res = await coro
+    except (urllib.error.URLError, OSError, ValueError):
+        stats.rest_op(name, None)
+        return None
+    ok = isinstance(res, dict) and res.get("success", True)
+    stats.rest_op(name, (time.perf_counter() - t0) * 1000.0 if ok else None)
+    return res
+
+
+async def rest_traffic(http: Http, args, stats: Stats, deadline: float, counter) -> None:
+    # ciclo di una visita: crea -> esercizi -> dettaglio -> finalize
+    period = 1.0 / args.rest_rate if args.rest_rate > 0 else 0.0
+    while time.monotonic() < deadline:
+        t0 = time.monotonic()
+        n = next(counter)
+        res = await timed(
+            stats,
+            "create_visit",
+            http.request("POST", "/api/visits", {"patient_id": f"load-p{n % 50}", "operator_id": "loadtest", "tipo_analisi": "posturale"}),
+        )
+        visit_id = ((res or {}).get("data") or {}).get("visit_id")
+        if visit_id:
+            exercises = [{"name": f"esercizio {i}", "reps": 10, "sets": 3} for i in range(4)]
+            await timed(stats, "put_exercises", http.request("PUT", f"/api/visits/{visit_id}/exercises", exercises))
+            await timed(stats, "get_visit", http.request("GET", f"/api/visits/{visit_id}"))
+            if args.finalize:
+                await timed(stats, "finalize", http.request("POST", f"/api/visits/{visit_id}/finalize"))
+        if period:
+            await asyncio.sleep(max(0.0, period - (time.monotonic() - t0)))
+
+
+async def cpu_sampler(http: Http, stats: Stats, deadline: float) -> None:
+    # più worker uvicorn: ogni risposta arriva da un pid, si tiene la serie per pid
+    while time.monotonic() < deadline:
+        try:
+            data = (await http.request("GET", "/api/status"))["data"]
+        except Exception:
+            await asyncio.sleep(1.0)
+            continue
+        proc = data.get("process") or {}
+        if "pid" in proc:
+            stats.cpu.setdefault(proc["pid"], []).append((proc["time"], proc["cpu_s"]))
+        device = (data.get("camera") or {}).get("cpu_percent")
+        if device is not None:
+            stats.device_cpu.append(device)
+        await asyncio.sleep(1.0)
+
+
+def cpu_summary(stats: Stats) -> dict:
+    per_pid = {}
+    for pid, samples in stats.cpu.items():
+        if len(samples) < 2:
+            continue
+        (t0, c0), (t1, c1) = samples[0], samples[-1]
+        if t1 > t0:
+            per_pid[str(pid)] = round(100.0 * (c1 - c0) / (t1 - t0), 1)
+    return {
+        "workers_percent": per_pid,
+        "total_percent": round(sum(per_pid.values()), 1),
+        "device_percent": round(statistics.fmean(stats.device_cpu), 1) if stats.device_cpu else None,
+    }
+
+
+async def run(args) -> dict:
+    http = Http(args.url)
+    ws_url = "ws" + args.url[len("http") :] if args.url.startswith("http") else args.url
+    if args.start_camera:
+        await http.request("POST", "/api/camera/start")
+    stats = Stats()
+    # visite reali, così il finalize ha una registrazione da elaborare
+    visit_ids = []
+    for i in range(args.visits):
+        res = await http.request("POST", "/api/visits", {"patient_id": f"load-p{i}", "operator_id": "loadtest", "tipo_analisi": "posturale"})
+        visit_ids.append(res["data"]["visit_id"])
+    deadline = time.monotonic() + args.duration
+    counter = itertools.count()
+    tasks = [ws_client(i, ws_url, visit_ids[i % len(visit_ids)], args, stats, deadline) for i in range(args.clients)]
+    tasks += [rest_traffic(http, args, stats, deadline, counter) for _ in range(args.rest_workers)]
+    tasks.append(cpu_sampler(http, stats, deadline))
+    started = time.monotonic()
+    await asyncio.gather(*tasks)
+    if args.start_camera:
+        await http.request("POST", "/api/camera/stop")
+
+    clients = sorted(stats.clients, key=lambda r: r["client"])
+    fps = [c["fps"] for c in clients if not c["error"]]
+    return {
+        "environment": environment(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "elapsed_s": round(time.monotonic() - started, 2),
+        "latency_ms": percentiles(stats.latency_ms),
+        "fps": {
+            "mean": round(statistics.fmean(fps), 2) if fps else 0.0,
+            "min": min(fps) if fps else 0.0,
+            "max": max(fps) if fps else 0.0,
+        },
+        "clients": clients,
+        "client_errors": sum(1 for c in clients if c["error"]),
+        "rest": {name: percentiles(values) for name, values in stats.rest.items()},
+        "rest_errors": stats.rest_errors,
+        "server_cpu": cpu_summary(stats),
+    }
+
+
+def report(result: dict) -> None:
+    lat = result["latency_ms"]
+    print(f"client: {len(result['clients'])}  errori: {result['client_errors']}  durata: {result['elapsed_s']} s")
+    print(f"latenza frame (ms)  p50 {lat['p50']}  p95 {lat['p95']}  p99 {lat['p99']}  max {lat['max']}  n={lat['count']}")
+    fps = result["fps"]
+    print(f"fps per client      media {fps['mean']}  min {fps['min']}  max {fps['max']}")
+    for name, p in result["rest"].items():
+        errors = result["rest_errors"].get(name, 0)
+        print(f"REST {name:<15} p50 {p['p50']}  p95 {p['p95']}  p99 {p['p99']} ms  n={p['count']}  errori={errors}")
+    cpu = result["server_cpu"]
+    workers = ", ".join(f"{pid}: {pct}%" for pid, pct in cpu["workers_percent"].items()) or "n/d"
+    print(f"CPU server          {cpu['total_percent']}% ({workers})  dispositivo: {cpu['device_percent']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.loadtest", description="Load test PhysioPlus (WS + REST)")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="URL base del server")
+    parser.add_argument("--clients", type=int, default=10, help="client WebSocket concorrenti")
+    parser.add_argument("--visits", type=int, default=1, help="visite tra cui distribuire i client")
+    parser.add_argument("--duration", type=float, default=20.0, help="secondi di test")
+    parser.add_argument("--mode", choices=("json", "binary"), default="json")
+    parser.add_argument("--max-fps", type=float, default=None, help="?max_fps= per i client")
+    parser.add_argument("--ack", action="store_true", help="conferma i frame ({\"ack\": seq}) come un client reale")
+    parser.add_argument("--rest-workers", type=int, default=1, help="cicli REST concorrenti (0 = nessuno)")
+    parser.add_argument("--rest-rate", type=float, default=2.0, help="cicli visita al secondo per worker REST")
+    parser.add_argument("--finalize", action="store_true", help="include POST /finalize nel ciclo REST")
+    parser.add_argument("--start-camera", action="store_true", help="avvia e ferma la camera di default")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="file JSON dei risultati")
+    args = parser.parse_args(argv)
+    args.visits = max(1, args.visits)
+
+    result = asyncio.run(run(args))
+    report(result)
+    save(result, args.output)
+    print(f"\nrisultati: {args.output}")
+    return 1 if result["client_errors"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())